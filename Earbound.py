@@ -1,19 +1,14 @@
 import os
 import sys
+import json
 import threading
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 import subprocess
-import re
-from pathlib import Path
-import urllib.parse
-import json
-import urllib.request
-import zipfile
-import tarfile
-import platform
-import tempfile
-import shutil
+import collections
+
+from earbound_core import DownloadEngine, DUPLICATE_MODES, OUTPUT_PROFILES, dedupe_links, default_download_folder, format_bytes, format_duration, get_cache_dir, parse_rate
+from earbound_daemon import DaemonClient, DaemonError, RemoteJobQueue, start_daemon
 
 def detect_system_theme() -> str:
     try:
@@ -66,11 +61,15 @@ class ModernButton(tk.Button):
     def on_leave(self, event):
         self.configure(bg=self.master.master.colors['button_bg'])
 
-class Earbound:
+class Earbound(DownloadEngine):
+    LOG_MAX_LINES = 2000
+    UI_DRAIN_INTERVAL_MS = 100
+    RATE_LIMITS = ("Unlimited", "512 KiB/s", "1 MiB/s", "2 MiB/s", "5 MiB/s", "10 MiB/s")
+
     def __init__(self):
         self.root = tk.Tk()
         self.root.title("Earbound - Universal Music Downloader")
-        self.root.geometry("700x600")
+        self.root.geometry("900x790")
         
         self.theme = detect_system_theme()
         self.colors = get_theme_colors(self.theme)
@@ -78,6 +77,10 @@ class Earbound:
         
         self.root.resizable(True, True)
         self.root.minsize(600, 500)
+        super().__init__(max_workers=2)
+        self._job_updates = collections.deque()
+        # With a daemon running the window is only a client of its shared queue
+        self.daemon = self._connect_daemon()
         
         # Variables
         self.download_folder = tk.StringVar()
@@ -85,13 +88,29 @@ class Earbound:
         self.status_var = tk.StringVar(value="Ready to download")
         self.progress_var = tk.DoubleVar()
         self.theme_var = tk.StringVar(value="default")
-        self.is_downloading = False
-        self.current_process = None  # For cancel
-        self.cancel_requested = False  # Flag
+        self.workers_var = tk.IntVar(value=self.job_queue.max_workers)
+        self.inprocess_var = tk.BooleanVar(value=self.use_inprocess)
+        self.youtube_tracks_var = tk.IntVar(value=self.track_workers["youtube"])
+        self.spotify_tracks_var = tk.IntVar(value=self.track_workers["spotify"])
+        self.profile_var = tk.StringVar(value=OUTPUT_PROFILES[self.output_profile]["label"])
+        self.log_to_file_var = tk.BooleanVar(value=False)
+        rate_labels = [label for label in self.RATE_LIMITS if parse_rate(label) == self.scheduler.rate_limit]
+        self.rate_limit_var = tk.StringVar(value=rate_labels[0] if rate_labels else self.RATE_LIMITS[0])
+        self.duplicates_var = tk.StringVar(value=DUPLICATE_MODES[self.duplicates])
+        self.spotify_sync_var = tk.BooleanVar(value=self.spotify_sync)
+        self.prune_var = tk.BooleanVar(value=self.prune_removed)
 
         self.setup_ui()
         self.apply_theme()
-        self.check_dependencies()
+        self._drain_ui_queue()
+        if self.daemon is None:
+            self.check_dependencies()
+            self.root.after(500, self._offer_resume)
+        else:
+            self.log_message(f"Connected to the Earbound daemon on port {self.daemon.port}")
+            if not self.daemon_ready:
+                self.log_message("The daemon is still checking dependencies; downloads start once it is done")
+            self.status_var.set("Ready to download (daemon)")
         
     def setup_ui(self):
         main_frame = ttk.Frame(self.root, padding="20")
@@ -133,7 +152,7 @@ class Earbound:
         link_frame = ttk.Frame(main_frame)
         link_frame.grid(row=2, column=0, columnspan=3, sticky=(tk.W, tk.E), pady=(0, 15))
         link_frame.columnconfigure(1, weight=1)
-        ttk.Label(link_frame, text="Paste your music link here:", font=('Segoe UI', 10, 'bold')).grid(row=0, column=0, sticky=tk.W, pady=5)
+        ttk.Label(link_frame, text="Paste your music links here:", font=('Segoe UI', 10, 'bold')).grid(row=0, column=0, sticky=tk.W, pady=5)
         link_entry = ttk.Entry(link_frame, textvariable=self.link_var, font=('Segoe UI', 10))
         link_entry.grid(row=0, column=1, sticky=(tk.W, tk.E), padx=(10, 5), pady=5)
         link_entry.bind('<Return>', lambda e: self.start_download())
@@ -147,7 +166,7 @@ class Earbound:
         self.download_btn = ttk.Button(button_frame, text="Download Music", command=self.start_download, style='Accent.TButton')
         self.download_btn.pack(side=tk.LEFT, padx=(0, 10))
         
-        # CANCEL BUTTON ADDED HERE
+        # Cancels the selected jobs, or every job when nothing is selected
         self.cancel_btn = ttk.Button(button_frame, text="Cancel", command=self.cancel_download, style='Accent.TButton')
         self.cancel_btn.pack(side=tk.LEFT, padx=(0, 10))
         self.cancel_btn.config(state='disabled')  # Disabled until download starts
@@ -155,20 +174,78 @@ class Earbound:
         clear_btn = ttk.Button(button_frame, text="Clear Log", command=self.clear_log)
         clear_btn.pack(side=tk.LEFT, padx=(0, 10))
         open_folder_btn = ttk.Button(button_frame, text="Open Folder", command=self.open_download_folder)
-        open_folder_btn.pack(side=tk.LEFT)
+        open_folder_btn.pack(side=tk.LEFT, padx=(0, 10))
+        metrics_btn = ttk.Button(button_frame, text="Export Metrics", command=self.export_metrics_dialog)
+        metrics_btn.pack(side=tk.LEFT)
+        
+        # Options
+        options_frame = ttk.Frame(main_frame)
+        options_frame.grid(row=4, column=0, columnspan=3, pady=(0, 15))
+        concurrency_frame = ttk.Frame(options_frame)
+        concurrency_frame.pack(side=tk.TOP)
+        ttk.Label(concurrency_frame, text="Links at once:", font=('Segoe UI', 10)).pack(side=tk.LEFT, padx=(0, 5))
+        workers_spin = ttk.Spinbox(concurrency_frame, from_=1, to=8, width=3, textvariable=self.workers_var, command=self.on_workers_change, state="readonly")
+        workers_spin.pack(side=tk.LEFT, padx=(0, 15))
+        ttk.Label(concurrency_frame, text="Tracks at once - YouTube:", font=('Segoe UI', 10)).pack(side=tk.LEFT, padx=(0, 5))
+        youtube_spin = ttk.Spinbox(concurrency_frame, from_=1, to=16, width=3, textvariable=self.youtube_tracks_var, command=self.on_track_workers_change, state="readonly")
+        youtube_spin.pack(side=tk.LEFT, padx=(0, 10))
+        ttk.Label(concurrency_frame, text="Spotify:", font=('Segoe UI', 10)).pack(side=tk.LEFT, padx=(0, 5))
+        spotify_spin = ttk.Spinbox(concurrency_frame, from_=1, to=16, width=3, textvariable=self.spotify_tracks_var, command=self.on_track_workers_change, state="readonly")
+        spotify_spin.pack(side=tk.LEFT, padx=(0, 15))
+        ttk.Label(concurrency_frame, text="Format:", font=('Segoe UI', 10)).pack(side=tk.LEFT, padx=(0, 5))
+        profile_combo = ttk.Combobox(concurrency_frame, textvariable=self.profile_var, values=[p["label"] for p in OUTPUT_PROFILES.values()], state="readonly", width=20)
+        profile_combo.pack(side=tk.LEFT, padx=(0, 15))
+        profile_combo.bind('<<ComboboxSelected>>', self.on_profile_change)
+        
+        network_frame = ttk.Frame(options_frame)
+        network_frame.pack(side=tk.TOP, pady=(10, 0))
+        ttk.Label(network_frame, text="Speed limit:", font=('Segoe UI', 10)).pack(side=tk.LEFT, padx=(0, 5))
+        rate_combo = ttk.Combobox(network_frame, textvariable=self.rate_limit_var, values=self.RATE_LIMITS, state="readonly", width=10)
+        rate_combo.pack(side=tk.LEFT, padx=(0, 15))
+        rate_combo.bind('<<ComboboxSelected>>', self.on_rate_limit_change)
+        ttk.Label(network_frame, text="Already in library:", font=('Segoe UI', 10)).pack(side=tk.LEFT, padx=(0, 5))
+        duplicates_combo = ttk.Combobox(network_frame, textvariable=self.duplicates_var, values=list(DUPLICATE_MODES.values()), state="readonly", width=14)
+        duplicates_combo.pack(side=tk.LEFT, padx=(0, 15))
+        duplicates_combo.bind('<<ComboboxSelected>>', self.on_duplicates_change)
+        inprocess_check = ttk.Checkbutton(network_frame, text="In-process yt-dlp", variable=self.inprocess_var, command=self.on_inprocess_change)
+        inprocess_check.pack(side=tk.LEFT, padx=(0, 15))
+        sync_check = ttk.Checkbutton(network_frame, text="Sync Spotify playlists", variable=self.spotify_sync_var, command=self.on_spotify_sync_change)
+        sync_check.pack(side=tk.LEFT, padx=(0, 10))
+        prune_check = ttk.Checkbutton(network_frame, text="Delete removed tracks", variable=self.prune_var, command=self.on_spotify_sync_change)
+        prune_check.pack(side=tk.LEFT)
         
         # Progress
         progress_frame = ttk.Frame(main_frame)
-        progress_frame.grid(row=4, column=0, columnspan=3, sticky=(tk.W, tk.E), pady=(0, 15))
+        progress_frame.grid(row=5, column=0, columnspan=3, sticky=(tk.W, tk.E), pady=(0, 15))
         progress_frame.columnconfigure(0, weight=1)
         self.progress_bar = ttk.Progressbar(progress_frame, variable=self.progress_var, maximum=100, length=500, style='Accent.Horizontal.TProgressbar')
         self.progress_bar.grid(row=0, column=0, sticky=(tk.W, tk.E), pady=(0, 10))
         self.status_label = ttk.Label(progress_frame, textvariable=self.status_var, font=('Segoe UI', 10))
         self.status_label.grid(row=1, column=0, sticky=(tk.W, tk.E))
         
+        # Jobs
+        jobs_frame = ttk.Frame(main_frame)
+        jobs_frame.grid(row=6, column=0, columnspan=3, sticky=(tk.W, tk.E, tk.N, tk.S), pady=(0, 15))
+        jobs_frame.columnconfigure(0, weight=1)
+        jobs_frame.rowconfigure(0, weight=1)
+        self.jobs_tree = ttk.Treeview(jobs_frame, columns=("status", "progress", "time", "link"), show="headings", height=6)
+        self.jobs_tree.heading("status", text="Status")
+        self.jobs_tree.heading("progress", text="Progress")
+        self.jobs_tree.heading("time", text="Time")
+        self.jobs_tree.heading("link", text="Link")
+        self.jobs_tree.column("status", width=120, stretch=False)
+        self.jobs_tree.column("progress", width=220, stretch=False, anchor=tk.E)
+        self.jobs_tree.column("time", width=70, stretch=False, anchor=tk.E)
+        self.jobs_tree.column("link", width=400)
+        jobs_scrollbar = ttk.Scrollbar(jobs_frame, orient=tk.VERTICAL, command=self.jobs_tree.yview)
+        self.jobs_tree.configure(yscrollcommand=jobs_scrollbar.set)
+        self.jobs_tree.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
+        jobs_scrollbar.grid(row=0, column=1, sticky=(tk.N, tk.S))
+        main_frame.rowconfigure(6, weight=1)
+        
         # Log
         log_frame = ttk.Frame(main_frame)
-        log_frame.grid(row=5, column=0, columnspan=3, sticky=(tk.W, tk.E, tk.N, tk.S), pady=(0, 0))
+        log_frame.grid(row=7, column=0, columnspan=3, sticky=(tk.W, tk.E, tk.N, tk.S), pady=(0, 0))
         log_frame.columnconfigure(0, weight=1)
         log_frame.rowconfigure(0, weight=1)
         self.log_text = tk.Text(log_frame, height=10, width=80, font=('Consolas', 9), wrap=tk.WORD)
@@ -176,17 +253,12 @@ class Earbound:
         self.log_text.configure(yscrollcommand=scrollbar.set)
         self.log_text.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
         scrollbar.grid(row=0, column=1, sticky=(tk.N, tk.S))
-        main_frame.rowconfigure(5, weight=1)
+        log_file_check = ttk.Checkbutton(log_frame, text="Save full log to file", variable=self.log_to_file_var, command=self.on_log_to_file_change)
+        log_file_check.grid(row=1, column=0, sticky=tk.W, pady=(5, 0))
+        main_frame.rowconfigure(7, weight=1)
         
         # Default folder
-        default_folder = str(Path.home() / "Music" / "Earbound")
-        if not os.path.exists(default_folder):
-            music_folder = Path.home() / "Music"
-            if music_folder.exists():
-                default_folder = str(music_folder / "Earbound")
-            else:
-                default_folder = str(Path.home() / "Documents" / "Earbound")
-        self.download_folder.set(default_folder)
+        self.download_folder.set(default_download_folder())
         
     def apply_theme(self):
         if self.theme_var.get() == "default":
@@ -209,19 +281,118 @@ class Earbound:
         style.configure('TLabelframe.Label', background=self.colors['bg'], foreground=self.colors['fg'])
         style.configure('TProgressbar', background=self.colors['accent'], troughcolor=self.colors['secondary_bg'])
         style.configure('Accent.Horizontal.TProgressbar', background=self.colors['accent'], troughcolor=self.colors['secondary_bg'])
+        style.configure('Treeview', background=self.colors['text_bg'], fieldbackground=self.colors['text_bg'], foreground=self.colors['text_fg'])
+        style.configure('TCheckbutton', background=self.colors['bg'], foreground=self.colors['fg'])
+        style.configure('Treeview.Heading', background=self.colors['button_bg'], foreground=self.colors['button_fg'])
+
+    def _connect_daemon(self):
+        try:
+            client = DaemonClient.find() or (start_daemon() if "--daemon" in sys.argv[1:] else None)
+            if client is None:
+                return None
+            status = client.status()
+            settings = status["settings"]
+            self.job_queue = RemoteJobQueue(client, on_update=self._on_job_update, on_log=self.log_message)
+        except DaemonError as e:
+            self.log_message(f"Daemon unavailable, downloading in this window: {e}")
+            return None
+        self.daemon_ready = status["ready"]
+        self.output_profile = settings["output_profile"]
+        self.track_workers.update(settings["track_workers"])
+        self.duplicates = settings["duplicates"]
+        self.use_inprocess = settings["use_inprocess"]
+        self.spotify_sync = settings["spotify_sync"]
+        self.prune_removed = settings["prune_removed"]
+        self.scheduler.set_rate_limit(settings["rate_limit"])
+        return client
+
+    def _push_settings(self, **values):
+        if self.daemon is None:
+            return
+        try:
+            self.daemon.settings(**values)
+        except DaemonError as e:
+            self.log_message(f"Daemon: {e}")
 
     def on_theme_change(self, event=None):
         self.apply_theme()
 
+    def on_workers_change(self):
+        self.job_queue.set_max_workers(self.workers_var.get())
+
+    def on_track_workers_change(self):
+        self.track_workers = {"youtube": self.youtube_tracks_var.get(), "spotify": self.spotify_tracks_var.get()}
+        self._push_settings(track_workers=self.track_workers)
+
+    def on_profile_change(self, event=None):
+        for name, profile in OUTPUT_PROFILES.items():
+            if profile["label"] == self.profile_var.get():
+                self.output_profile = name
+        self._push_settings(output_profile=self.output_profile)
+
+    def on_rate_limit_change(self, event=None):
+        # Shared by every running download; single tracks get a larger share than playlists
+        self.scheduler.set_rate_limit(parse_rate(self.rate_limit_var.get()))
+        self._push_settings(rate_limit=self.scheduler.rate_limit)
+
+    def on_duplicates_change(self, event=None):
+        for mode, label in DUPLICATE_MODES.items():
+            if label == self.duplicates_var.get():
+                self.duplicates = mode
+        self._push_settings(duplicates=self.duplicates)
+        # Index the folder now so the first download doesn't wait for the scan
+        folder = self.download_folder.get().strip()
+        if self.duplicates != "keep" and self.daemon is None and folder and os.path.isdir(folder):
+            threading.Thread(target=self.get_library, args=(folder,), daemon=True).start()
+
+    def on_inprocess_change(self):
+        self.use_inprocess = self.inprocess_var.get()
+        self._push_settings(use_inprocess=self.use_inprocess)
+
+    def on_spotify_sync_change(self):
+        # Pruning only happens while syncing
+        self.spotify_sync = self.spotify_sync_var.get()
+        self.prune_removed = self.spotify_sync and self.prune_var.get()
+        self._push_settings(spotify_sync=self.spotify_sync, prune_removed=self.prune_removed)
+
     def browse_folder(self):
         folder = filedialog.askdirectory(title="Select Download Folder")
         if folder:
             self.download_folder.set(folder)
 
-    def log_message(self, message):
-        self.log_text.insert(tk.END, f"{message}\n")
-        self.log_text.see(tk.END)
-        self.root.update_idletasks()
+    def on_log_to_file_change(self):
+        if self.log_to_file_var.get():
+            path = get_cache_dir() / "logs" / "earbound.log"
+            self.log_pipeline.enable_file(path)
+            self.log_message(f"Logging to {path}")
+        else:
+            self.log_pipeline.disable_file()
+            self.log_message("File logging stopped")
+
+    def check_dependencies(self):
+        threading.Thread(target=DownloadEngine.check_dependencies, args=(self,), daemon=True).start()
+
+    def _drain_ui_queue(self):
+        try:
+            dropped = self.log_pipeline.take_dropped()
+            lines = self.log_pipeline.drain()
+            if dropped:
+                lines.insert(0, f"... {dropped} log lines skipped ...")
+            if lines:
+                self.log_text.insert(tk.END, "\n".join(lines) + "\n")
+                excess = int(self.log_text.index('end-1c').split('.')[0]) - 1 - self.LOG_MAX_LINES
+                if excess > 0:
+                    self.log_text.delete('1.0', f"{excess + 1}.0")
+                self.log_text.see(tk.END)
+
+            updates = collections.OrderedDict()
+            while self._job_updates:
+                job, status = self._job_updates.popleft()
+                updates[job.id] = (job, status)
+            for job, status in updates.values():
+                self._refresh_job(job, status)
+        finally:
+            self.root.after(self.UI_DRAIN_INTERVAL_MS, self._drain_ui_queue)
 
     def clear_log(self):
         self.log_text.delete(1.0, tk.END)
@@ -241,230 +412,143 @@ class Earbound:
         else:
             self.log_message("Download folder does not exist")
 
-    def check_dependencies(self):
-        self.log_message("Checking dependencies...")
-        self.ffmpeg_path = None
-        if not self._check_spotdl():
-            if not self._install_spotdl():
-                self.log_message("spotdl installation failed")
-        if not self._check_ytdlp():
-            if not self._install_ytdlp():
-                self.log_message("yt-dlp installation failed")
-        if not self._check_ffmpeg():
-            if not self._download_ffmpeg():
-                self.log_message("FFmpeg download failed")
-        self.log_message("Ready to download!")
-
-    def _check_spotdl(self):
-        try:
-            result = subprocess.run(["spotdl", "--version"], capture_output=True, check=True, timeout=5, text=True)
-            self.log_message(f"spotdl ready ({result.stdout.strip()})")
-            return True
-        except:
-            return False
-
-    def _check_ytdlp(self):
-        try:
-            result = subprocess.run(["yt-dlp", "--version"], capture_output=True, check=True, timeout=5, text=True)
-            self.log_message(f"yt-dlp ready ({result.stdout.strip()})")
-            return True
-        except:
-            return False
-
-    def _check_ffmpeg(self):
-        try:
-            subprocess.run(["ffmpeg", "-version"], capture_output=True, check=True, timeout=3)
-            self.ffmpeg_path = "ffmpeg"
-            self.log_message("FFmpeg in PATH")
-            return True
-        except:
-            bin_dir = Path(__file__).parent / "bin"
-            local = bin_dir / ("ffmpeg.exe" if os.name == 'nt' else "ffmpeg")
-            if local.exists():
-                self.ffmpeg_path = str(local)
-                self.log_message("Local FFmpeg found")
-                return True
-            return False
-
-    def _install_spotdl(self):
-        self.log_message("Installing spotdl...")
-        try:
-            subprocess.run([sys.executable, "-m", "pip", "install", "--upgrade", "pip"], check=True, timeout=30)
-            subprocess.run([sys.executable, "-m", "pip", "install", "spotdl"], check=True, timeout=120)
-            return self._check_spotdl()
-        except:
-            return False
-
-    def _install_ytdlp(self):
-        self.log_message("Installing yt-dlp...")
-        try:
-            subprocess.run([sys.executable, "-m", "pip", "install", "--upgrade", "pip"], check=True, timeout=30)
-            subprocess.run([sys.executable, "-m", "pip", "install", "yt-dlp"], check=True, timeout=60)
-            return self._check_ytdlp()
-        except:
-            return False
-
-    def _download_ffmpeg(self):
-        self.log_message("Downloading FFmpeg...")
-        try:
-            bin_dir = Path(__file__).parent / "bin"
-            bin_dir.mkdir(exist_ok=True)
-            system = platform.system().lower()
-            if system == "windows":
-                url = "https://www.gyan.dev/ffmpeg/builds/ffmpeg-release-essentials.zip"
-                zip_path = bin_dir / "ffmpeg.zip"
-                urllib.request.urlretrieve(url, zip_path)
-                with zipfile.ZipFile(zip_path, 'r') as z:
-                    for f in z.namelist():
-                        if "ffmpeg.exe" in f:
-                            z.extract(f, bin_dir)
-                            shutil.move(str(bin_dir / f), str(bin_dir / "ffmpeg.exe"))
-                            break
-                zip_path.unlink()
-            # ... (rest of download logic same as yours)
-            return self._check_ffmpeg()
-        except:
-            return False
-
-    def validate_link(self, link):
-        if not link.strip(): return False, "Enter a link"
-        if re.search(r'spotify\.com', link, re.IGNORECASE):
-            return True, f"spotify_{self._detect_spotify_content_type(link)}"
-        if re.search(r'(youtube\.com|youtu\.be|music\.youtube\.com)', link, re.IGNORECASE):
-            return True, f"youtube_{self._detect_youtube_content_type(link)}"
-        return False, "Unsupported link"
-
-    def _detect_spotify_content_type(self, link):
-        if '/playlist/' in link: return "playlist"
-        if '/album/' in link: return "album"
-        return "track"
-
-    def _detect_youtube_content_type(self, link):
-        if re.search(r'[?&]list=|/playlist', link): return "playlist"
-        return "video"
-
-    def _get_organized_download_path(self, base_path, link_type, link):
-        base = Path(base_path)
-        if link_type.startswith("spotify_playlist") or link_type.startswith("spotify_album"):
-            path = base / "Spotify_Playlist"
-            path.mkdir(exist_ok=True)
-            return str(path)
-        if link_type.startswith("youtube_playlist"):
-            name = self._get_youtube_playlist_name(link) or "Playlist"
-            path = base / "YouTube_Playlist" / self._sanitize_filename(name)
-            path.mkdir(parents=True, exist_ok=True)
-            return str(path)
-        return str(base)
-
-    def _get_youtube_playlist_name(self, link):
-        try:
-            r = subprocess.run(["yt-dlp", "--print", "%(playlist_title)s", "--playlist-items", "1", link], capture_output=True, text=True, timeout=10)
-            return r.stdout.strip().split('\n')[0] if r.returncode == 0 else None
-        except: return None
-
-    def _sanitize_filename(self, s):
-        s = re.sub(r'[<>:"/\\|?*]', '_', s)
-        s = re.sub(r'\s+', ' ', s).strip()
-        return s[:100]
+    def export_metrics_dialog(self):
+        path = filedialog.asksaveasfilename(title="Export Metrics", defaultextension=".json",
+                                            filetypes=[("JSON", "*.json"), ("Prometheus text", "*.prom"), ("All files", "*.*")])
+        if not path:
+            return
+        if self.daemon is None:
+            self.export_metrics(path)
+        else:
+            try:
+                data = self.daemon.metrics("json" if path.endswith(".json") else "prometheus")
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(json.dumps(data, indent=2) if isinstance(data, dict) else data)
+            except (DaemonError, OSError) as e:
+                self.log_message(f"Could not write metrics: {e}")
+                return
+        self.log_message(f"Metrics written to {path}")
+
+    def _offer_resume(self):
+        rows = self.resumable_jobs()
+        if not rows:
+            return
+        if messagebox.askyesno("Resume downloads", f"{len(rows)} download(s) did not finish last time. Resume them?"):
+            self.cancel_btn.config(state='normal')
+            self.status_var.set("Resuming...")
+            self.resume_jobs(rows)
+            self.log_message(f"Resumed {len(rows)} download(s)")
+        else:
+            self.discard_jobs(rows)
+            self.log_message(f"Discarded {len(rows)} unfinished download(s)")
 
     def start_download(self):
-        if self.is_downloading: return
         if not self.download_folder.get().strip():
             messagebox.showerror("Error", "Select folder")
             return
-        if not self.link_var.get().strip():
+        links = self.link_var.get().split()
+        if not links:
             messagebox.showerror("Error", "Enter link")
             return
-        valid, link_type = self.validate_link(self.link_var.get())
-        if not valid:
-            messagebox.showerror("Error", link_type)
+        canonical, invalid, duplicates = dedupe_links(links)
+        rejected = [f"{link}: {reason}" for link, reason in invalid]
+        # Links already queued or downloading aren't started a second time
+        active = {job.link for job in self.job_queue.jobs.values() if not job.finished}
+        queued = [c for c in canonical if c.url not in active]
+        duplicates += len(canonical) - len(queued)
+        if not queued:
+            messagebox.showerror("Error", "\n".join(rejected) or "Already downloading these links")
             return
+        for link in rejected:
+            self.log_message(f"Skipped {link}")
+        if duplicates:
+            self.log_message(f"Skipped {duplicates} duplicate link(s)")
 
-        self.is_downloading = True
-        self.cancel_requested = False
-        self.download_btn.config(state='disabled')
+        self.link_var.set("")
         self.cancel_btn.config(state='normal')  # Enable cancel
-        self.progress_var.set(0)
         self.status_var.set("Starting...")
-        self.current_process = None
-
-        threading.Thread(target=self.download_music, args=(link_type,), daemon=True).start()
+        folder = self.download_folder.get().strip()
+        for link in queued:
+            self.job_queue.submit(link.url, link.link_type, folder)
+        self.log_message(f"Queued {len(queued)} link(s)")
 
     def cancel_download(self):
-        if not self.is_downloading: return
-        self.cancel_requested = True
-        self.log_message("Cancelling download...")
-        self.status_var.set("Cancelling...")
-        if self.current_process:
-            try:
-                if os.name == 'nt':
-                    subprocess.run(['taskkill', '/F', '/T', '/PID', str(self.current_process.pid)], capture_output=True)
-                else:
-                    import signal
-                    os.killpg(os.getpgid(self.current_process.pid), signal.SIGTERM)
-            except: pass
-
-    def download_music(self, link_type):
-        try:
-            link = self.link_var.get().strip()
-            base_path = self.download_folder.get().strip()
-            os.makedirs(base_path, exist_ok=True)
-            download_path = self._get_organized_download_path(base_path, link_type, link)
-
-            self.log_message(f"Starting {link_type} download...")
-            self.log_message(f"Path: {download_path}")
-
-            if link_type.startswith("spotify"):
-                self._run_spotify(link, download_path)
-            else:
-                self._run_youtube(link, download_path)
-
-            if not self.cancel_requested:
-                self.log_message("Download complete!")
-                self.status_var.set("Complete")
-                self.progress_var.set(100)
-                messagebox.showinfo("Success", "Done!")
-        except Exception as e:
-            if not self.cancel_requested:
-                self.log_message(f"Error: {e}")
-                messagebox.showerror("Error", str(e))
-        finally:
-            self.is_downloading = False
-            self.download_btn.config(state='normal')
-            self.cancel_btn.config(state='disabled')
-            self.current_process = None
-
-    def _run_spotify(self, link, path):
-        cmd = ["spotdl", "download", link, "--output", path, "--format", "mp3"]
-        if self.ffmpeg_path and self.ffmpeg_path != "ffmpeg":
-            cmd += ["--ffmpeg", self.ffmpeg_path]
-        self._run_process(cmd)
-
-    def _run_youtube(self, link, path):
-        cmd = ["yt-dlp", "--format", "bestaudio", "--output", f"{path}/%(title)s.%(ext)s", "--ignore-errors"]
-        if self.ffmpeg_path and self.ffmpeg_path != "ffmpeg":
-            cmd += ["--ffmpeg-location", self.ffmpeg_path]
-        cmd += ["--extract-audio", "--audio-format", "mp3"]
-        cmd.append(link)
-        self._run_process(cmd)
-
-    def _run_process(self, cmd):
-        self.current_process = subprocess.Popen(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-            text=True, bufsize=1, preexec_fn=os.setsid if os.name != 'nt' else None
-        )
-        for line in self.current_process.stdout:
-            if self.cancel_requested: break
-            line = line.strip()
-            if line: self.log_message(line)
-            if "download:" in line.lower():
-                m = re.search(r'(\d+(?:\.\d+)?)%', line)
-                if m:
-                    p = float(m.group(1))
-                    self.progress_var.set(20 + p * 0.7)
-        self.current_process.wait()
-        if self.current_process.returncode != 0 and not self.cancel_requested:
-            raise Exception("Process failed")
+        selected = [int(item) for item in self.jobs_tree.selection()]
+        if selected:
+            for job_id in selected:
+                if self.job_queue.cancel(job_id):
+                    self.log_message(f"Cancelling job #{job_id}...")
+        elif self.job_queue.is_busy():
+            self.log_message("Cancelling all downloads...")
+            self.status_var.set("Cancelling...")
+            self.job_queue.cancel_all()
+
+    def _on_job_update(self, job):
+        # Called from worker threads; drained in _drain_ui_queue
+        self._job_updates.append((job, job.status))
+
+    def _refresh_job(self, job, status):
+        item = str(job.id)
+        progress = f"{job.progress:.0f}%"
+        if job.items_total > 1:
+            progress = f"{job.items_done}/{job.items_total} {progress}"
+        if status == "running" and job.speed:
+            progress += f" {format_bytes(job.speed)}/s"
+            if job.eta is not None:
+                progress += f" ETA {format_duration(job.eta)}"
+        metrics = job.metrics.snapshot(tracks=False)
+        shown = f"{status} ({len(job.failed_items)} failed)" if job.failed_items and job.finished else status
+        values = (shown, progress, format_duration(metrics["elapsed"]), job.link)
+        if self.jobs_tree.exists(item):
+            self.jobs_tree.item(item, values=values)
+        else:
+            self.jobs_tree.insert("", tk.END, iid=item, values=values)
+
+        if status == "done" and job.failed_items:
+            self.log_message(f"[#{job.id}] Download complete, {len(job.failed_items)} track(s) failed. {self._metrics_summary(metrics)}")
+        elif status == "done":
+            self.log_message(f"[#{job.id}] Download complete! {self._metrics_summary(metrics)}")
+        elif status == "failed":
+            self.log_message(f"[#{job.id}] Error: {job.error}")
+        elif status == "cancelled":
+            self.log_message(f"[#{job.id}] Cancelled")
+
+        jobs = list(self.job_queue.jobs.values())
+        if jobs:
+            self.progress_var.set(sum(j.progress if not j.finished else 100 for j in jobs) / len(jobs))
+        if not self.job_queue.is_busy():
+            self._on_queue_drained(jobs)
+        else:
+            running = sum(1 for j in jobs if j.status == "running")
+            queued = sum(1 for j in jobs if j.status == "queued")
+            self.status_var.set(f"Downloading: {running} running, {queued} queued")
+
+    def _metrics_summary(self, metrics):
+        parts = [f"{format_duration(metrics['elapsed'])} total"]
+        for stage in ("downloading", "converting"):
+            if metrics["track_stages"].get(stage):
+                parts.append(f"{stage} {format_duration(metrics['track_stages'][stage])}")
+        if metrics["bytes"]:
+            parts.append(format_bytes(metrics["bytes"]))
+        if metrics["throughput"]:
+            parts.append(f"{format_bytes(metrics['throughput'])}/s")
+        if metrics["retries"]:
+            parts.append(f"{metrics['retries']} retries")
+        return f"({', '.join(parts)})"
+
+    def _on_queue_drained(self, jobs):
+        if self.cancel_btn.instate(['disabled']):
+            return
+        self.cancel_btn.config(state='disabled')
+        done = sum(1 for j in jobs if j.status == "done")
+        failed = sum(1 for j in jobs if j.status == "failed")
+        cancelled = sum(1 for j in jobs if j.status == "cancelled")
+        self.status_var.set(f"Complete: {done} done, {failed} failed, {cancelled} cancelled")
+        self.job_queue.remove_finished()
+        if done and not failed:
+            messagebox.showinfo("Success", "Done!")
+        elif failed:
+            messagebox.showerror("Error", f"{failed} download(s) failed, see the log")
 
     def run(self):
         self.root.mainloop()
@@ -0,0 +1,372 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import statistics
+import collections
+import platform
+
+from earbound_core import DownloadEngine, DownloadJob, get_cache_dir
+
+# Benchmarks Earbound's own overhead against fake spotdl, yt-dlp and ffmpeg
+# executables, without network access. The fakes and the cache directory
+# live in a temporary folder; nothing outside it is touched.
+
+BENCH_FORMAT_VERSION = 1
+
+FAKE_YTDLP = r'''
+import os, sys, time, json, zlib
+args = sys.argv[1:]
+def opt(name):
+    return args[args.index(name) + 1] if name in args else None
+if "--version" in args:
+    print("2099.01.01-fake")
+    sys.exit(0)
+tracks = int(os.environ.get("FAKE_TRACKS", "10"))
+progress_lines = int(os.environ.get("FAKE_PROGRESS_LINES", "10"))
+log_lines = int(os.environ.get("FAKE_LOG_LINES", "0"))
+log_rate = float(os.environ.get("FAKE_LOG_RATE", "0"))
+track_seconds = float(os.environ.get("FAKE_TRACK_SECONDS", "0"))
+size = int(os.environ.get("FAKE_TRACK_BYTES", "4096"))
+if "--flat-playlist" in args:
+    # Ids and title differ per playlist link so concurrent playlists don't share files
+    prefix = "%04x" % (zlib.crc32(args[-1].encode()) & 0xffff)
+    entries = [{"id": "%s%07d" % (prefix, i), "url": "https://www.youtube.com/watch?v=%s%07d" % (prefix, i),
+                "title": "Track %d" % i, "ie_key": "Youtube"} for i in range(tracks)]
+    print(json.dumps({"title": "Fake playlist " + prefix, "entries": entries}))
+    sys.exit(0)
+urls = [a for a in args if a.startswith("https://")]
+if opt("--batch-file"):
+    with open(opt("--batch-file")) as f:
+        urls += [line.strip() for line in f if line.strip()]
+folder = os.path.dirname(opt("--output") or "./x")
+for url in urls:
+    video_id = url.rsplit("=", 1)[-1].rsplit("/", 1)[-1]
+    for i in range(log_lines):
+        print("[fake] LOG %.6f" % time.time(), flush=True)
+        if log_rate:
+            time.sleep(1.0 / log_rate)
+    temp_path = os.path.join(folder, video_id + ".webm.part")
+    for i in range(1, progress_lines + 1):
+        print("EARBOUND|%s|%d|%d|NA|1048576.0|1|%s" % (video_id, size * i // progress_lines, size, temp_path), flush=True)
+        if track_seconds:
+            time.sleep(track_seconds / progress_lines)
+    path = os.path.join(folder, video_id + ".webm")
+    with open(path, "wb") as f:
+        f.write(b"\0" * size)
+    print("EARBOUND_FILE|Youtube|%s|opus|%s" % (video_id, path), flush=True)
+'''
+
+FAKE_SPOTDL = r'''
+import os, sys, time, json
+args = sys.argv[1:]
+def opt(name):
+    return args[args.index(name) + 1] if name in args else None
+if "--version" in args:
+    print("4.0.0-fake")
+    sys.exit(0)
+tracks = int(os.environ.get("FAKE_TRACKS", "10"))
+track_seconds = float(os.environ.get("FAKE_TRACK_SECONDS", "0"))
+if args[0] == "save":
+    songs = [{"song_id": "%022d" % i, "name": "Track %d" % i, "artists": ["Artist"]} for i in range(tracks)]
+    with open(opt("--save-file"), "w") as f:
+        json.dump(songs, f)
+    sys.exit(0)
+folder = opt("--output") or "."
+archive = opt("--archive")
+numbers = range(tracks)
+if args[1].endswith(".spotdl"):
+    with open(args[1]) as f:
+        numbers = [int(song["song_id"]) for song in json.load(f)]
+print("Found %d songs in Fake Album (Album)" % len(numbers), flush=True)
+for i in numbers:
+    track_id = "%022d" % i
+    if track_seconds:
+        time.sleep(track_seconds)
+    with open(os.path.join(folder, "Artist - Track %d.mp3" % i), "wb") as f:
+        f.write(b"\0" * 4096)
+    print('Downloaded "Artist - Track %d": https://open.spotify.com/track/%s' % (i, track_id), flush=True)
+    if archive:
+        with open(archive, "a") as f:
+            f.write("https://open.spotify.com/track/%s\n" % track_id)
+'''
+
+FAKE_FFMPEG = r'''
+import os, sys, time, shutil
+args = sys.argv[1:]
+if "-version" in args:
+    print("ffmpeg version fake")
+    sys.exit(0)
+time.sleep(float(os.environ.get("FAKE_CONVERT_SECONDS", "0")))
+shutil.copyfile(args[args.index("-i") + 1], args[-1])
+'''
+
+def install_fakes(bin_dir):
+    for name, source in (("yt-dlp", FAKE_YTDLP), ("spotdl", FAKE_SPOTDL), ("ffmpeg", FAKE_FFMPEG)):
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(f"#!{sys.executable}\n{source}")
+        os.chmod(path, 0o755)
+
+def isolate(root):
+    # The engine keeps its cache, journal and playlist cache in the temp folder
+    os.environ["XDG_CACHE_HOME"] = os.path.join(root, "cache")
+    os.environ["LOCALAPPDATA"] = os.path.join(root, "cache")
+    if sys.platform == 'darwin':
+        os.environ["HOME"] = root
+    bin_dir = os.path.join(root, "bin")
+    os.makedirs(bin_dir)
+    install_fakes(bin_dir)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ.get("PATH", "")
+
+def set_fake(**values):
+    for key, value in values.items():
+        os.environ[f"FAKE_{key.upper()}"] = str(value)
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+class UiDrain:
+    # Stands in for the GUI's after() loop: drains the log pipeline and the
+    # job updates every interval and records how long each entry waited
+    def __init__(self, engine, interval=0.1):
+        self.engine = engine
+        self.interval = interval
+        self.log_latencies = []
+        self.update_latencies = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._drain()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._drain()
+
+    def _drain(self):
+        now = time.time()
+        for line in self.engine.log_pipeline.drain():
+            marker = line.find("LOG ")
+            if marker >= 0:
+                self.log_latencies.append(now - float(line[marker + 4:]))
+        updates = self.engine.updates
+        now = time.perf_counter()
+        while updates:
+            self.update_latencies.append(now - updates.popleft())
+
+class BenchEngine(DownloadEngine):
+    # Subprocess backends only, so the fakes on PATH are what runs
+    def __init__(self, **kwargs):
+        super().__init__(use_inprocess=False, **kwargs)
+        self.updates = collections.deque()
+        self.done_at = {}
+
+    def _on_job_update(self, job):
+        self.updates.append(time.perf_counter())
+        if job.finished and job.id not in self.done_at:
+            self.done_at[job.id] = time.perf_counter()
+
+def bench_startup(root, sizes):
+    results = collections.OrderedDict()
+    start = time.perf_counter()
+    engine = BenchEngine()
+    results["startup.engine_init_ms"] = ((time.perf_counter() - start) * 1000, "ms")
+    cache = get_cache_dir() / "dependencies.json"
+    if cache.exists():
+        cache.unlink()
+    start = time.perf_counter()
+    found = engine.check_dependencies(install=False)
+    results["startup.check_dependencies_cold_ms"] = ((time.perf_counter() - start) * 1000, "ms")
+    start = time.perf_counter()
+    engine.check_dependencies(install=False)
+    results["startup.check_dependencies_warm_ms"] = ((time.perf_counter() - start) * 1000, "ms")
+    if len(found) != 3:
+        raise RuntimeError(f"fake tools not picked up: {sorted(found)}")
+    return results
+
+def bench_process(root, sizes):
+    results = collections.OrderedDict()
+    folder = tempfile.mkdtemp(dir=root)
+    for name, fake in (("progress", dict(progress_lines=sizes["lines"], log_lines=0)),
+                       ("log", dict(progress_lines=1, log_lines=sizes["lines"]))):
+        set_fake(tracks=1, track_seconds=0, log_rate=0, **fake)
+        engine = BenchEngine()
+        job = DownloadJob("https://youtu.be/fake0000000", "youtube_video", folder)
+        start = time.perf_counter()
+        engine._run_process(["yt-dlp", "--output", os.path.join(folder, "%(title)s.%(ext)s"), job.link], job)
+        elapsed = time.perf_counter() - start
+        results[f"process.{name}_lines_per_s"] = (sizes["lines"] / elapsed, "lines/s")
+    return results
+
+def bench_latency(root, sizes):
+    results = collections.OrderedDict()
+    folder = tempfile.mkdtemp(dir=root)
+    set_fake(tracks=1, progress_lines=sizes["latency_lines"], log_lines=sizes["latency_lines"], log_rate=sizes["log_rate"],
+             track_seconds=sizes["latency_lines"] / sizes["log_rate"])
+    engine = BenchEngine()
+    job = DownloadJob("https://youtu.be/fake0000000", "youtube_video", folder)
+    with UiDrain(engine) as drain:
+        engine._run_process(["yt-dlp", "--output", os.path.join(folder, "%(title)s.%(ext)s"), job.link], job)
+    logs = drain.log_latencies
+    updates = drain.update_latencies
+    results["latency.log_p50_ms"] = (percentile(logs, 0.5) * 1000, "ms")
+    results["latency.log_p95_ms"] = (percentile(logs, 0.95) * 1000, "ms")
+    results["latency.log_max_ms"] = (max(logs or [0]) * 1000, "ms")
+    results["latency.log_dropped"] = (sizes["latency_lines"] - len(logs), "lines")
+    results["latency.update_p50_ms"] = (percentile(updates, 0.5) * 1000, "ms")
+    results["latency.update_p95_ms"] = (percentile(updates, 0.95) * 1000, "ms")
+    return results
+
+def bench_playlist(root, sizes):
+    # One large playlist with single tracks queued behind it, the way a
+    # bulk sync and a quick request meet in practice
+    results = collections.OrderedDict()
+    folder = tempfile.mkdtemp(dir=root)
+    tracks = sizes["playlist_tracks"]
+    set_fake(tracks=tracks, progress_lines=10, log_lines=0, log_rate=0, track_seconds=sizes["track_seconds"], convert_seconds=0)
+    engine = BenchEngine(max_workers=2, track_workers={"youtube": 4})
+    engine.check_dependencies(install=False)
+    playlist_link = f"https://www.youtube.com/playlist?list=PLfake{time.time_ns()}"
+    with UiDrain(engine) as drain:
+        start = time.perf_counter()
+        playlists = [engine.job_queue.submit(playlist_link, "youtube_playlist", folder)]
+        playlists.append(engine.job_queue.submit(playlist_link + "b", "youtube_playlist", folder))
+        time.sleep(0.2)
+        singles_at = time.perf_counter()
+        singles = [engine.job_queue.submit(f"https://youtu.be/single{i:05d}", "youtube_video", folder) for i in range(3)]
+        engine.job_queue.join()
+        elapsed = time.perf_counter() - start
+    failed = [job for job in playlists + singles if job.status != "done"]
+    if failed:
+        raise RuntimeError(f"job #{failed[0].id} {failed[0].status}: {failed[0].error}")
+    results["playlist.wall_s"] = (elapsed, "s")
+    results["playlist.tracks_per_s"] = ((tracks * 2 + len(singles)) / elapsed, "tracks/s")
+    latency = max(engine.done_at[job.id] for job in singles) - singles_at
+    # Single tracks run next to the playlists instead of waiting for a free slot
+    if latency > elapsed / 2:
+        raise RuntimeError(f"single tracks took {latency:.2f} s of the {elapsed:.2f} s run")
+    results["playlist.single_track_latency_s"] = (latency, "s")
+    results["playlist.update_p95_ms"] = (percentile(drain.update_latencies, 0.95) * 1000, "ms")
+
+    set_fake(tracks=tracks, track_seconds=0)
+    engine = BenchEngine()
+    engine.check_dependencies(install=False)
+    start = time.perf_counter()
+    job = engine.job_queue.submit("https://open.spotify.com/album/0000000000000000000000", "spotify_album", folder)
+    engine.job_queue.join()
+    if job.status != "done":
+        raise RuntimeError(f"spotify job {job.status}: {job.error}")
+    results["spotify.album_wall_s"] = (time.perf_counter() - start, "s")
+    # Every track is already there, so a resync stops after reading the track list
+    start = time.perf_counter()
+    job = engine.job_queue.submit("https://open.spotify.com/album/0000000000000000000000", "spotify_album", folder)
+    engine.job_queue.join()
+    if job.status != "done":
+        raise RuntimeError(f"spotify resync {job.status}: {job.error}")
+    results["spotify.resync_wall_s"] = (time.perf_counter() - start, "s")
+    return results
+
+BENCHMARKS = collections.OrderedDict([
+    ("startup", bench_startup),
+    ("process", bench_process),
+    ("latency", bench_latency),
+    ("playlist", bench_playlist),
+])
+
+SIZES = {
+    "full": {"lines": 200000, "latency_lines": 2000, "log_rate": 2000, "playlist_tracks": 300, "track_seconds": 0.02},
+    "quick": {"lines": 20000, "latency_lines": 500, "log_rate": 1000, "playlist_tracks": 40, "track_seconds": 0.01},
+}
+
+def run(names, sizes, repeat):
+    # Each benchmark runs in its own temp folder; values are the median over the repeats
+    samples = collections.OrderedDict()
+    for name in names:
+        for _ in range(repeat):
+            root = tempfile.mkdtemp(prefix="earbound-bench-")
+            saved = dict(os.environ)
+            try:
+                isolate(root)
+                for key, (value, unit) in BENCHMARKS[name](root, sizes).items():
+                    samples.setdefault(key, ([], unit))[0].append(value)
+            finally:
+                os.environ.clear()
+                os.environ.update(saved)
+                shutil.rmtree(root, ignore_errors=True)
+    return collections.OrderedDict((key, (statistics.median(values), unit)) for key, (values, unit) in samples.items())
+
+def format_results(results, size):
+    lines = [f"# earbound-bench {BENCH_FORMAT_VERSION} size={size} python={platform.python_version()} platform={sys.platform}"]
+    for key, (value, unit) in results.items():
+        lines.append(f"{key:<40} {value:>14.3f} {unit}")
+    return "\n".join(lines) + "\n"
+
+def parse_results(text):
+    results = collections.OrderedDict()
+    for line in text.splitlines():
+        parts = line.split()
+        if len(parts) == 3 and not line.startswith("#"):
+            results[parts[0]] = (float(parts[1]), parts[2])
+    return results
+
+def format_comparison(old, new):
+    lines = []
+    for key, (value, unit) in new.items():
+        if key in old and old[key][0]:
+            change = (value - old[key][0]) / old[key][0] * 100
+            lines.append(f"{key:<40} {old[key][0]:>14.3f} -> {value:>14.3f} {unit:<8} {change:+7.1f}%")
+    return "\n".join(lines) + "\n"
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="earbound-bench",
+        description="Measure Earbound's overhead offline, against fake spotdl, yt-dlp and ffmpeg executables.",
+    )
+    parser.add_argument("benchmarks", nargs="*", help=f"benchmarks to run: {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument("--quick", action="store_true", help="smaller workloads, for a fast check")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="runs per benchmark, the median is reported (default: 3)")
+    parser.add_argument("-o", "--output", help="also write the results to this file, e.g. bench_output.txt")
+    parser.add_argument("--json", action="store_true", help="print JSON instead of the text format")
+    parser.add_argument("--compare", metavar="FILE", help="show the change against results saved earlier with -o")
+    return parser
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark: {unknown[0]}")
+    if os.name == 'nt':
+        print("earbound-bench: the fake backends are POSIX scripts", file=sys.stderr)
+        return 2
+    size = "quick" if args.quick else "full"
+    results = run(args.benchmarks or list(BENCHMARKS), SIZES[size], max(1, args.repeat))
+    text = format_results(results, size)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    if args.json:
+        print(json.dumps({key: {"value": round(value, 3), "unit": unit} for key, (value, unit) in results.items()}, indent=2))
+    else:
+        sys.stdout.write(text)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            sys.stdout.write("\n" + format_comparison(parse_results(f.read()), results))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
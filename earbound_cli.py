@@ -0,0 +1,258 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+
+from earbound_core import DownloadEngine, DownloadJob, DUPLICATE_MODES, OUTPUT_PROFILES, dedupe_links, default_download_folder, job_fields, parse_rate
+from earbound_daemon import DaemonClient, DaemonError, start_daemon
+
+class CliEngine(DownloadEngine):
+    PROGRESS_INTERVAL = 1.0
+
+    def __init__(self, out=sys.stdout, verbose=False, **kwargs):
+        super().__init__(**kwargs)
+        self.out = out
+        self.verbose = verbose
+        self._out_lock = threading.Lock()
+        self._last_event = {}
+
+    def emit(self, event, **fields):
+        with self._out_lock:
+            write_event(self.out, event, **fields)
+
+    def log_message(self, message):
+        if self.verbose:
+            self.emit("log", message=message)
+
+    def _on_job_update(self, job):
+        # Status changes always go out, progress at most once per interval per job
+        now = time.monotonic()
+        last_status, last_time = self._last_event.get(job.id, (None, 0))
+        if job.status == last_status and now - last_time < self.PROGRESS_INTERVAL:
+            return
+        self._last_event[job.id] = (job.status, now)
+        fields = job_fields(job)
+        if job.finished:
+            fields["metrics"] = job.metrics.snapshot(tracks=False)
+        self.emit("result" if job.finished else "job", **fields)
+
+# How long a --daemon run keeps trying to get its event stream back
+RECONNECT_TIMEOUT = 30
+
+def write_event(out, event, **fields):
+    record = dict(event=event, time=round(time.time(), 3), **fields)
+    out.write(json.dumps(record, ensure_ascii=False) + "\n")
+    out.flush()
+
+def read_links(args):
+    links = list(args.links)
+    sources = []
+    implicit_stdin = not links and not args.input and not (args.resume or args.discard_unfinished)
+    if args.input == "-" or (implicit_stdin and not sys.stdin.isatty()):
+        sources.append(sys.stdin)
+    elif args.input:
+        sources.append(open(args.input, 'r', encoding='utf-8'))
+    for source in sources:
+        with source:
+            for line in source:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    links.extend(line.split())
+    return links
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="earbound",
+        description="Headless Earbound downloader. Progress and results are printed as JSON lines.",
+    )
+    parser.add_argument("links", nargs="*", help="links to download")
+    parser.add_argument("-i", "--input", help="file with one link per line, '-' for stdin")
+    parser.add_argument("-o", "--output", default=default_download_folder(), help="download folder")
+    parser.add_argument("-j", "--jobs", type=int, default=2, help="links downloaded at once (default: 2)")
+    parser.add_argument("--youtube-tracks", type=int, default=3, help="tracks of one YouTube playlist downloaded at once (default: 3)")
+    parser.add_argument("--spotify-tracks", type=int, default=4, help="spotdl download threads per link (default: 4)")
+    parser.add_argument("-f", "--format", choices=list(OUTPUT_PROFILES), default="mp3", help="output profile (default: mp3)")
+    parser.add_argument("--limit-rate", type=parse_rate, metavar="RATE", help="total download speed, e.g. 500K or 2M (default: unlimited)")
+    parser.add_argument("--connections", type=int, default=8, help="connections to YouTube shared by all jobs (default: 8)")
+    parser.add_argument("--engine", choices=["inprocess", "subprocess"], default="inprocess", help="how yt-dlp is driven (default: inprocess)")
+    parser.add_argument("--duplicates", choices=list(DUPLICATE_MODES), default="keep",
+                        help="tracks already somewhere in the download folder: download again, skip, or hard link them (default: keep)")
+    parser.add_argument("--no-sync", action="store_true",
+                        help="resolve Spotify playlists, albums and artists from scratch instead of only downloading tracks added since the last sync")
+    parser.add_argument("--prune", action="store_true", help="delete files of tracks removed from a synced Spotify playlist")
+    parser.add_argument("--lookup", action="append", metavar="'ARTIST - TITLE'", help="only report where the download folder already has a track (repeatable)")
+    parser.add_argument("--resume", action="store_true", help="also resume downloads left unfinished by a cancel or crash")
+    parser.add_argument("--discard-unfinished", action="store_true", help="clean up downloads left unfinished instead of resuming")
+    parser.add_argument("--metrics", metavar="FILE", help="write job metrics to FILE as each job finishes (.json, otherwise Prometheus text)")
+    parser.add_argument("--daemon", action="store_true",
+                        help="hand the links to the background daemon, starting it if needed, and follow their progress; "
+                             "download settings are the daemon's")
+    parser.add_argument("--no-install", action="store_true", help="don't install missing dependencies")
+    parser.add_argument("-v", "--verbose", action="store_true", help="also emit backend log lines")
+    return parser
+
+def lookup(args):
+    engine = CliEngine(verbose=args.verbose)
+    folder = os.path.abspath(args.output)
+    if not os.path.isdir(folder):
+        print(f"earbound: {folder} does not exist", file=sys.stderr)
+        return 2
+    library = engine.get_library(folder)
+    engine.emit("library", folder=folder, tracks=len(library), duplicates=library.duplicate_count())
+    found = 0
+    for name in args.lookup:
+        matches = library.find_name(name)
+        found += bool(matches)
+        engine.emit("lookup", query=name, matches=matches)
+    return 0 if found == len(args.lookup) else 1
+
+def run_via_daemon(args, links):
+    out = sys.stdout
+    try:
+        client = DaemonClient.find() or start_daemon(["--no-install"] if args.no_install else [])
+        # Subscribed before submitting so no update of the new jobs is missed
+        events = client.events(logs=args.verbose)
+        result = client.submit(links, os.path.abspath(args.output))
+    except DaemonError as e:
+        print(f"earbound: {e}", file=sys.stderr)
+        return 2
+    for item in result["invalid"]:
+        write_event(out, "result", link=item["link"], status="invalid", error=item["error"])
+    if result["duplicates"]:
+        write_event(out, "duplicates", count=result["duplicates"])
+    jobs = {job["id"]: job for job in result["jobs"]}
+    finished = lambda job: job["status"] in DownloadJob.FINISHED
+
+    def handle(event):
+        # Replayed snapshots after a reconnect don't repeat results already printed
+        if event["id"] not in jobs or finished(jobs[event["id"]]):
+            return
+        jobs[event["id"]] = event
+        fields = {k: v for k, v in event.items() if k not in ("event", "time", "snapshot", "folder", "metrics")}
+        if finished(event):
+            fields["metrics"] = event.get("metrics")
+        write_event(out, "result" if finished(event) else "job", **fields)
+
+    interrupted = False
+    try:
+        while not all(finished(job) for job in jobs.values()):
+            for event in events:
+                if event["event"] == "log":
+                    write_event(out, "log", message=event["message"])
+                elif event["event"] == "job":
+                    handle(event)
+                    if all(finished(job) for job in jobs.values()):
+                        break
+            else:
+                # The stream ended: the daemon dropped a slow subscriber, restarted or the connection broke
+                events = reconnect(client, jobs, handle, args.verbose)
+                if events is None:
+                    print("earbound: lost the daemon, the jobs may still be running there", file=sys.stderr)
+                    break
+    except KeyboardInterrupt:
+        interrupted = True
+        for job_id in jobs:
+            try: client.cancel(job_id)
+            except DaemonError: pass
+    results = [(job["status"], len(job.get("failed_items", []))) for job in jobs.values()]
+    return summarize(out, results, len(result["invalid"]), interrupted)
+
+def reconnect(client, jobs, handle, logs, timeout=RECONNECT_TIMEOUT):
+    # Returns a new event stream with every unfinished job caught up, or None
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        time.sleep(1)
+        try:
+            events = client.events(logs=logs)
+        except DaemonError:
+            continue
+        # Subscribed first, so nothing after these lookups is missed
+        for job_id, job in list(jobs.items()):
+            if job["status"] in DownloadJob.FINISHED:
+                continue
+            try:
+                state = client.job(job_id)
+            except DaemonError as e:
+                state = dict(job, status="failed", error=f"lost by the daemon: {e}")
+            handle(dict(state, event="job"))
+        return events
+    return None
+
+def summarize(out, results, invalid, interrupted):
+    # results: (status, failed track count) per job
+    counts = {}
+    failed_items = 0
+    for status, failed in results:
+        counts[status] = counts.get(status, 0) + 1
+        failed_items += failed
+    if invalid:
+        counts["invalid"] = invalid
+    if failed_items:
+        counts["failed_items"] = failed_items
+    total = len(results) + invalid
+    write_event(out, "summary", total=total, **counts)
+    if interrupted:
+        return 130
+    return 0 if counts.get("done", 0) == total and not failed_items else 1
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.daemon and (args.resume or args.discard_unfinished or args.lookup):
+        parser.error("--daemon can't be combined with --resume, --discard-unfinished or --lookup")
+    if args.lookup:
+        return lookup(args)
+    try:
+        links = read_links(args)
+    except OSError as e:
+        print(f"earbound: {e}", file=sys.stderr)
+        return 2
+    if not links and not args.resume and not args.discard_unfinished:
+        print("earbound: no links given", file=sys.stderr)
+        return 2
+    if args.daemon:
+        return run_via_daemon(args, links)
+
+    engine = CliEngine(verbose=args.verbose, max_workers=args.jobs, use_inprocess=args.engine == "inprocess",
+                       track_workers={"youtube": args.youtube_tracks, "spotify": args.spotify_tracks},
+                       output_profile=args.format, rate_limit=args.limit_rate,
+                       host_connections={"youtube": args.connections}, duplicates=args.duplicates,
+                       spotify_sync=not args.no_sync, prune_removed=args.prune)
+    engine.metrics_path = args.metrics
+    folder = os.path.abspath(args.output)
+    os.makedirs(folder, exist_ok=True)
+
+    queued, rejected, duplicates = dedupe_links(links)
+    invalid = len(rejected)
+    for link, reason in rejected:
+        engine.emit("result", link=link, status="invalid", error=reason)
+    if duplicates:
+        engine.emit("duplicates", count=duplicates)
+
+    found = engine.check_dependencies(install=not args.no_install)
+    engine.emit("ready", tools={name: info["version"] for name, info in found.items()})
+
+    unfinished = engine.resumable_jobs() if args.resume or args.discard_unfinished else []
+    if args.discard_unfinished:
+        engine.discard_jobs(unfinished)
+        engine.emit("discarded", count=len(unfinished))
+        unfinished = []
+    jobs = engine.resume_jobs(unfinished)
+    jobs += [engine.job_queue.submit(link.url, link.link_type, folder) for link in queued]
+    interrupted = False
+    while True:
+        try:
+            if engine.job_queue.join(0.5):
+                break
+        except KeyboardInterrupt:
+            interrupted = True
+            engine.job_queue.cancel_all()
+
+    if args.metrics:
+        engine.export_metrics()
+    return summarize(engine.out, [(job.status, len(job.failed_items)) for job in jobs], invalid, interrupted)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,2775 @@
+import os
+import sys
+import threading
+import subprocess
+import re
+from pathlib import Path
+import urllib.parse
+import json
+import urllib.request
+import urllib.error
+import http.client
+import tarfile
+import struct
+import zlib
+import platform
+import tempfile
+import shutil
+import signal
+import itertools
+import collections
+import time
+import sqlite3
+import importlib
+import hashlib
+import random
+import unicodedata
+import ctypes
+import glob
+import logging
+import logging.handlers
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+BIN_DIR = Path(__file__).parent / "bin"
+LOCAL_FFMPEG = BIN_DIR / ("ffmpeg.exe" if os.name == 'nt' else "ffmpeg")
+
+# Tool name -> version flag; spotdl and yt-dlp are also pip package names
+DEPENDENCY_PROBES = {"spotdl": "--version", "yt-dlp": "--version", "ffmpeg": "-version"}
+PIP_PACKAGES = ("spotdl", "yt-dlp")
+
+def get_cache_dir() -> Path:
+    if os.name == 'nt':
+        base = Path(os.environ.get('LOCALAPPDATA') or Path.home() / "AppData" / "Local")
+    elif sys.platform == 'darwin':
+        base = Path.home() / "Library" / "Caches"
+    else:
+        base = Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / ".cache")
+    path = base / "Earbound"
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+def read_json(path, default=None):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def write_json_atomic(path, data):
+    write_text_atomic(path, json.dumps(data, indent=2))
+
+def write_text_atomic(path, text):
+    path = Path(path)
+    fd, tmp = tempfile.mkstemp(dir=str(path.parent), prefix=path.name, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp, path)
+    except:
+        try: os.unlink(tmp)
+        except OSError: pass
+        raise
+
+class LogPipeline:
+    # Bounded hand-off between worker threads and the UI; oldest lines are
+    # dropped from the screen buffer, never from the optional log file.
+    def __init__(self, capacity=5000):
+        self._buffer = collections.deque(maxlen=capacity)
+        self._file_logger = None
+        self.dropped = 0
+
+    def put(self, message):
+        if len(self._buffer) == self._buffer.maxlen:
+            self.dropped += 1
+        self._buffer.append(message)
+        logger = self._file_logger
+        if logger is not None:
+            logger.info(message)
+
+    def drain(self, limit=500):
+        lines = []
+        while len(lines) < limit:
+            try:
+                lines.append(self._buffer.popleft())
+            except IndexError:
+                break
+        return lines
+
+    def take_dropped(self):
+        dropped, self.dropped = self.dropped, 0
+        return dropped
+
+    def enable_file(self, path, max_bytes=5 * 1024 * 1024, backups=3):
+        self.disable_file()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        logger = logging.getLogger(f"earbound.logfile.{id(self)}")
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        logger.addHandler(handler)
+        self._file_logger = logger
+
+    def disable_file(self):
+        logger, self._file_logger = self._file_logger, None
+        if logger is not None:
+            for handler in list(logger.handlers):
+                logger.removeHandler(handler)
+                handler.close()
+
+ARCHIVE_FILENAME = ".earbound_archive.sqlite3"
+LIBRARY_FILENAME = ".earbound_library.sqlite3"
+SPOTIFY_SYNC_FILENAME = ".earbound_spotify_sync.sqlite3"
+# Share of a synced list that may disappear in one sync before the result is distrusted
+SYNC_MAX_REMOVED = 0.5
+SPOTIFY_TRACK_URL = "https://open.spotify.com/track/"
+
+YOUTUBE_HOST_RE = re.compile(r'(?:(?:www|m|music)\.)?youtube(?:-nocookie)?\.com$')
+YOUTUBE_ID_RE = re.compile(r'[A-Za-z0-9_-]{11}')
+YOUTUBE_PATH_ID_RE = re.compile(r'/(?:shorts|live|embed|v)/([A-Za-z0-9_-]{11})(?:/|$)')
+YOUTUBE_LIST_RE = re.compile(r'[A-Za-z0-9_-]{2,64}')
+YOUTUBE_QUERY_RE = re.compile(r'(?:^|&)(v|list)=([^&]*)')
+# YouTube Music albums and artists, and channel pages with an optional tab; yt-dlp reads them as playlists
+YOUTUBE_BROWSE_RE = re.compile(r'/browse/([A-Za-z0-9_-]{2,64})/?$')
+YOUTUBE_CHANNEL_RE = re.compile(r'/((?:channel|c|user)/[A-Za-z0-9_.-]+|@[\w.-]+)(/(?:videos|shorts|streams|playlists|releases|featured))?/?$')
+SPOTIFY_PATH_RE = re.compile(r'(?:/intl-[a-z]{2}(?:-[a-z]{2})?)?(?:/embed)?/(track|album|playlist|artist)/([A-Za-z0-9]{22})/?$', re.IGNORECASE)
+SPOTIFY_URI_RE = re.compile(r'spotify:(track|album|playlist|artist):([A-Za-z0-9]{22})$')
+SPOTIFY_TRACK_ID_RE = re.compile(r'track[/:]([A-Za-z0-9]{22})')
+# scheme (optional), host, path, query
+URL_RE = re.compile(r'(?:[a-z][a-z0-9+.-]*://)?(?:[^@/?#]*@)?([^/?#:]*)(?::\d*)?([^?#]*)(?:\?([^#]*))?', re.IGNORECASE)
+
+class CanonicalLink(collections.namedtuple("CanonicalLink", "source kind id url")):
+    __slots__ = ()
+
+    @property
+    def link_type(self):
+        return f"{self.source}_{self.kind}"
+
+def canonicalize_link(link):
+    # (source, kind, stable id) plus a canonical URL without tracking
+    # parameters; raises ValueError for links Earbound can't download
+    link = link.strip()
+    m = SPOTIFY_URI_RE.match(link)
+    if m:
+        return _spotify_link(m.group(1), m.group(2))
+    host, path, query_string = URL_RE.match(link).groups()
+    host = host.lower()
+    if host == "open.spotify.com" or host == "play.spotify.com":
+        m = SPOTIFY_PATH_RE.match(path)
+        if not m:
+            raise ValueError("Unsupported Spotify link")
+        return _spotify_link(m.group(1), m.group(2))
+    if host == "youtu.be" or host == "www.youtu.be":
+        video_id = path.strip("/").split("/")[0]
+        if not YOUTUBE_ID_RE.fullmatch(video_id):
+            raise ValueError("Invalid YouTube link")
+        # Shared from inside a playlist, the short link carries list= like a watch URL
+        return _youtube_list_or_video(video_id, _youtube_query(query_string).get("list", ""))
+    if YOUTUBE_HOST_RE.match(host):
+        query = _youtube_query(query_string)
+        video_id = query.get("v", "")
+        if not video_id:
+            m = YOUTUBE_PATH_ID_RE.match(path)
+            video_id = m.group(1) if m else ""
+        canonical = _youtube_list_or_video(video_id, query.get("list", ""))
+        if canonical:
+            return canonical
+        m = YOUTUBE_BROWSE_RE.match(path)
+        if m:
+            browse_id = m.group(1)
+            # VL<playlist id> is YouTube Music's page of a regular playlist
+            if browse_id.startswith("VL") and YOUTUBE_LIST_RE.fullmatch(browse_id[2:]):
+                return _youtube_list(browse_id[2:], f"https://www.youtube.com/playlist?list={browse_id[2:]}")
+            return _youtube_list(f"browse/{browse_id}", f"https://music.youtube.com/browse/{browse_id}")
+        m = YOUTUBE_CHANNEL_RE.match(path)
+        if m:
+            channel = m.group(1) + (m.group(2) or "")
+            return _youtube_list(channel, f"https://www.youtube.com/{channel}")
+        raise ValueError("Unsupported YouTube link")
+    raise ValueError("Unsupported link")
+
+def _youtube_query(query_string):
+    query = {}
+    for name, value in YOUTUBE_QUERY_RE.findall(query_string or ""):
+        query.setdefault(name, value)
+    return query
+
+def _youtube_list_or_video(video_id, list_id):
+    # A video opened from a playlist is the playlist; auto-generated
+    # mixes (RD...) never end, so those stay the single video
+    if YOUTUBE_LIST_RE.fullmatch(list_id) and not (video_id and list_id.startswith("RD")):
+        return _youtube_list(list_id, f"https://www.youtube.com/playlist?list={list_id}")
+    if YOUTUBE_ID_RE.fullmatch(video_id):
+        return _youtube_video(video_id)
+    return None
+
+def _youtube_list(list_id, url):
+    return CanonicalLink("youtube", "playlist", list_id, url)
+
+def _spotify_link(kind, item_id):
+    kind = kind.lower()
+    return CanonicalLink("spotify", kind, item_id, f"https://open.spotify.com/{kind}/{item_id}")
+
+def _youtube_video(video_id):
+    return CanonicalLink("youtube", "video", video_id, f"https://www.youtube.com/watch?v={video_id}")
+
+def dedupe_links(links):
+    # Returns (unique canonical links in input order, [(link, reason)] for
+    # invalid ones, number of duplicates dropped)
+    unique = collections.OrderedDict()
+    invalid = []
+    parsed = {}
+    duplicates = 0
+    for link in links:
+        if link not in parsed:
+            try:
+                parsed[link] = canonicalize_link(link)
+            except ValueError as e:
+                parsed[link] = None
+                invalid.append((link, str(e)))
+                continue
+        canonical = parsed[link]
+        if canonical is None:
+            continue
+        key = (canonical.source, canonical.kind, canonical.id)
+        if key in unique:
+            duplicates += 1
+        else:
+            unique[key] = canonical
+    return list(unique.values()), invalid, duplicates
+
+def youtube_video_id(link):
+    try:
+        canonical = canonicalize_link(link)
+    except ValueError:
+        return None
+    return canonical.id if canonical.link_type == "youtube_video" else None
+
+def spotify_track_id(link):
+    m = SPOTIFY_TRACK_ID_RE.search(link)
+    return m.group(1) if m else None
+
+class DownloadArchive:
+    # Per download folder index of finished items, keyed by (source, id).
+    # yt-dlp and spotdl each get a plain-text archive exported from it per
+    # run, and lines they append are folded back in as items complete.
+    def __init__(self, folder):
+        self.path = Path(folder) / ARCHIVE_FILENAME
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS items ("
+                "source TEXT NOT NULL, item_id TEXT NOT NULL, added_at REAL NOT NULL, "
+                "PRIMARY KEY (source, item_id))"
+            )
+
+    def contains(self, source, item_id):
+        with self._lock:
+            row = self._conn.execute("SELECT 1 FROM items WHERE source = ? AND item_id = ?", (source, item_id)).fetchone()
+        return row is not None
+
+    def add(self, source, item_id):
+        with self._lock, self._conn:
+            cur = self._conn.execute("INSERT OR IGNORE INTO items (source, item_id, added_at) VALUES (?, ?, ?)", (source, item_id, time.time()))
+        return cur.rowcount > 0
+
+    def remove(self, source, item_id):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM items WHERE source = ? AND item_id = ?", (source, item_id))
+
+    def ids(self, source=None):
+        with self._lock:
+            if source is None:
+                rows = self._conn.execute("SELECT source, item_id FROM items").fetchall()
+            else:
+                rows = self._conn.execute("SELECT source, item_id FROM items WHERE source = ?", (source,)).fetchall()
+        return rows
+
+    def export_file(self, tool, record=True):
+        fd, path = tempfile.mkstemp(prefix=f"earbound-{tool}-", suffix=".txt")
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            for source, item_id in self.ids():
+                if tool == "spotdl" and source == "spotify":
+                    f.write(f"{SPOTIFY_TRACK_URL}{item_id}\n")
+                elif tool == "yt-dlp" and source != "spotify":
+                    f.write(f"{source} {item_id}\n")
+        return ArchiveFile(self, tool, path, record)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class ArchiveFile:
+    # With record=False the file only tells the backend what to skip and
+    # the caller adds finished items to the archive itself
+    def __init__(self, archive, tool, path, record=True):
+        self.archive = archive
+        self.tool = tool
+        self.path = path
+        self.record = record
+        self._offset = os.path.getsize(path)
+        self._lock = threading.Lock()
+
+    def sync(self):
+        # Picks up lines appended by the backend since the last call
+        if not self.record:
+            return 0
+        with self._lock:
+            return self._sync()
+
+    def _sync(self):
+        try:
+            if os.path.getsize(self.path) <= self._offset:
+                return 0
+            with open(self.path, 'r', encoding='utf-8') as f:
+                f.seek(self._offset)
+                data = f.read()
+        except OSError:
+            return 0
+        complete = data[:data.rfind("\n") + 1]
+        self._offset += len(complete.encode('utf-8'))
+        added = 0
+        for line in complete.splitlines():
+            item = self._parse(line.strip())
+            if item and self.archive.add(*item):
+                added += 1
+        return added
+
+    def _parse(self, line):
+        if not line:
+            return None
+        if self.tool == "spotdl":
+            track_id = spotify_track_id(line)
+            return ("spotify", track_id) if track_id else None
+        parts = line.split()
+        return (parts[0].lower(), parts[1]) if len(parts) == 2 else None
+
+    def close(self):
+        self.sync()
+        try: os.unlink(self.path)
+        except OSError: pass
+
+AUDIO_EXTENSIONS = {".mp3", ".m4a", ".opus", ".ogg", ".oga", ".flac", ".wav", ".aac", ".webm"}
+# What to do with a track the library already has somewhere
+DUPLICATE_MODES = collections.OrderedDict([("keep", "Download again"), ("skip", "Skip"), ("link", "Hard link")])
+DURATION_TOLERANCE = 3
+# "(Official Video)", "[Lyrics]", "feat. X", "- Remastered 2011" and "| Topic" style decorations
+TITLE_NOISE_RE = re.compile(r'[\(\[][^\)\]]*[\)\]]|\s(?:feat|ft|featuring)\.?\s[^\(\[]*?(?=\s-\s|[\(\[]|$)|'
+                            r'\s-\s[^-]*\bremaster(?:ed)?\b.*$|\s[|/]\s.*$', re.IGNORECASE)
+# ...unless they name a different recording of the song
+TITLE_VERSION_RE = re.compile(r'\b(?:live|remix(?:ed)?|mix|acoustic|instrumental|edit|demo|unplugged|karaoke|extended|'
+                              r'cover|reprise|a\s?cappella|acapella|slowed|sped\s?up|nightcore)\b', re.IGNORECASE)
+ARTIST_SPLIT_RE = re.compile(r',|;|\s&\s|\s(?:feat|ft|featuring|x)\.?\s', re.IGNORECASE)
+NON_WORD_RE = re.compile(r'[\W_]+')
+
+_mutagen_module = None
+
+def load_mutagen():
+    # Optional, it comes with spotdl. Without it tracks are matched by file name
+    global _mutagen_module
+    if _mutagen_module is None:
+        try:
+            import mutagen
+            _mutagen_module = mutagen
+        except ImportError:
+            return None
+    return _mutagen_module
+
+def normalize_tag(text):
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = TITLE_NOISE_RE.sub(lambda m: m.group() if TITLE_VERSION_RE.search(m.group()) else " ", text.casefold())
+    return NON_WORD_RE.sub(" ", text).strip()
+
+def track_key(artist, title):
+    # Primary artist and title, so differently decorated copies of a song match
+    artist = normalize_tag(ARTIST_SPLIT_RE.split(artist or "")[0])
+    title = normalize_tag(title)
+    return f"{artist}|{title}" if artist and title else None
+
+def split_track_name(name, artist=None):
+    # "Artist - Title" is how spotdl names files and how most uploads are titled
+    head, sep, tail = name.partition(" - ")
+    if sep and head.strip() and tail.strip():
+        return head, tail
+    return artist, name
+
+def channel_artist(channel):
+    # Auto-generated YouTube Music channels are called "Artist - Topic"
+    if channel and channel.endswith(" - Topic"):
+        return channel[:-len(" - Topic")]
+    return channel
+
+def spotdl_display_name(song):
+    # How spotdl reports a song in its log
+    artists = song.get("artists") or [song.get("artist") or ""]
+    return f"{song.get('artist') or artists[0]} - {song.get('name') or ''}"
+
+def spotdl_file_stem(song):
+    # spotdl's default "{artists} - {title}" file name, with the characters it replaces
+    artists = song.get("artists") or [song.get("artist") or ""]
+    name = f"{', '.join(artists)} - {song.get('name') or ''}"
+    return "".join(c for c in name if c not in '/?\\*|<>').replace('"', "'").replace(":", "-")
+
+def read_track_tags(path, mutagen=None):
+    artist = title = duration = None
+    if mutagen is not None:
+        try:
+            audio = mutagen.File(path, easy=True)
+            if audio is not None:
+                tags = audio.tags or {}
+                artist = (tags.get("artist") or [None])[0]
+                title = (tags.get("title") or [None])[0]
+                duration = getattr(audio.info, "length", None)
+        except:
+            pass
+    if not title:
+        artist, title = split_track_name(os.path.splitext(os.path.basename(path))[0], artist)
+    return artist, title, duration
+
+class LibraryIndex:
+    # Audio files under a download folder keyed by normalized artist and
+    # title. Lookups are served from memory; a refresh walks the tree in
+    # parallel and only reads tags of files whose mtime or size changed.
+    def __init__(self, folder):
+        self.folder = os.path.abspath(folder)
+        self.scanned = False
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._files = {}  # relative path -> (mtime_ns, size, key, duration)
+        self._keys = {}  # key -> set of relative paths
+        self._conn = sqlite3.connect(os.path.join(self.folder, LIBRARY_FILENAME), timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "path TEXT PRIMARY KEY, mtime INTEGER NOT NULL, size INTEGER NOT NULL, "
+                "artist TEXT, title TEXT, duration REAL, track_key TEXT)"
+            )
+            # Keys are rebuilt from the tags so an index written by an older version matches the same way
+            for path, mtime, size, artist, title, duration in self._conn.execute("SELECT path, mtime, size, artist, title, duration FROM files"):
+                self._remember(path, mtime, size, track_key(artist, title), duration)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._files)
+
+    def refresh(self, workers=None):
+        # Returns the files that are new or changed since the last refresh
+        with self._refresh_lock:
+            with ThreadPoolExecutor(max_workers=workers or min(32, (os.cpu_count() or 2) * 4), thread_name_prefix="library") as pool:
+                found = self._walk(pool)
+                with self._lock:
+                    known = {path: info[:2] for path, info in self._files.items()}
+                changed = [path for path, stat in found.items() if known.get(path) != stat]
+                removed = [path for path in known if path not in found]
+                mutagen = load_mutagen()
+                tags = list(pool.map(lambda path: read_track_tags(os.path.join(self.folder, path), mutagen), changed))
+            self._store([(path,) + found[path] + info for path, info in zip(changed, tags)], removed)
+            self.scanned = True
+        return [os.path.join(self.folder, path) for path in changed]
+
+    def add_file(self, path):
+        # Indexes a file written by a download; returns other copies of the same track
+        path = os.path.abspath(path)
+        rel = os.path.relpath(path, self.folder)
+        if rel.startswith(os.pardir):
+            return []
+        try:
+            st = os.stat(path)
+        except OSError:
+            return []
+        artist, title, duration = read_track_tags(path, load_mutagen())
+        self._store([(rel, st.st_mtime_ns, st.st_size, artist, title, duration)], [])
+        return self.find(artist, title, duration, exclude=path, strict=True)
+
+    def find(self, artist, title, duration=None, exclude=None, strict=False):
+        # Strict lookups, which skip or link tracks, also need both durations to agree
+        key = track_key(artist, title)
+        if key is None or (strict and duration is None):
+            return []
+        with self._lock:
+            paths = [path for path in self._keys.get(key, ()) if self._same_duration(self._files[path][3], duration, strict)]
+        found = [os.path.join(self.folder, path) for path in sorted(paths)]
+        return [path for path in found if path != exclude]
+
+    def find_name(self, name, duration=None, strict=False):
+        artist, title = split_track_name(name)
+        return self.find(artist, title, duration, strict=strict)
+
+    @staticmethod
+    def _same_duration(known, duration, strict):
+        if known is None or duration is None:
+            return not strict
+        return abs(known - duration) <= DURATION_TOLERANCE
+
+    def duplicate_count(self):
+        with self._lock:
+            return sum(len(paths) - 1 for paths in self._keys.values())
+
+    def _walk(self, pool):
+        files = {}
+        pending = {pool.submit(self._scan_dir, self.folder)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                dirs, found = future.result()
+                files.update(found)
+                pending.update(pool.submit(self._scan_dir, path) for path in dirs)
+        return files
+
+    def _scan_dir(self, path):
+        dirs, files = [], {}
+        prefix = len(self.folder) + 1
+        try:
+            it = os.scandir(path)
+        except OSError:
+            return dirs, files
+        with it:
+            for entry in it:
+                if entry.name.startswith("."):
+                    continue
+                # One file vanishing mid-scan mustn't drop the rest of the folder from the index
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                    elif os.path.splitext(entry.name)[1].lower() in AUDIO_EXTENSIONS and ".converting." not in entry.name:
+                        st = entry.stat()
+                        files[entry.path[prefix:]] = (st.st_mtime_ns, st.st_size)
+                except OSError:
+                    pass
+        return dirs, files
+
+    def _store(self, rows, removed):
+        rows = [row + (track_key(row[3], row[4]),) for row in rows]
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in removed])
+            self._conn.executemany("INSERT OR REPLACE INTO files (path, mtime, size, artist, title, duration, track_key) "
+                                   "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            for path in removed:
+                self._forget(path)
+            for path, mtime, size, artist, title, duration, key in rows:
+                self._forget(path)
+                self._remember(path, mtime, size, key, duration)
+
+    def _remember(self, path, mtime, size, key, duration):
+        self._files[path] = (mtime, size, key, duration)
+        if key:
+            self._keys.setdefault(key, set()).add(path)
+
+    def _forget(self, path):
+        info = self._files.pop(path, None)
+        if info and info[2]:
+            paths = self._keys.get(info[2])
+            if paths is not None:
+                paths.discard(path)
+                if not paths:
+                    del self._keys[info[2]]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class SpotifySync:
+    # Synced Spotify playlists, albums and artists of one folder: the tracks
+    # each list had at its last sync, and per track the file it was saved as
+    # and the YouTube source spotdl matched it to. A resync only has spotdl
+    # resolve and download tracks that have no file yet.
+    def __init__(self, folder):
+        self.folder = os.path.abspath(folder)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(self.folder, SPOTIFY_SYNC_FILENAME), timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS lists (list_id TEXT PRIMARY KEY, link TEXT NOT NULL, synced_at REAL NOT NULL)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS tracks ("
+                "list_id TEXT NOT NULL, song_id TEXT NOT NULL, position INTEGER NOT NULL, removed INTEGER NOT NULL DEFAULT 0, "
+                "PRIMARY KEY (list_id, song_id))"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS songs ("
+                "song_id TEXT PRIMARY KEY, name TEXT, artists TEXT, duration REAL, file TEXT, source TEXT)"
+            )
+
+    def tracks(self, list_id):
+        # Track ids of the list at its last sync, None if it was never synced
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM lists WHERE list_id = ?", (list_id,)).fetchone() is None:
+                return None
+            rows = self._conn.execute("SELECT song_id FROM tracks WHERE list_id = ? AND removed = 0", (list_id,)).fetchall()
+        return {row[0] for row in rows}
+
+    def matches(self, song_ids):
+        # song id -> (file, source)
+        with self._lock:
+            rows = [self._conn.execute("SELECT song_id, file, source FROM songs WHERE song_id = ?", (song_id,)).fetchone()
+                    for song_id in song_ids]
+        return {row[0]: row[1:] for row in rows if row}
+
+    def audio_files(self):
+        # file name -> (mtime_ns, size) of the audio files in the folder
+        files = {}
+        try:
+            with os.scandir(self.folder) as it:
+                for entry in it:
+                    if os.path.splitext(entry.name)[1].lower() in AUDIO_EXTENSIONS and entry.is_file():
+                        st = entry.stat()
+                        files[entry.name] = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            pass
+        return files
+
+    def save_matches(self, songs):
+        # songs: (song dict, file, source); known values are kept when a new one is missing
+        rows = [(song["song_id"], song.get("name"), ", ".join(song.get("artists") or ()), song.get("duration"), file, source)
+                for song, file, source in songs]
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR IGNORE INTO songs (song_id) VALUES (?)", [row[:1] for row in rows])
+            self._conn.executemany("UPDATE songs SET name = ?, artists = ?, duration = ?, file = COALESCE(?, file), "
+                                   "source = COALESCE(?, source) WHERE song_id = ?", [row[1:] + row[:1] for row in rows])
+
+    def save_list(self, list_id, link, song_ids):
+        # Tracks that left the list stay behind marked removed until pruned
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO lists (list_id, link, synced_at) VALUES (?, ?, ?)", (list_id, link, time.time()))
+            self._conn.execute("UPDATE tracks SET removed = 1 WHERE list_id = ?", (list_id,))
+            self._conn.executemany("INSERT OR REPLACE INTO tracks (list_id, song_id, position, removed) VALUES (?, ?, ?, 0)",
+                                   [(list_id, song_id, position) for position, song_id in enumerate(song_ids)])
+
+    def removed(self, list_id):
+        # (song id, file, name, artists) of tracks no longer in the list
+        with self._lock:
+            return self._conn.execute(
+                "SELECT t.song_id, s.file, s.name, s.artists FROM tracks t LEFT JOIN songs s ON s.song_id = t.song_id "
+                "WHERE t.list_id = ? AND t.removed = 1", (list_id,)).fetchall()
+
+    def in_use(self, song_id, file):
+        # Whether a synced list still has the track, or another track saved as the same file
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM tracks t LEFT JOIN songs s ON s.song_id = t.song_id "
+                "WHERE t.removed = 0 AND (t.song_id = ? OR s.file = ?)", (song_id, file)).fetchone()
+        return row is not None
+
+    def forget(self, list_id, song_id):
+        # The match stays, so a track that comes back skips the search
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM tracks WHERE list_id = ? AND song_id = ?", (list_id, song_id))
+            self._conn.execute("UPDATE songs SET file = NULL WHERE song_id = ? AND NOT EXISTS "
+                               "(SELECT 1 FROM tracks WHERE song_id = ?)", (song_id, song_id))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class JobJournal:
+    # Jobs and per-track state, so work interrupted by a cancel or crash
+    # can be resumed (or its temp files removed) on the next launch
+    ACTIVE = ("queued", "running")
+    # A cancel keeps the partial files, so cancelled jobs resume like
+    # interrupted ones; "discarded" jobs had their leftovers removed
+    RESUMABLE = ACTIVE + ("cancelled",)
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), timeout=30, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, link TEXT NOT NULL, link_type TEXT NOT NULL, "
+                "folder TEXT NOT NULL, path TEXT, status TEXT NOT NULL, pid INTEGER, "
+                "created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS items ("
+                "job_id INTEGER NOT NULL, item_key TEXT NOT NULL, status TEXT NOT NULL, path TEXT, "
+                "updated_at REAL NOT NULL, PRIMARY KEY (job_id, item_key))"
+            )
+
+    def add_job(self, link, link_type, folder, status):
+        now = time.time()
+        with self._lock, self._conn:
+            cur = self._conn.execute(
+                "INSERT INTO jobs (link, link_type, folder, status, pid, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (link, link_type, folder, status, os.getpid(), now, now))
+        return cur.lastrowid
+
+    def update_job(self, job_id, status=None, path=None):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET status = COALESCE(?, status), path = COALESCE(?, path), pid = ?, updated_at = ? WHERE id = ?",
+                (status, path, os.getpid(), time.time(), job_id))
+
+    def update_item(self, job_id, key, status, path=None):
+        with self._lock, self._conn:
+            now = time.time()
+            self._conn.execute(
+                "INSERT OR IGNORE INTO items (job_id, item_key, status, path, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, key, status, path, now))
+            self._conn.execute(
+                "UPDATE items SET status = ?, path = COALESCE(?, path), updated_at = ? WHERE job_id = ? AND item_key = ?",
+                (status, path, now, job_id, key))
+
+    def add_items(self, job_id, keys, status):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO items (job_id, item_key, status, updated_at) VALUES (?, ?, ?, ?)",
+                [(job_id, key, status, now) for key in keys])
+
+    def unfinished(self):
+        # Interrupted or cancelled jobs whose owning process is gone, unless
+        # the same link was downloaded into the folder since
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM jobs j WHERE status IN (?, ?, ?) AND NOT EXISTS ("
+                "SELECT 1 FROM jobs later WHERE later.link = j.link AND later.folder = j.folder "
+                "AND later.id > j.id AND later.status = 'done') ORDER BY id", self.RESUMABLE).fetchall()
+        return [dict(row) for row in rows if not process_alive(row["pid"])]
+
+    def item_states(self, job_id):
+        with self._lock:
+            rows = self._conn.execute("SELECT item_key, status FROM items WHERE job_id = ?", (job_id,)).fetchall()
+        return {row["item_key"]: row["status"] for row in rows}
+
+    def temp_paths(self, job_id):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT path FROM items WHERE job_id = ? AND status != 'done' AND path IS NOT NULL", (job_id,)).fetchall()
+        return [row["path"] for row in rows]
+
+    def prune(self, max_age=30 * 24 * 3600):
+        # Returns the partial files the pruned jobs left behind
+        cutoff = time.time() - max_age
+        with self._lock, self._conn:
+            rows = self._conn.execute(
+                "SELECT path FROM items WHERE status != 'done' AND path IS NOT NULL AND job_id IN "
+                "(SELECT id FROM jobs WHERE status NOT IN (?, ?) AND updated_at < ?)", self.ACTIVE + (cutoff,)).fetchall()
+            self._conn.execute("DELETE FROM items WHERE job_id IN (SELECT id FROM jobs WHERE status NOT IN (?, ?) AND updated_at < ?)", self.ACTIVE + (cutoff,))
+            self._conn.execute("DELETE FROM jobs WHERE status NOT IN (?, ?) AND updated_at < ?", self.ACTIVE + (cutoff,))
+        return [row["path"] for row in rows]
+
+WIN_PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+WIN_ERROR_ACCESS_DENIED = 5
+WIN_STILL_ACTIVE = 259
+
+def process_alive(pid):
+    if not pid:
+        return False
+    if pid == os.getpid():
+        return True
+    if os.name == 'nt':
+        return _windows_process_alive(pid)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+def _windows_process_alive(pid):
+    # os.kill can't probe a process on Windows, it would terminate it
+    kernel32 = ctypes.windll.kernel32
+    handle = kernel32.OpenProcess(WIN_PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+    if not handle:
+        # Access denied still means the process exists
+        return kernel32.GetLastError() == WIN_ERROR_ACCESS_DENIED
+    try:
+        code = ctypes.c_ulong()
+        if not kernel32.GetExitCodeProcess(handle, ctypes.byref(code)):
+            return True
+        return code.value == WIN_STILL_ACTIVE
+    finally:
+        kernel32.CloseHandle(handle)
+
+def remove_temp_file(path):
+    # A partial download may also have a fragment sidecar next to it
+    for candidate in (path, path + ".ytdl"):
+        try:
+            os.unlink(candidate)
+        except OSError:
+            pass
+
+def remove_stale_temp_files(max_age=24 * 3600):
+    cutoff = time.time() - max_age
+    for path in glob.glob(os.path.join(tempfile.gettempdir(), "earbound-*")):
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.unlink(path)
+        except OSError:
+            pass
+
+_yt_dlp_module = None
+
+def load_yt_dlp():
+    # Imported lazily: extractor import is slow and yt-dlp may only be
+    # pip-installed after start-up
+    global _yt_dlp_module
+    if _yt_dlp_module is None:
+        importlib.invalidate_caches()
+        try:
+            import yt_dlp
+            _yt_dlp_module = yt_dlp
+        except ImportError:
+            return None
+    return _yt_dlp_module
+
+def format_bytes(count):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if count < 1024 or unit == "GiB":
+            return f"{count:.0f}{unit}" if unit == "B" else f"{count:.1f}{unit}"
+        count /= 1024
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+class YtdlpLogger:
+    def __init__(self, log):
+        self.log = log
+
+    def debug(self, message):
+        if not message.startswith("[debug] "):
+            self.log(message)
+
+    def info(self, message):
+        self.log(message)
+
+    def warning(self, message):
+        self.log(f"WARNING: {message}")
+
+    def error(self, message):
+        self.log(message)
+
+class PlaylistCache:
+    # Flat playlist extractions (title + entries), in memory and on disk
+    def __init__(self, folder, ttl=3600):
+        self.folder = Path(folder)
+        self.ttl = ttl
+        self._memory = {}
+        self._lock = threading.Lock()
+
+    def _path(self, link):
+        return self.folder / (hashlib.sha1(link.strip().encode('utf-8')).hexdigest() + ".json")
+
+    def get(self, link):
+        with self._lock:
+            info = self._memory.get(link)
+        if info is None:
+            info = read_json(self._path(link))
+        if not info or time.time() - info.get("fetched_at", 0) > self.ttl:
+            return None
+        with self._lock:
+            self._memory[link] = info
+        return info
+
+    def put(self, link, info):
+        info = dict(info, fetched_at=time.time())
+        with self._lock:
+            self._memory[link] = info
+        try:
+            self.folder.mkdir(parents=True, exist_ok=True)
+            write_json_atomic(self._path(link), info)
+        except OSError:
+            pass
+        return info
+
+# yt-dlp progress as one parseable line per update: id, bytes, total, estimate, speed, eta, temp file
+YTDLP_PROGRESS_PREFIX = "EARBOUND|"
+YTDLP_PROGRESS_TEMPLATE = "download:" + YTDLP_PROGRESS_PREFIX + "|".join(
+    "%(" + field + ")s" for field in ("info.id", "progress.downloaded_bytes", "progress.total_bytes",
+                                      "progress.total_bytes_estimate", "progress.speed", "progress.eta",
+                                      "progress.tmpfilename"))
+# Printed by yt-dlp once a file is complete on disk
+YTDLP_FILE_PREFIX = "EARBOUND_FILE|"
+YTDLP_FILE_TEMPLATE = "after_move:" + YTDLP_FILE_PREFIX + "%(extractor_key)s|%(id)s|%(acodec)s|%(filepath)s"
+# yt-dlp retrying a request or a fragment
+YTDLP_RETRY_RE = re.compile(r'Retrying (?:fragment \d+ )?\(\d+/')
+SPOTDL_FOUND_RE = re.compile(r'Found (\d+) songs?')
+# "Downloaded" lines end with the source the track was matched to
+SPOTDL_TRACK_RE = re.compile(r'^(?:Downloaded "(?P<downloaded>.+?)"(?::\s*(?P<source>https?://\S+))?|Skipping (?P<skipped>.+?) \()')
+# yt-dlp prefixes most lines about an item with "[extractor] id: "
+YTDLP_ITEM_RE = re.compile(r'^(?:ERROR: )?\[(?!download\])[\w:]+\] (?!Destination:)([\w-]+): ')
+SPOTDL_ERROR_RE = re.compile(r'^(\w+Error): (?:.*?for song: (?P<song>.+)|.*)$')
+# Failures that come back the same on every attempt
+PERMANENT_ERROR_RE = re.compile(
+    r'video unavailable|private video|has been removed|no longer available|not available in your country|'
+    r'members[- ]only|copyright|confirm your age|age[- ]restricted|unsupported url|requested format is not available|'
+    r'http error 404|http error 410|no results found|does not exist', re.IGNORECASE)
+# No output for this long means the backend hangs; yt-dlp prints progress
+# several times a second, spotdl only once a track is done
+STALL_TIMEOUTS = {"yt-dlp": 90, "spotdl": 600}
+RETRY_ATTEMPTS = 4
+RETRY_BASE_DELAY = 2.0
+RETRY_MAX_DELAY = 60.0
+
+# Conversion targets. Streams already in the target codec are remuxed
+# (or kept as they are) instead of being re-encoded.
+OUTPUT_PROFILES = collections.OrderedDict([
+    ("mp3", {"label": "MP3 (VBR ~130 kbps)", "ext": "mp3", "format": "bestaudio", "codecs": ("mp3",),
+             "encoder": ["-c:a", "libmp3lame", "-q:a", "5"], "spotdl": ["--format", "mp3"]}),
+    ("mp3-320", {"label": "MP3 320 kbps", "ext": "mp3", "format": "bestaudio", "codecs": ("mp3",),
+                 "encoder": ["-c:a", "libmp3lame", "-b:a", "320k"], "spotdl": ["--format", "mp3", "--bitrate", "320k"]}),
+    ("mp3-192", {"label": "MP3 192 kbps", "ext": "mp3", "format": "bestaudio", "codecs": ("mp3",),
+                 "encoder": ["-c:a", "libmp3lame", "-b:a", "192k"], "spotdl": ["--format", "mp3", "--bitrate", "192k"]}),
+    ("opus", {"label": "Opus (no re-encode)", "ext": "opus", "format": "bestaudio[acodec=opus]/bestaudio", "codecs": ("opus",),
+              "encoder": ["-c:a", "libopus", "-b:a", "160k"], "spotdl": ["--format", "opus", "--bitrate", "disable"]}),
+    ("m4a", {"label": "M4A (no re-encode)", "ext": "m4a", "format": "bestaudio[ext=m4a]/bestaudio", "codecs": ("mp4a", "aac"),
+             "encoder": ["-c:a", "aac", "-b:a", "192k"], "spotdl": ["--format", "m4a", "--bitrate", "disable"]}),
+    ("original", {"label": "Original stream", "ext": None, "format": "bestaudio", "codecs": (),
+                  "encoder": None, "spotdl": ["--format", "opus", "--bitrate", "disable"]}),
+])
+
+def transcode_command(ffmpeg, source, acodec, profile):
+    # Returns (cmd, temp_path, target); cmd is None when the file is kept as it is
+    if profile["ext"] is None:
+        return None, None, source
+    stem = os.path.splitext(source)[0]
+    target = f"{stem}.{profile['ext']}"
+    same_codec = any((acodec or "").lower().startswith(codec) for codec in profile["codecs"])
+    if same_codec and target == source:
+        return None, None, source
+    temp_path = f"{stem}.converting.{profile['ext']}"
+    cmd = [ffmpeg, "-y", "-nostdin", "-loglevel", "error", "-i", source, "-vn", "-map_metadata", "0"]
+    cmd += ["-c:a", "copy"] if same_codec else profile["encoder"]
+    cmd.append(temp_path)
+    return cmd, temp_path, target
+
+def parse_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def find_tool(name):
+    path = shutil.which(name)
+    if path is None and name == "ffmpeg" and LOCAL_FFMPEG.exists():
+        path = str(LOCAL_FFMPEG)
+    return path
+
+def probe_tool(name, cache):
+    # Reuses the cached version while the binary on disk is unchanged
+    path = find_tool(name)
+    if path is None:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    fingerprint = [st.st_mtime, st.st_size]
+    entry = cache.get(name)
+    if entry and entry.get("path") == path and entry.get("fingerprint") == fingerprint:
+        return dict(entry, cached=True)
+    try:
+        result = subprocess.run([path, DEPENDENCY_PROBES[name]], capture_output=True, check=True, timeout=15, text=True)
+    except:
+        return None
+    lines = result.stdout.strip().splitlines()
+    entry = {"path": path, "version": lines[0] if lines else "", "fingerprint": fingerprint}
+    cache[name] = entry
+    return dict(entry, cached=False)
+
+# Static FFmpeg builds per (system, machine) with the checksum file each host publishes
+FFMPEG_BUILDS = {
+    ("windows", "x86_64"): ("https://www.gyan.dev/ffmpeg/builds/ffmpeg-release-essentials.zip",
+                            "https://www.gyan.dev/ffmpeg/builds/ffmpeg-release-essentials.zip.sha256"),
+    ("linux", "x86_64"): ("https://johnvansickle.com/ffmpeg/releases/ffmpeg-release-amd64-static.tar.xz",
+                          "https://johnvansickle.com/ffmpeg/releases/ffmpeg-release-amd64-static.tar.xz.md5"),
+    ("linux", "arm64"): ("https://johnvansickle.com/ffmpeg/releases/ffmpeg-release-arm64-static.tar.xz",
+                         "https://johnvansickle.com/ffmpeg/releases/ffmpeg-release-arm64-static.tar.xz.md5"),
+    ("darwin", "x86_64"): ("https://ffmpeg.martin-riedl.de/redirect/latest/macos/amd64/release/ffmpeg.zip",
+                           "https://ffmpeg.martin-riedl.de/redirect/latest/macos/amd64/release/ffmpeg.zip.sha256"),
+    ("darwin", "arm64"): ("https://ffmpeg.martin-riedl.de/redirect/latest/macos/arm64/release/ffmpeg.zip",
+                          "https://ffmpeg.martin-riedl.de/redirect/latest/macos/arm64/release/ffmpeg.zip.sha256"),
+}
+FFMPEG_MEMBER_NAMES = ("ffmpeg", "ffmpeg.exe")
+CHECKSUM_ALGORITHMS = {32: "md5", 40: "sha1", 64: "sha256", 128: "sha512"}
+HTTP_HEADERS = {"User-Agent": "Earbound"}
+
+def ffmpeg_build():
+    # EARBOUND_FFMPEG_URL points the bootstrap at another server, e.g. a local mirror
+    url = os.environ.get("EARBOUND_FFMPEG_URL")
+    if url:
+        return url, os.environ.get("EARBOUND_FFMPEG_CHECKSUM_URL") or url + ".sha256"
+    machine = platform.machine().lower()
+    machine = {"amd64": "x86_64", "x64": "x86_64", "aarch64": "arm64"}.get(machine, machine)
+    return FFMPEG_BUILDS.get((platform.system().lower(), machine))
+
+def fetch_checksum(url, timeout=30):
+    # Checksum files are "<hex>" or "<hex>  <filename>"
+    with urllib.request.urlopen(urllib.request.Request(url, headers=HTTP_HEADERS), timeout=timeout) as response:
+        text = response.read(4096).decode('ascii', 'replace')
+    digest = (text.split() or [""])[0].lower()
+    if not re.fullmatch(r'[0-9a-f]+', digest) or len(digest) not in CHECKSUM_ALGORITHMS:
+        raise ValueError(f"unrecognised checksum file at {url}")
+    return CHECKSUM_ALGORITHMS[len(digest)], digest
+
+class DownloadStream:
+    # Read-only file view of an HTTP download. Everything read is hashed
+    # and mirrored to a .part file; bytes already in the .part file from an
+    # interrupted attempt are replayed first and only the rest is fetched,
+    # with a Range request.
+    def __init__(self, url, part_path, hasher, on_progress=None, timeout=30):
+        self.url = url
+        self.part_path = Path(part_path)
+        self.meta_path = self.part_path.with_name(self.part_path.name + ".json")
+        self.hasher = hasher
+        self.on_progress = on_progress
+        self.timeout = timeout
+        self.position = 0
+        self.total = None
+        self.resumed_from = 0
+        self.restarted = False
+        self._pending = b""
+        self._replay = None
+        self._replay_left = 0
+        self._response = None
+        self._part = None
+
+    def open(self):
+        meta = read_json(self.meta_path, {})
+        offset = 0
+        if meta.get("url") == self.url and self.part_path.exists():
+            offset = self.part_path.stat().st_size
+        self._response = self._request(offset, meta)
+        if offset and not self._continues(offset):
+            # The .part file is complete, longer than the file upstream or
+            # doesn't line up with it, so it is of no use to any later attempt
+            self.close()
+            self.discard()
+            self.restarted = True
+            offset = 0
+            self._response = self._request(0, meta)
+        if offset and self._response.status == 206:
+            self.total = self._content_range()[2]
+            self._replay = open(self.part_path, 'rb')
+            self._replay_left = offset
+            self._part = open(self.part_path, 'ab')
+            self.resumed_from = offset
+        else:
+            length = self._response.headers.get("Content-Length")
+            self.total = int(length) if length and length.isdigit() else None
+            self.part_path.parent.mkdir(parents=True, exist_ok=True)
+            self._part = open(self.part_path, 'wb')
+            write_json_atomic(self.meta_path, {"url": self.url, "etag": self._response.headers.get("ETag"),
+                                               "last_modified": self._response.headers.get("Last-Modified")})
+        return self
+
+    def _request(self, offset, meta):
+        headers = dict(HTTP_HEADERS)
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+            # Only resume if the file upstream is still the one we started on
+            etag = meta.get("etag") or ""
+            validator = etag if etag and not etag.startswith("W/") else meta.get("last_modified")
+            if validator:
+                headers["If-Range"] = validator
+        try:
+            return urllib.request.urlopen(urllib.request.Request(self.url, headers=headers), timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            if offset and e.code == 416:
+                e.close()
+                return None
+            raise
+
+    def _content_range(self):
+        # (first, last, total) of a 206; total is None when the server doesn't know it
+        m = re.match(r'bytes (\d+)-(\d+)/(\d+|\*)', self._response.headers.get("Content-Range", ""))
+        if not m:
+            return None
+        return int(m.group(1)), int(m.group(2)), int(m.group(3)) if m.group(3) != "*" else None
+
+    def _continues(self, offset):
+        # A full 200 response just starts over; a 416 or a range that doesn't
+        # pick up right after the .part file can't be used
+        if self._response is None:
+            return False
+        if self._response.status != 206:
+            return True
+        content_range = self._content_range()
+        if content_range is None:
+            return False
+        first, last, total = content_range
+        return first == offset and last >= first and (total is None or total > offset)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = 64 * 1024
+        if self._pending:
+            data, self._pending = self._pending[:size], self._pending[size:]
+            # Callers sniffing the format expect a full block, not just the handed-back bytes
+            return data + self.read(size - len(data)) if len(data) < size else data
+        data = b""
+        if self._replay is not None:
+            data = self._replay.read(min(size, self._replay_left))
+            self._replay_left -= len(data)
+            if not data or self._replay_left <= 0:
+                self._replay.close()
+                self._replay = None
+        if not data and self._response is not None:
+            data = self._response.read(size)
+            self._part.write(data)
+        if data:
+            self.hasher.update(data)
+            self.position += len(data)
+            if self.on_progress:
+                self.on_progress(self.position, self.total)
+        return data
+
+    def read_exact(self, size):
+        chunks = []
+        while size > 0:
+            data = self.read(size)
+            if not data:
+                raise EOFError("download ended early")
+            chunks.append(data)
+            size -= len(data)
+        return b"".join(chunks)
+
+    def unread(self, data):
+        # Hands bytes back to the next read, e.g. past the end of a deflate stream
+        self._pending = data + self._pending
+
+    def drain(self):
+        while self.read(256 * 1024):
+            pass
+        if self.total is not None and self.position != self.total:
+            raise EOFError(f"download ended at {self.position} of {self.total} bytes")
+
+    def discard(self):
+        for path in (self.part_path, self.meta_path):
+            try: path.unlink()
+            except OSError: pass
+
+    def close(self):
+        for f in (self._replay, self._response, self._part):
+            if f is not None:
+                try: f.close()
+                except OSError: pass
+        self._replay = self._response = self._part = None
+
+def _is_ffmpeg_member(name):
+    return name.replace("\\", "/").rsplit("/", 1)[-1] in FFMPEG_MEMBER_NAMES
+
+def _extract_tar_member(stream, dest):
+    with tarfile.open(fileobj=stream, mode="r|*") as tar:
+        for member in tar:
+            if member.isfile() and _is_ffmpeg_member(member.name):
+                source = tar.extractfile(member)
+                with open(dest, 'wb') as out:
+                    shutil.copyfileobj(source, out, 256 * 1024)
+                return True
+    return False
+
+def _extract_zip_member(stream, dest):
+    # Walks local file headers in stream order; the central directory at
+    # the end of the archive is never needed
+    while True:
+        header = stream.read_exact(4)
+        if header != b"PK\x03\x04":
+            return False
+        (_, flags, method, _, _, crc, compressed, size, name_len, extra_len) = struct.unpack(
+            "<HHHHHIIIHH", stream.read_exact(26))
+        raw_name = stream.read_exact(name_len)
+        extra = stream.read_exact(extra_len)
+        name = raw_name.decode('utf-8' if flags & 0x800 else 'cp437')
+        if 0xFFFFFFFF in (compressed, size):
+            compressed, size = _zip64_sizes(extra, compressed, size)
+        has_descriptor = bool(flags & 0x08)
+        if flags & 0x01 or method not in (0, 8) or (has_descriptor and method != 8):
+            raise ValueError(f"unsupported zip entry: {name}")
+        wanted = _is_ffmpeg_member(name) and not name.endswith("/")
+        out = open(dest, 'wb') if wanted else None
+        try:
+            actual_crc = _copy_zip_data(stream, out, method, None if has_descriptor else compressed)
+        finally:
+            if out is not None:
+                out.close()
+        if has_descriptor:
+            descriptor = stream.read_exact(12)
+            if descriptor[:4] == b"PK\x07\x08":
+                descriptor = descriptor[4:] + stream.read_exact(4)
+            crc = struct.unpack("<I", descriptor[:4])[0]
+        if wanted:
+            if actual_crc != crc:
+                raise ValueError(f"CRC mismatch in {name}")
+            return True
+
+def _zip64_sizes(extra, compressed, size):
+    while len(extra) >= 4:
+        tag, length = struct.unpack("<HH", extra[:4])
+        if tag == 0x0001:
+            values = list(struct.unpack(f"<{length // 8}Q", extra[4:4 + length // 8 * 8]))
+            if size == 0xFFFFFFFF and values:
+                size = values.pop(0)
+            if compressed == 0xFFFFFFFF and values:
+                compressed = values.pop(0)
+            break
+        extra = extra[4 + length:]
+    return compressed, size
+
+def _copy_zip_data(stream, out, method, compressed):
+    # compressed is None when the size is only in the trailing data
+    # descriptor; the deflate stream then marks its own end
+    decompressor = zlib.decompressobj(-15) if method == 8 else None
+    crc = 0
+    remaining = compressed
+    while remaining is None or remaining > 0:
+        data = stream.read(256 * 1024 if remaining is None else min(remaining, 256 * 1024))
+        if not data:
+            raise EOFError("download ended inside a zip entry")
+        if remaining is not None:
+            remaining -= len(data)
+        if decompressor is not None:
+            data = decompressor.decompress(data)
+        crc = zlib.crc32(data, crc)
+        if out is not None:
+            out.write(data)
+        if decompressor is not None and decompressor.eof:
+            if decompressor.unused_data:
+                stream.unread(decompressor.unused_data)
+            break
+    return crc
+
+def download_ffmpeg(url, checksum_url, dest, work_dir, log=None, attempts=3):
+    # Streams the archive once: ffmpeg is extracted while it downloads and
+    # only moved into place once the whole archive matches its checksum
+    log = log or (lambda message: None)
+    algorithm, expected = fetch_checksum(checksum_url)
+    dest = Path(dest)
+    part_path = Path(work_dir) / f"ffmpeg-{hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]}.part"
+    temp_path = dest.with_name(dest.name + ".download")
+    reported = [0]
+
+    def on_progress(position, total):
+        if total:
+            step = position * 10 // total
+            if step > reported[0]:
+                reported[0] = step
+                log(f"FFmpeg: {format_bytes(position)} of {format_bytes(total)}")
+
+    for attempt in range(1, attempts + 1):
+        stream = DownloadStream(url, part_path, hashlib.new(algorithm), on_progress)
+        try:
+            stream.open()
+            if stream.resumed_from:
+                log(f"Resuming FFmpeg download at {format_bytes(stream.resumed_from)}")
+            elif stream.restarted:
+                log("Partial FFmpeg download doesn't match the file upstream, starting over")
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            head = stream.read_exact(4)
+            stream.unread(head)
+            extract = _extract_zip_member if head == b"PK\x03\x04" else _extract_tar_member
+            if not extract(stream, temp_path):
+                stream.discard()
+                raise ValueError("archive has no ffmpeg binary")
+            stream.drain()
+            stream.close()
+            if stream.hasher.hexdigest() != expected:
+                stream.discard()
+                raise ValueError(f"{algorithm} checksum mismatch")
+            if os.name != 'nt':
+                os.chmod(temp_path, 0o755)
+            os.replace(temp_path, dest)
+            stream.discard()
+            return dest
+        except urllib.error.HTTPError as e:
+            # Server errors may pass, anything else won't change on retry
+            if e.code < 500 or attempt == attempts:
+                raise
+            log(f"FFmpeg download failed ({e}), retrying...")
+        except (OSError, EOFError, ValueError, http.client.HTTPException, tarfile.TarError, zlib.error) as e:
+            if attempt == attempts:
+                raise
+            log(f"FFmpeg download failed ({e}), retrying...")
+        finally:
+            stream.close()
+            remove_temp_file(str(temp_path))
+        time.sleep(attempt)
+
+def default_download_folder():
+    default_folder = str(Path.home() / "Music" / "Earbound")
+    if not os.path.exists(default_folder):
+        music_folder = Path.home() / "Music"
+        if music_folder.exists():
+            default_folder = str(music_folder / "Earbound")
+        else:
+            default_folder = str(Path.home() / "Documents" / "Earbound")
+    return default_folder
+
+def kill_process_tree(process):
+    if process is None or process.poll() is not None:
+        return
+    try:
+        if os.name == 'nt':
+            subprocess.run(['taskkill', '/F', '/T', '/PID', str(process.pid)], capture_output=True)
+        else:
+            os.killpg(os.getpgid(process.pid), signal.SIGTERM)
+    except:
+        pass
+
+class BackendError(Exception):
+    pass
+
+class ConversionError(Exception):
+    pass
+
+class StallError(BackendError):
+    pass
+
+class UnavailableError(BackendError):
+    # Removed, private, region-locked or not found: retrying won't help
+    pass
+
+class ItemsFailed(BackendError):
+    def __init__(self, failures):
+        self.failures = failures
+        first = next(iter(failures.values()))
+        super().__init__(str(first) if len(failures) == 1 else f"{len(failures)} tracks failed, first: {first}")
+
+def item_error(message):
+    m = YTDLP_ITEM_RE.match(message)
+    if m:
+        message = message[m.end():]
+    elif message.startswith("ERROR: "):
+        message = message[len("ERROR: "):]
+    return UnavailableError(message) if PERMANENT_ERROR_RE.search(message) else BackendError(message)
+
+def retry_delay(attempt):
+    # Exponential backoff with jitter so parallel chunks don't retry in lockstep
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+class StallWatchdog:
+    # Kills a backend process that printed nothing for `timeout` seconds
+    def __init__(self, process, timeout):
+        self.process = process
+        self.timeout = timeout
+        self.stalled = False
+        self._last = time.monotonic()
+        self._done = threading.Event()
+        threading.Thread(target=self._run, daemon=True, name="watchdog").start()
+
+    def touch(self):
+        self._last = time.monotonic()
+
+    def stop(self):
+        self._done.set()
+
+    def _run(self):
+        while not self._done.wait(min(1.0, self.timeout / 4)):
+            if time.monotonic() - self._last > self.timeout:
+                self.stalled = True
+                kill_process_tree(self.process)
+                return
+
+class ItemErrors:
+    # Errors from backend output by item. An error line that doesn't name
+    # its item belongs to the last one mentioned on that thread, since each
+    # fan-out chunk reads its own backend's output.
+    def __init__(self):
+        self._errors = {}
+        self._current = threading.local()
+
+    def current(self):
+        return getattr(self._current, "key", None)
+
+    def feed(self, line):
+        m = YTDLP_ITEM_RE.match(line)
+        if m:
+            self._current.key = m.group(1)
+        if line.startswith("ERROR: "):
+            self.add(self.current(), item_error(line))
+
+    def add(self, key, error):
+        if key is not None:
+            self._errors[key] = error
+
+    def pop(self, key):
+        return self._errors.pop(key, None)
+
+class JobMetrics:
+    # Wall-clock breakdown of a job and of each of its tracks. A stage lasts
+    # until the next one is entered, so a job's stages add up to its run time.
+    TRACK_FINISHED = ("done", "failed")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        self.stages = collections.OrderedDict()
+        self.stage = "queued"
+        self._since = time.monotonic()
+        self.tracks = collections.OrderedDict()
+        self.retries = 0
+        self.error_class = None
+
+    def enter(self, stage):
+        with self._lock:
+            if self.stage is not None:
+                self._close_stage(time.monotonic())
+                self.stage = stage
+
+    def finish(self, error=None):
+        with self._lock:
+            if self.stage is None:
+                return
+            self._close_stage(time.monotonic())
+            self.stage = None
+            if error is not None:
+                self.error_class = type(error).__name__
+
+    def _close_stage(self, now):
+        self.stages[self.stage] = self.stages.get(self.stage, 0.0) + now - self._since
+        self._since = now
+
+    def _track(self, key, now):
+        track = self.tracks.get(key)
+        if track is None:
+            track = self.tracks[key] = {"stage": None, "since": now, "stages": {}, "bytes": 0, "retries": 0, "error_class": None}
+        return track
+
+    def track(self, key, stage, error=None):
+        if key is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            track = self._track(key, now)
+            if track["stage"] != stage:
+                if track["stage"] is not None and track["stage"] not in self.TRACK_FINISHED:
+                    track["stages"][track["stage"]] = track["stages"].get(track["stage"], 0.0) + now - track["since"]
+                track["stage"], track["since"] = stage, now
+            if error is not None:
+                track["error_class"] = type(error).__name__
+
+    def track_bytes(self, key, downloaded):
+        if key is None or not downloaded:
+            return
+        with self._lock:
+            track = self._track(key, time.monotonic())
+            track["bytes"] = max(track["bytes"], int(downloaded))
+
+    def retry(self, key=None):
+        with self._lock:
+            self.retries += 1
+            if key in self.tracks:
+                self.tracks[key]["retries"] += 1
+
+    def snapshot(self, tracks=True):
+        now = time.monotonic()
+        with self._lock:
+            stages = dict(self.stages)
+            if self.stage is not None:
+                stages[self.stage] = stages.get(self.stage, 0.0) + now - self._since
+            track_rows = []
+            track_stages = {}
+            for key, track in self.tracks.items():
+                durations = dict(track["stages"])
+                if track["stage"] is not None and track["stage"] not in self.TRACK_FINISHED:
+                    durations[track["stage"]] = durations.get(track["stage"], 0.0) + now - track["since"]
+                for stage, seconds in durations.items():
+                    track_stages[stage] = track_stages.get(stage, 0.0) + seconds
+                download_time = durations.get("downloading")
+                track_rows.append({
+                    "key": key, "stage": track["stage"], "bytes": track["bytes"], "retries": track["retries"],
+                    "error_class": track["error_class"], "stages": {k: round(v, 3) for k, v in durations.items()},
+                    "speed": round(track["bytes"] / download_time) if download_time and track["bytes"] else None,
+                })
+            total_bytes = sum(track["bytes"] for track in self.tracks.values())
+            summary = {
+                "started_at": round(self.started_at, 3),
+                "elapsed": round(sum(stages.values()), 3),
+                "stages": {k: round(v, 3) for k, v in stages.items()},
+                "track_stages": {k: round(v, 3) for k, v in track_stages.items()},
+                "bytes": total_bytes,
+                "throughput": round(total_bytes / stages["downloading"]) if stages.get("downloading") and total_bytes else None,
+                "retries": self.retries,
+                "error_class": self.error_class,
+            }
+        if tracks:
+            summary["tracks"] = track_rows
+        return summary
+
+class MetricsRegistry:
+    # Metrics of recent jobs, kept after the queue forgets them, plus
+    # running totals for the Prometheus export
+    def __init__(self, keep=200):
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._jobs = collections.OrderedDict()
+        self.totals = collections.Counter()
+
+    def add(self, job):
+        with self._lock:
+            self._jobs[job.id] = job
+
+    def job_finished(self, job):
+        metrics = job.metrics.snapshot()
+        with self._lock:
+            totals = self.totals
+            totals[("jobs", job.status)] += 1
+            totals[("bytes", "")] += metrics["bytes"]
+            totals[("retries", "")] += metrics["retries"]
+            if metrics["error_class"]:
+                totals[("errors", metrics["error_class"])] += 1
+            for stage, seconds in metrics["stages"].items():
+                totals[("stage_seconds", stage)] += seconds
+            for stage, seconds in metrics["track_stages"].items():
+                totals[("track_stage_seconds", stage)] += seconds
+            for track in metrics["tracks"]:
+                if track["stage"] in JobMetrics.TRACK_FINISHED:
+                    totals[("tracks", track["stage"])] += 1
+                if track["error_class"]:
+                    totals[("errors", track["error_class"])] += 1
+            finished = [job_id for job_id, j in self._jobs.items() if j.finished]
+            for job_id in finished[:max(0, len(finished) - self.keep)]:
+                del self._jobs[job_id]
+
+    def snapshot(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+            totals = {}
+            for (name, label), value in self.totals.items():
+                if label:
+                    totals.setdefault(name, {})[label] = round(value, 3)
+                else:
+                    totals[name] = value
+        rows = []
+        for job in jobs:
+            row = {"id": job.id, "link": job.link, "type": job.link_type, "status": job.status,
+                   "progress": round(job.progress, 1), "items_done": job.items_done, "items_total": job.items_total,
+                   "speed": job.speed, "eta": job.eta, "error": job.error}
+            row.update(job.metrics.snapshot())
+            rows.append(row)
+        return {"time": round(time.time(), 3), "totals": totals, "jobs": rows}
+
+    def prometheus(self):
+        snapshot = self.snapshot()
+        totals = snapshot["totals"]
+        lines = []
+
+        def family(name, kind, help_text, samples):
+            lines.append(f"# HELP earbound_{name} {help_text}")
+            lines.append(f"# TYPE earbound_{name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{k}="{prometheus_escape(v)}"' for k, v in labels.items())
+                value = prometheus_value(value)
+                lines.append(f"earbound_{name}{{{label_text}}} {value}" if label_text else f"earbound_{name} {value}")
+
+        family("jobs_total", "counter", "Finished jobs by status.",
+               [({"status": k}, v) for k, v in sorted(totals.get("jobs", {}).items())])
+        family("tracks_total", "counter", "Finished tracks by status.",
+               [({"status": k}, v) for k, v in sorted(totals.get("tracks", {}).items())])
+        family("downloaded_bytes_total", "counter", "Bytes downloaded by finished jobs.", [({}, totals.get("bytes", 0))])
+        family("retries_total", "counter", "Retries reported by the download backends.", [({}, totals.get("retries", 0))])
+        family("errors_total", "counter", "Job and track failures by error class.",
+               [({"class": k}, v) for k, v in sorted(totals.get("errors", {}).items())])
+        family("job_stage_seconds_total", "counter", "Wall-clock seconds finished jobs spent per stage.",
+               [({"stage": k}, v) for k, v in sorted(totals.get("stage_seconds", {}).items())])
+        family("track_stage_seconds_total", "counter", "Seconds finished tracks spent per stage, summed over tracks.",
+               [({"stage": k}, v) for k, v in sorted(totals.get("track_stage_seconds", {}).items())])
+        active = collections.Counter(job["status"] for job in snapshot["jobs"] if job["status"] in ("queued", "running"))
+        family("jobs_active", "gauge", "Jobs queued or running.", [({"status": k}, active.get(k, 0)) for k in ("queued", "running")])
+        family("download_speed_bytes", "gauge", "Current download speed of all running jobs, bytes per second.",
+               [({}, sum(job["speed"] or 0 for job in snapshot["jobs"] if job["status"] == "running"))])
+        return "\n".join(lines) + "\n"
+
+    def export(self, path):
+        # .json gets the full snapshot, anything else the Prometheus text format
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if path.suffix.lower() == ".json":
+            write_json_atomic(path, self.snapshot())
+        else:
+            write_text_atomic(path, self.prometheus())
+
+def prometheus_value(value):
+    # Full precision; "{:g}" would turn a byte counter into 1.23457e+09
+    return str(int(value)) if isinstance(value, int) else repr(float(value))
+
+def prometheus_escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+# Single tracks go ahead of playlists and albums, in the queue and for bandwidth
+PRIORITY_HIGH = 1
+PRIORITY_NORMAL = 0
+PRIORITY_WEIGHTS = {PRIORITY_HIGH: 4, PRIORITY_NORMAL: 1}
+# High priority jobs that may run on top of max_workers, and connections
+# per host only they may use, so a single track never waits for a playlist
+# to finish
+PRIORITY_EXTRA_SLOTS = 2
+PRIORITY_RESERVED_CONNECTIONS = 1
+MIN_RATE = 16 * 1024
+# Audio for Spotify links is fetched from YouTube too, so both share the
+# YouTube connection budget
+DOWNLOAD_HOSTS = {"youtube": "youtube", "spotify": "youtube"}
+DEFAULT_HOST_CONNECTIONS = {"youtube": 8}
+
+def default_priority(link_type):
+    return PRIORITY_HIGH if link_type in ("youtube_video", "spotify_track") else PRIORITY_NORMAL
+
+def parse_rate(value):
+    # "500K", "2M", "1.5MiB" or plain bytes per second; empty means unlimited
+    if value is None or str(value).strip().lower() in ("", "0", "none", "unlimited"):
+        return None
+    m = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([kmg]?)(?:i?b)?(?:/s)?\s*', str(value), re.IGNORECASE)
+    if not m:
+        raise ValueError(f"invalid rate: {value!r}")
+    return int(float(m.group(1)) * 1024 ** " kmg".index(m.group(2).lower() or " "))
+
+class Lease:
+    def __init__(self, job, host, connections):
+        self.job = job
+        self.host = host
+        self.connections = connections
+        self.rate = None  # Bytes per second, None when unlimited
+
+class BandwidthScheduler:
+    # Hands out backend connections per host and splits the global
+    # bandwidth cap across the jobs holding them: each job gets a share
+    # weighted by its priority, divided among its connections. Waiters are
+    # served by priority, then in arrival order.
+    def __init__(self, rate_limit=None, host_limits=None):
+        self.rate_limit = rate_limit
+        self.host_limits = dict(DEFAULT_HOST_CONNECTIONS)
+        self.host_limits.update(host_limits or {})
+        self._cond = threading.Condition()
+        self._leases = []
+        self._waiting = []
+        self._seq = itertools.count()
+
+    def set_rate_limit(self, rate):
+        with self._cond:
+            self.rate_limit = rate
+            self._rebalance()
+
+    def set_host_limit(self, host, count):
+        with self._cond:
+            self.host_limits[host] = max(1, int(count))
+            self._cond.notify_all()
+
+    def acquire(self, job, host, connections=1):
+        # Blocks until the host has room; returns None if the job is cancelled meanwhile
+        with self._cond:
+            limit = self.host_limits.get(host)
+            connections = max(1, min(connections, limit or connections))
+            ticket = (-job.priority, next(self._seq), host, connections)
+            self._waiting.append(ticket)
+            try:
+                while not self._can_start(ticket):
+                    if job.cancel_requested:
+                        return None
+                    self._cond.wait(0.5)
+            finally:
+                self._waiting.remove(ticket)
+                self._cond.notify_all()
+            lease = Lease(job, host, self._connections(ticket))
+            self._leases.append(lease)
+            self._rebalance()
+            return lease
+
+    def release(self, lease):
+        if lease is None:
+            return
+        with self._cond:
+            if lease in self._leases:
+                self._leases.remove(lease)
+                self._rebalance()
+            self._cond.notify_all()
+
+    def _can_start(self, ticket):
+        host = ticket[2]
+        first = min(t for t in self._waiting if t[2] == host)
+        if first is not ticket:
+            return False
+        limit = self._limit(ticket)
+        in_use = sum(lease.connections for lease in self._leases if lease.host == host)
+        return limit is None or in_use + self._connections(ticket) <= limit
+
+    def _connections(self, ticket):
+        # The limit may have been lowered while the ticket waited
+        limit = self._limit(ticket)
+        return ticket[3] if limit is None else min(ticket[3], limit)
+
+    def _limit(self, ticket):
+        limit = self.host_limits.get(ticket[2])
+        if limit is not None and -ticket[0] < PRIORITY_HIGH:
+            limit = max(1, limit - PRIORITY_RESERVED_CONNECTIONS)
+        return limit
+
+    def _rebalance(self):
+        if not self.rate_limit:
+            for lease in self._leases:
+                lease.rate = None
+            return
+        jobs = collections.OrderedDict()
+        for lease in self._leases:
+            jobs.setdefault(lease.job.id, []).append(lease)
+        total_weight = sum(PRIORITY_WEIGHTS.get(leases[0].job.priority, 1) for leases in jobs.values())
+        for leases in jobs.values():
+            share = self.rate_limit * PRIORITY_WEIGHTS.get(leases[0].job.priority, 1) / total_weight
+            connections = sum(lease.connections for lease in leases)
+            for lease in leases:
+                lease.rate = max(MIN_RATE, int(share * lease.connections / connections))
+
+class DownloadJob:
+    _ids = itertools.count(1)
+    FINISHED = ("done", "failed", "cancelled")
+
+    def __init__(self, link, link_type, folder, journal_id=None, priority=None):
+        self.id = next(DownloadJob._ids)
+        self.link = link
+        self.link_type = link_type
+        self.folder = folder
+        self.priority = default_priority(link_type) if priority is None else priority
+        self.journal_id = journal_id
+        self.journal_status = None
+        self.item_states = {}
+        self.status = "queued"
+        self.progress = 0.0
+        self.error = None
+        self.processes = set()  # For cancel
+        self.cancel_requested = False
+        self.archive = None
+        self.library = None
+        self.item_errors = ItemErrors()
+        self.failed_items = {}  # key -> exception, for tracks that failed while the rest went on
+        self.speed = None
+        self.eta = None
+        self.items_total = 1
+        self._items = {}
+        self.metrics = JobMetrics()
+
+    @property
+    def finished(self):
+        return self.status in self.FINISHED
+
+    @property
+    def items_done(self):
+        return sum(1 for fraction in list(self._items.values()) if fraction >= 1.0)
+
+    def set_items(self, total, done=()):
+        self.items_total = max(1, total)
+        self._items = {key: 1.0 for key in done}
+        self._update_progress()
+
+    def update_item(self, key, fraction):
+        # Progress of one track; the job's progress covers the whole playlist
+        self._items[key] = min(1.0, max(0.0, fraction))
+        self._update_progress()
+
+    def _update_progress(self):
+        total = max(self.items_total, len(self._items))
+        self.progress = 20 + 70 * sum(list(self._items.values())) / total
+
+def job_fields(job):
+    fields = {"id": job.id, "link": job.link, "type": job.link_type, "status": job.status, "progress": round(job.progress, 1)}
+    if job.items_total > 1:
+        fields["items_done"] = job.items_done
+        fields["items_total"] = job.items_total
+    if job.speed:
+        fields["speed"] = job.speed
+    if job.eta is not None:
+        fields["eta"] = job.eta
+    if job.error:
+        fields["error"] = job.error
+    if job.failed_items:
+        fields["failed_items"] = [{"id": key, "error": str(error), "permanent": isinstance(error, UnavailableError)}
+                                  for key, error in job.failed_items.items()]
+    return fields
+
+class JobQueue:
+    def __init__(self, runner, on_update=None, max_workers=2):
+        self.runner = runner
+        self.on_update = on_update
+        self.max_workers = max(1, int(max_workers))
+        self.jobs = collections.OrderedDict()
+        self._pending = collections.deque()
+        self._active = 0
+        self._extra = 0  # Of the active jobs, those running beyond max_workers
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+
+    def submit(self, link, link_type, folder, journal_id=None, priority=None):
+        job = DownloadJob(link, link_type, folder, journal_id, priority)
+        with self._lock:
+            # Ahead of every queued job with a lower priority, behind its equals
+            index = len(self._pending)
+            while index > 0 and self._pending[index - 1].priority < job.priority:
+                index -= 1
+            self._pending.insert(index, job)
+            # Only listed once it is queued, so a bad priority can't leave a job behind
+            self.jobs[job.id] = job
+        self._notify(job)
+        self._fill()
+        return job
+
+    def set_max_workers(self, count):
+        with self._lock:
+            self.max_workers = max(1, int(count))
+        self._fill()
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None or job.finished:
+            return False
+        job.cancel_requested = True
+        with self._lock:
+            queued = job in self._pending
+            if queued:
+                self._pending.remove(job)
+                self._idle.notify_all()
+        if queued:
+            job.status = "cancelled"
+            job.metrics.finish()
+            self._notify(job)
+        else:
+            for process in list(job.processes):
+                kill_process_tree(process)
+        return True
+
+    def cancel_all(self):
+        for job_id in list(self.jobs):
+            self.cancel(job_id)
+
+    def remove_finished(self, keep=0):
+        # Keeps the `keep` most recently submitted finished jobs
+        with self._lock:
+            finished = [j.id for j in self.jobs.values() if j.finished]
+            for job_id in finished[:len(finished) - keep]:
+                del self.jobs[job_id]
+
+    def is_busy(self):
+        with self._lock:
+            return self._active > 0 or bool(self._pending)
+
+    def join(self, timeout=None):
+        with self._idle:
+            return self._idle.wait_for(lambda: self._active == 0 and not self._pending, timeout)
+
+    def _fill(self):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    return
+                if self._active - self._extra < self.max_workers:
+                    extra = False
+                elif self._pending[0].priority >= PRIORITY_HIGH and self._extra < PRIORITY_EXTRA_SLOTS:
+                    extra = True
+                else:
+                    return
+                job = self._pending.popleft()
+                self._active += 1
+                self._extra += extra
+            threading.Thread(target=self._work, args=(job, extra), daemon=True).start()
+
+    def _work(self, job, extra=False):
+        error = None
+        try:
+            job.status = "running"
+            job.metrics.enter("starting")
+            self._notify(job)
+            self.runner(job)
+            if job.cancel_requested:
+                job.status = "cancelled"
+            else:
+                job.status = "done"
+                job.progress = 100.0
+        except Exception as e:
+            job.status = "cancelled" if job.cancel_requested else "failed"
+            job.error = str(e)
+            error = e if job.status == "failed" else None
+        finally:
+            job.metrics.finish(error)
+            job.processes.clear()
+            job.speed = job.eta = None
+            with self._lock:
+                self._active -= 1
+                self._extra -= extra
+            self._notify(job)
+            with self._lock:
+                self._idle.notify_all()
+            self._fill()
+
+    def _notify(self, job):
+        if self.on_update:
+            self.on_update(job)
+
+class DownloadEngine:
+    def __init__(self, max_workers=2, use_inprocess=True, track_workers=None, output_profile="mp3",
+                 rate_limit=None, host_connections=None, duplicates="keep", spotify_sync=True, prune_removed=False):
+        self.use_inprocess = use_inprocess
+        self.duplicates = duplicates
+        # Spotify playlists, albums and artists only download tracks added since their last sync
+        self.spotify_sync = spotify_sync
+        self.prune_removed = prune_removed
+        self.scheduler = BandwidthScheduler(rate_limit, host_connections)
+        self.output_profile = output_profile
+        self._convert_pools = {}  # priority -> pool
+        self._convert_pool_lock = threading.Lock()
+        # Tracks downloaded at once inside a single playlist job, per source
+        self.track_workers = {"youtube": 3, "spotify": 4}
+        self.track_workers.update(track_workers or {})
+        self.ffmpeg_path = None
+        self.deps_ready = threading.Event()
+        self.log_pipeline = LogPipeline()
+        self.playlist_cache = PlaylistCache(get_cache_dir() / "playlists")
+        self._archives = {}
+        self._archives_lock = threading.Lock()
+        self._libraries = {}
+        self._syncs = {}
+        self.metrics = MetricsRegistry()
+        self.metrics_path = None  # Exported whenever a job finishes
+        self.journal = JobJournal(get_cache_dir() / "journal.sqlite3")
+        for path in self.journal.prune():
+            remove_temp_file(path)
+        remove_stale_temp_files()
+        self.job_queue = JobQueue(self.download_music, on_update=self._job_changed, max_workers=max_workers)
+
+    def log_message(self, message):
+        self.log_pipeline.put(message)
+
+    def _job_changed(self, job):
+        self.metrics.add(job)
+        if job.finished and job.status != job.journal_status:
+            self.metrics.job_finished(job)
+            if self.metrics_path:
+                self.export_metrics()
+        if job.status != job.journal_status:
+            job.journal_status = job.status
+            if job.journal_id is None:
+                job.journal_id = self.journal.add_job(job.link, job.link_type, job.folder, job.status)
+            else:
+                self.journal.update_job(job.journal_id, job.status)
+        self._on_job_update(job)
+
+    def export_metrics(self, path=None):
+        try:
+            self.metrics.export(path or self.metrics_path)
+        except OSError as e:
+            self.log_message(f"Could not write metrics: {e}")
+
+    def _backend_message(self, job, message):
+        job.item_errors.feed(message)
+        if YTDLP_RETRY_RE.search(message):
+            job.metrics.retry(job.item_errors.current())
+        self.log_message(f"[#{job.id}] {message}")
+
+    def _track_item(self, job, key, status, path=None, error=None):
+        # Journal writes only happen when a track changes state
+        if key is None or job.item_states.get(key) == status:
+            return
+        job.item_states[key] = status
+        job.metrics.track(key, status, error)
+        if job.journal_id is not None:
+            self.journal.update_item(job.journal_id, key, status, path)
+
+    def _remove_temp_files(self, journal_id):
+        for path in self.journal.temp_paths(journal_id):
+            remove_temp_file(path)
+
+    def resumable_jobs(self):
+        # A link interrupted more than once is only resumed from its latest attempt
+        latest = collections.OrderedDict()
+        for row in self.journal.unfinished():
+            key = (row["link"], row["folder"])
+            if key in latest:
+                self.journal.update_job(latest[key]["id"], "discarded")
+            latest[key] = row
+        return list(latest.values())
+
+    def resume_jobs(self, rows):
+        # Partial .part downloads are picked up again by yt-dlp; finished
+        # tracks are in the archive and the journal
+        return [self.job_queue.submit(row["link"], row["link_type"], row["folder"], journal_id=row["id"]) for row in rows]
+
+    def discard_jobs(self, rows):
+        for row in rows:
+            self._remove_temp_files(row["id"])
+            self.journal.update_job(row["id"], "discarded")
+
+    def _on_job_update(self, job):
+        pass
+
+    def check_dependencies(self, install=True):
+        self.log_message("Checking dependencies...")
+        cache_path = get_cache_dir() / "dependencies.json"
+        cache = read_json(cache_path, {})
+        found = {}
+        try:
+            found = self._probe_tools(list(DEPENDENCY_PROBES), cache)
+            missing = [name for name in PIP_PACKAGES if name not in found]
+            if missing and install and self._install_packages(missing):
+                found.update(self._probe_tools(missing, cache))
+            for name in missing:
+                if name not in found:
+                    self.log_message(f"{name} installation failed" if install else f"{name} not found")
+            if "ffmpeg" not in found:
+                if install and self._download_ffmpeg():
+                    found.update(self._probe_tools(["ffmpeg"], cache))
+                elif not install:
+                    self.log_message("FFmpeg not found")
+            if "ffmpeg" in found:
+                path = found["ffmpeg"]["path"]
+                self.ffmpeg_path = path if path == str(LOCAL_FFMPEG) else "ffmpeg"
+            write_json_atomic(cache_path, cache)
+        except Exception as e:
+            self.log_message(f"Dependency check failed: {e}")
+        finally:
+            self.deps_ready.set()
+        self.log_message("Ready to download!")
+        return found
+
+    def _probe_tools(self, names, cache):
+        with ThreadPoolExecutor(max_workers=len(names)) as pool:
+            results = dict(zip(names, pool.map(lambda name: probe_tool(name, cache), names)))
+        found = {}
+        for name, result in results.items():
+            if result:
+                found[name] = result
+                source = "cached" if result["cached"] else result["path"]
+                self.log_message(f"{name} ready ({result['version']}, {source})")
+        return found
+
+    def _install_packages(self, packages):
+        self.log_message(f"Installing {', '.join(packages)}...")
+        try:
+            subprocess.run([sys.executable, "-m", "pip", "install"] + list(packages), check=True, timeout=180)
+            return True
+        except:
+            return False
+
+    def _download_ffmpeg(self):
+        build = ffmpeg_build()
+        if build is None:
+            self.log_message(f"No FFmpeg build for {platform.system()} {platform.machine()}")
+            return False
+        self.log_message("Downloading FFmpeg...")
+        try:
+            download_ffmpeg(*build, LOCAL_FFMPEG, get_cache_dir() / "downloads", log=self.log_message)
+        except Exception as e:
+            self.log_message(f"FFmpeg download failed: {e}")
+            return False
+        return LOCAL_FFMPEG.exists()
+
+    def validate_link(self, link):
+        if not link.strip(): return False, "Enter a link"
+        try:
+            return True, canonicalize_link(link).link_type
+        except ValueError as e:
+            return False, str(e)
+
+    def _get_organized_download_path(self, base_path, link_type, link):
+        base = Path(base_path)
+        if link_type in ("spotify_playlist", "spotify_album", "spotify_artist"):
+            path = base / "Spotify_Playlist"
+            path.mkdir(exist_ok=True)
+            return str(path)
+        if link_type.startswith("youtube_playlist"):
+            name = self._get_youtube_playlist_name(link) or "Playlist"
+            path = base / "YouTube_Playlist" / self._sanitize_filename(name)
+            path.mkdir(parents=True, exist_ok=True)
+            return str(path)
+        return str(base)
+
+    def _get_youtube_playlist_name(self, link):
+        info = self._get_playlist_info(link)
+        return info["title"] if info else None
+
+    def _get_playlist_info(self, link):
+        info = self.playlist_cache.get(link)
+        if info is None:
+            try:
+                info = self._extract_playlist(link)
+            except Exception as e:
+                self.log_message(f"Could not read playlist: {e}")
+                info = None
+            if info:
+                info = self.playlist_cache.put(link, info)
+        return info
+
+    def _extract_playlist(self, link):
+        yt_dlp = load_yt_dlp() if self.use_inprocess else None
+        if yt_dlp:
+            opts = {"extract_flat": "in_playlist", "quiet": True, "no_warnings": True, "ignoreerrors": True}
+            with yt_dlp.YoutubeDL(opts) as ydl:
+                data = ydl.sanitize_info(ydl.extract_info(link, download=False))
+        else:
+            r = subprocess.run(["yt-dlp", "--flat-playlist", "--dump-single-json", link], capture_output=True, text=True, timeout=120)
+            data = json.loads(r.stdout) if r.returncode == 0 else None
+        if not data:
+            return None
+        entries = []
+        for entry in data.get("entries") or []:
+            url = entry and (entry.get("url") or entry.get("webpage_url"))
+            if url:
+                entries.append({"id": entry.get("id"), "url": url, "title": entry.get("title"), "ie_key": entry.get("ie_key"),
+                                "channel": entry.get("channel") or entry.get("uploader"), "duration": entry.get("duration")})
+        return {"title": data.get("title"), "entries": entries}
+
+    def _sanitize_filename(self, s):
+        s = re.sub(r'[<>:"/\\|?*]', '_', s)
+        s = re.sub(r'\s+', ' ', s).strip()
+        return s[:100]
+
+    def download_music(self, job):
+        self.deps_ready.wait()
+        base_path = job.folder
+        os.makedirs(base_path, exist_ok=True)
+        download_path = self._get_organized_download_path(base_path, job.link_type, job.link)
+        job.archive = self._get_archive(base_path)
+        job.library = self.get_library(base_path) if self.duplicates != "keep" else None
+        if job.journal_id is not None:
+            self.journal.update_job(job.journal_id, path=download_path)
+            # A resumed job starts from the track states of its earlier run
+            job.item_states = self.journal.item_states(job.journal_id)
+            if job.item_states:
+                states = collections.Counter(job.item_states.values())
+                self.log_message(f"[#{job.id}] Resuming: {states['done']} track(s) done, {states['downloading']} partially downloaded")
+
+        self.log_message(f"[#{job.id}] Starting {job.link_type} download...")
+        self.log_message(f"[#{job.id}] Path: {download_path}")
+
+        job.metrics.enter("resolving")
+        if job.link_type.startswith("spotify"):
+            self._run_spotify(job.link, download_path, job)
+        else:
+            self._run_youtube(job.link, download_path, job)
+
+    def _get_archive(self, base_path):
+        key = os.path.abspath(base_path)
+        with self._archives_lock:
+            if key not in self._archives:
+                self._archives[key] = DownloadArchive(key)
+            return self._archives[key]
+
+    def _get_sync(self, path):
+        key = os.path.abspath(path)
+        with self._archives_lock:
+            if key not in self._syncs:
+                self._syncs[key] = SpotifySync(key)
+            return self._syncs[key]
+
+    def get_library(self, base_path):
+        key = os.path.abspath(base_path)
+        with self._archives_lock:
+            library = self._libraries.get(key)
+            if library is None:
+                library = self._libraries[key] = LibraryIndex(key)
+        # The first use in a session catches up with files changed outside the app
+        if not library.scanned:
+            self.refresh_library(library)
+        return library
+
+    def refresh_library(self, library):
+        started = time.monotonic()
+        changed = library.refresh()
+        self.log_message(f"Library: {len(library)} tracks, {len(changed)} new or changed, "
+                         f"{library.duplicate_count()} duplicates ({(time.monotonic() - started) * 1000:.0f} ms)")
+        return changed
+
+    def _owned_entries(self, job, entries, path):
+        # Playlist entries the library already has; in link mode the existing
+        # file is hard linked into this folder instead of downloading it again
+        owned = []
+        for entry in entries:
+            artist, title = split_track_name(entry.get("title") or "", channel_artist(entry.get("channel")))
+            matches = job.library.find(artist, title, entry.get("duration"), strict=True)
+            if not matches:
+                continue
+            if self.duplicates == "link" and not self._link_into(job, matches, path):
+                continue
+            owned.append(entry)
+        return owned
+
+    def _link_into(self, job, matches, folder):
+        for source in matches:
+            if os.path.dirname(source) == os.path.abspath(folder):
+                return True
+        source = matches[0]
+        target = os.path.join(folder, os.path.basename(source))
+        try:
+            if not os.path.exists(target):
+                os.link(source, target)
+        except OSError as e:
+            self.log_message(f"[#{job.id}] Could not link {os.path.basename(source)}: {e}")
+            return False
+        job.library.add_file(target)
+        return True
+
+    def _check_duplicate(self, job, path):
+        # Downloads whose track was only known once the file existed (single
+        # videos, Spotify) are replaced by a hard link to the earlier copy
+        duplicates = job.library.add_file(path)
+        if not duplicates:
+            return
+        suffix = os.path.splitext(path)[1].lower()
+        same_format = [d for d in duplicates if os.path.splitext(d)[1].lower() == suffix]
+        if self.duplicates != "link" or not same_format:
+            self.log_message(f"[#{job.id}] {os.path.basename(path)} is already in the library as {os.path.relpath(duplicates[0], job.library.folder)}")
+            return
+        temp_path = path + ".link"
+        try:
+            os.link(same_format[0], temp_path)
+            os.replace(temp_path, path)
+        except OSError as e:
+            try: os.unlink(temp_path)
+            except OSError: pass
+            self.log_message(f"[#{job.id}] Could not link {os.path.basename(path)}: {e}")
+            return
+        job.library.add_file(path)
+        self.log_message(f"[#{job.id}] Linked {os.path.basename(path)} to {os.path.relpath(same_format[0], job.library.folder)}")
+
+    def _run_spotify(self, link, path, job):
+        track_id = spotify_track_id(link)
+        if job.archive and track_id and job.archive.contains("spotify", track_id):
+            self.log_message(f"[#{job.id}] Already downloaded, skipping")
+            return
+        if self.spotify_sync and job.link_type != "spotify_track":
+            self._sync_spotify(link, path, job)
+        else:
+            job.metrics.enter("downloading")
+            self._download_spotify(link, path, job)
+        if job.library and not job.cancel_requested:
+            # spotdl picks the file names, so the new files are found by rescanning
+            folder = os.path.abspath(path) + os.sep
+            for new_path in job.library.refresh():
+                if new_path.startswith(folder):
+                    self._check_duplicate(job, new_path)
+        self._check_failures(job)
+
+    def _download_spotify(self, query, path, job, on_source=None):
+        # query is a link or a .spotdl file of already resolved tracks
+        cmd = ["spotdl", "download", query, "--output", path]
+        cmd += OUTPUT_PROFILES[self.output_profile]["spotdl"]
+        if self.ffmpeg_path and self.ffmpeg_path != "ffmpeg":
+            cmd += ["--ffmpeg", self.ffmpeg_path]
+
+        errors = {}
+
+        def on_line(line):
+            m = SPOTDL_ERROR_RE.match(line)
+            if m:
+                errors[m.group("song") or line] = item_error(line)
+                return
+            m = SPOTDL_FOUND_RE.search(line)
+            if m:
+                # A sync already counted the whole list
+                if on_source is None:
+                    job.set_items(int(m.group(1)))
+                    self._on_job_update(job)
+                return
+            m = SPOTDL_TRACK_RE.match(line)
+            if m:
+                key = m.group("downloaded") or m.group("skipped")
+                if on_source and m.group("source"):
+                    on_source(key, m.group("source"))
+                self._track_item(job, key, "done")
+                job.update_item(key, 1.0)
+                self._on_job_update(job)
+
+        def run(archive_file):
+            # Tracks already downloaded are in the archive, so a rerun only retries the failed ones
+            for attempt in range(RETRY_ATTEMPTS):
+                transient = [key for key, error in errors.items() if not isinstance(error, UnavailableError)]
+                if attempt and not self._back_off(job, attempt, transient):
+                    return
+                errors.clear()
+                # spotdl's threads each download from the audio host, so the
+                # lease covers all of them; it is given back while backing off
+                lease = self.scheduler.acquire(job, DOWNLOAD_HOSTS["spotify"], max(1, self.track_workers["spotify"]))
+                if lease is None:
+                    return
+                leased_cmd = cmd + ["--threads", str(lease.connections)]
+                if lease.rate:
+                    leased_cmd += ["--yt-dlp-args", f"--limit-rate {max(MIN_RATE, lease.rate // lease.connections)}"]
+                try:
+                    self._run_backend(leased_cmd, job, "--archive", archive_file, on_line)
+                except BackendError as e:
+                    errors.setdefault(job.link, e)
+                finally:
+                    self.scheduler.release(lease)
+                if job.cancel_requested or all(isinstance(e, UnavailableError) for e in errors.values()):
+                    break
+            for key, error in errors.items():
+                self._item_failed(job, key, error)
+
+        self._run_archived(job, "spotdl", run)
+
+    def _save_spotify_list(self, link, job):
+        # Track metadata of a playlist, album or artist without matching
+        # anything to YouTube yet; None if spotdl couldn't resolve it
+        fd, save_file = tempfile.mkstemp(prefix="earbound-", suffix=".spotdl")
+        os.close(fd)
+        try:
+            self._run_process(["spotdl", "save", link, "--save-file", save_file], job)
+            songs = read_json(save_file)
+        except BackendError as e:
+            self.log_message(f"[#{job.id}] Could not resolve the track list: {e}")
+            return None
+        finally:
+            remove_temp_file(save_file)
+        songs = [song for song in songs if isinstance(song, dict) and song.get("song_id")] if isinstance(songs, list) else []
+        # Lists are never empty on Spotify; no tracks means the output wasn't understood
+        if not songs:
+            self.log_message(f"[#{job.id}] Could not resolve the track list: spotdl returned no tracks")
+            return None
+        return songs
+
+    def _sync_spotify(self, link, path, job):
+        canonical = canonicalize_link(link)
+        list_id = f"{canonical.kind}:{canonical.id}"
+        songs = self._save_spotify_list(canonical.url, job)
+        if songs is None or job.cancel_requested:
+            if not job.cancel_requested:
+                self.log_message(f"[#{job.id}] Downloading without sync")
+                job.metrics.enter("downloading")
+                self._download_spotify(link, path, job)
+            return
+        sync = self._get_sync(path)
+        previous = sync.tracks(list_id)
+        matches = sync.matches([song["song_id"] for song in songs])
+        before = sync.audio_files()
+        found, pending = [], []
+        for song in songs:
+            song_id = song["song_id"]
+            file, source = matches.get(song_id, (None, None))
+            if not (file and file in before):
+                file = self._song_file(song, before, path)
+            if file or (job.archive and job.archive.contains("spotify", song_id)):
+                found.append((song, file, None))
+            else:
+                # A stored match spares spotdl the YouTube search
+                if source and not song.get("download_url"):
+                    song["download_url"] = source
+                pending.append(song)
+        song_ids = [song["song_id"] for song in songs]
+        job.set_items(len(songs), done=[f"spotify:{song['song_id']}" for song, file, source in found])
+        self._on_job_update(job)
+        trusted = True
+        if previous is None:
+            self.log_message(f"[#{job.id}] First sync: {len(songs)} tracks, {len(pending)} to download")
+        else:
+            added = sum(song_id not in previous for song_id in song_ids)
+            removed = len(previous - set(song_ids))
+            self.log_message(f"[#{job.id}] {added} track(s) added and {removed} removed since the last sync, {len(pending)} to download")
+            # Losing most of a list at once is far more likely a bad resolution
+            # than a real edit, and pruning it would delete the files
+            if removed > len(previous) * SYNC_MAX_REMOVED:
+                trusted = False
+                self.log_message(f"[#{job.id}] Could not resolve the track list reliably ({removed} of {len(previous)} tracks missing), "
+                                 f"keeping the last sync")
+
+        sources = {}
+
+        def on_source(name, url):
+            sources[name.casefold()] = url
+
+        if pending:
+            fd, batch = tempfile.mkstemp(prefix="earbound-", suffix=".spotdl")
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(pending, f)
+            job.metrics.enter("downloading")
+            try:
+                self._download_spotify(batch, path, job, on_source)
+            finally:
+                remove_temp_file(batch)
+            after = sync.audio_files()
+            written = {name for name, stat in after.items() if before.get(name) != stat}
+            for song in pending:
+                source = sources.get(spotdl_display_name(song).casefold()) or sources.get(spotdl_file_stem(song).casefold())
+                found.append((song, self._song_file(song, after, path, written), source or song.get("download_url")))
+        sync.save_matches(found)
+        if job.cancel_requested or not trusted:
+            return
+        sync.save_list(list_id, canonical.url, song_ids)
+        if self.prune_removed:
+            self._prune_spotify(job, sync, list_id, path)
+
+    def _song_file(self, song, files, path, written=()):
+        # The file spotdl saved the song as. One this run didn't write may be
+        # an older download of another song, so its length must agree too.
+        stem = spotdl_file_stem(song).casefold()
+        for file in files:
+            if os.path.splitext(file)[0].casefold() != stem:
+                continue
+            if file in written:
+                return file
+            duration = read_track_tags(os.path.join(path, file), load_mutagen())[2]
+            if duration is not None and song.get("duration") is not None and abs(duration - song["duration"]) <= DURATION_TOLERANCE:
+                return file
+        return None
+
+    def _prune_spotify(self, job, sync, list_id, path):
+        # Files still used by another synced list are kept, and so is one
+        # that isn't named after the track, whoever it belongs to
+        pruned = 0
+        for song_id, file, name, artists in sync.removed(list_id):
+            if sync.in_use(song_id, file):
+                sync.forget(list_id, song_id)
+                continue
+            if file and os.path.splitext(file)[0].casefold() == spotdl_file_stem({"name": name, "artists": [artists]}).casefold():
+                try:
+                    os.unlink(os.path.join(path, file))
+                    pruned += 1
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    self.log_message(f"[#{job.id}] Could not remove {file}: {e}")
+                    continue
+            # Forgotten by the archive too, so the track downloads again if it comes back
+            if job.archive:
+                job.archive.remove("spotify", song_id)
+            sync.forget(list_id, song_id)
+        if pruned:
+            self.log_message(f"[#{job.id}] Removed {pruned} file(s) of tracks no longer in the list")
+
+    def _run_youtube(self, link, path, job):
+        video_id = youtube_video_id(link) if job.link_type == "youtube_video" else None
+        if job.archive and video_id and job.archive.contains("youtube", video_id):
+            self.log_message(f"[#{job.id}] Already downloaded, skipping")
+            return
+        items = [(video_id, link)]
+        info = self._get_playlist_info(link) if job.link_type == "youtube_playlist" else None
+        if info and info["entries"]:
+            # Download the already extracted entries so yt-dlp doesn't walk the playlist again
+            entries = info["entries"]
+            done = [e.get("id") or e["url"] for e in entries if self._item_done(job, e)]
+            pending = [e for e in entries if not self._item_done(job, e)]
+            owned = self._owned_entries(job, pending, path) if job.library else []
+            if owned:
+                pending = [e for e in pending if e not in owned]
+            items = [(e.get("id"), e["url"]) for e in pending]
+            job.set_items(len(entries), done + [e.get("id") or e["url"] for e in owned])
+            if job.journal_id is not None:
+                self.journal.add_items(job.journal_id, [e.get("id") or e["url"] for e in pending], "pending")
+            self._on_job_update(job)
+            if done:
+                self.log_message(f"[#{job.id}] {len(done)} of {len(entries)} tracks already downloaded")
+            if owned:
+                action = "linked" if self.duplicates == "link" else "skipped"
+                self.log_message(f"[#{job.id}] {len(owned)} of {len(entries)} tracks already in the library, {action}")
+            if not items:
+                return
+        workers = max(1, min(self.track_workers["youtube"], len(items)))
+        chunks = [items[i::workers] for i in range(workers)]
+        profile = OUTPUT_PROFILES[self.output_profile]
+        conversions = []
+        finished = set()
+
+        def on_file(extractor, item_id, acodec, filepath):
+            # Download stage done; conversion runs in the shared pool while the next track downloads
+            item = {"source": extractor.lower(), "id": item_id, "acodec": acodec, "path": filepath}
+            finished.add(item_id)
+            job.metrics.track(item_id, "waiting")
+            conversions.append((item_id, self._get_convert_pool(job.priority).submit(self._convert_item, job, item, profile)))
+
+        yt_dlp = load_yt_dlp() if self.use_inprocess else None
+        if yt_dlp:
+            attempt = lambda archive_file: self._leased(
+                job, lambda urls, lease: self._run_youtube_inprocess(yt_dlp, urls, path, job, archive_file, profile, on_file, lease))
+        else:
+            cmd = ["yt-dlp", "--format", profile["format"], "--output", f"{path}/%(title)s.%(ext)s", "--ignore-errors",
+                   "--newline", "--progress", "--progress-template", YTDLP_PROGRESS_TEMPLATE, "--print", YTDLP_FILE_TEMPLATE]
+            if self.ffmpeg_path and self.ffmpeg_path != "ffmpeg":
+                cmd += ["--ffmpeg-location", self.ffmpeg_path]
+
+            def on_line(line):
+                if line.startswith(YTDLP_FILE_PREFIX):
+                    fields = line[len(YTDLP_FILE_PREFIX):].split("|", 3)
+                    if len(fields) == 4:
+                        on_file(*fields)
+
+            attempt = lambda archive_file: self._leased(
+                job, lambda urls, lease: self._run_youtube_batch(cmd, urls, job, archive_file, on_line, lease))
+        run = lambda archive_file: self._fan_out(chunks, lambda chunk: self._retry_items(job, chunk, finished, attempt(archive_file)))
+        job.metrics.enter("downloading")
+        try:
+            self._run_archived(job, "yt-dlp", run, record=False)
+        finally:
+            # Only conversions still running once the last download is done are left to wait for
+            job.metrics.enter("converting")
+            wait([future for key, future in conversions])
+        for key, future in conversions:
+            if future.exception() is not None:
+                self._item_failed(job, key, future.exception())
+        self._check_failures(job)
+
+    def _retry_items(self, job, items, finished, run):
+        # Runs a chunk of (key, url) items, then again with only the ones that
+        # failed for a transient reason, backing off between attempts
+        for attempt in range(RETRY_ATTEMPTS):
+            if attempt and not self._back_off(job, attempt, [key for key, url in items]):
+                return
+            try:
+                returncode = run([url for key, url in items])
+                error = BackendError(f"yt-dlp exited with code {returncode}") if returncode else None
+            except StallError as e:
+                self.log_message(f"[#{job.id}] {e}, stopped it")
+                job.item_errors.add(job.item_errors.current(), e)
+                error = e
+            if job.cancel_requested:
+                return
+            retry = []
+            for key, url in items:
+                if key in finished or (key is None and error is None):
+                    continue
+                failure = job.item_errors.pop(key) or error or BackendError("yt-dlp finished without a file")
+                if isinstance(failure, UnavailableError) or attempt == RETRY_ATTEMPTS - 1:
+                    self._item_failed(job, key or url, failure)
+                else:
+                    retry.append((key, url))
+            items = retry
+            if not items:
+                return
+
+    def _back_off(self, job, attempt, keys):
+        delay = retry_delay(attempt - 1)
+        self.log_message(f"[#{job.id}] Retrying {len(keys)} track(s) in {delay:.1f}s (attempt {attempt + 1} of {RETRY_ATTEMPTS})")
+        for key in keys:
+            job.metrics.retry(key)
+        deadline = time.monotonic() + delay
+        while time.monotonic() < deadline:
+            if job.cancel_requested:
+                return False
+            time.sleep(min(0.2, max(0.0, deadline - time.monotonic())))
+        return not job.cancel_requested
+
+    def _item_failed(self, job, key, error):
+        job.failed_items[key] = error
+        self._track_item(job, key, "failed", error=error)
+        self.log_message(f"[#{job.id}] Failed: {key}: {error}")
+
+    def _check_failures(self, job):
+        # Failed tracks are reported on the job, which only fails as a whole if nothing else got through
+        if not job.failed_items or job.cancel_requested:
+            return
+        errors = list(job.failed_items.values())
+        if job.items_done == 0:
+            raise errors[0] if len(errors) == 1 else ItemsFailed(job.failed_items)
+        job.error = str(ItemsFailed(job.failed_items))
+
+    def _get_convert_pool(self, priority=PRIORITY_NORMAL):
+        # High priority jobs convert in a pool of their own, so their tracks
+        # don't queue behind every track of a running playlist
+        lane = PRIORITY_HIGH if priority >= PRIORITY_HIGH else PRIORITY_NORMAL
+        with self._convert_pool_lock:
+            if lane not in self._convert_pools:
+                workers = PRIORITY_EXTRA_SLOTS if lane == PRIORITY_HIGH else os.cpu_count() or 2
+                self._convert_pools[lane] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="convert")
+            return self._convert_pools[lane]
+
+    def _convert_item(self, job, item, profile):
+        if job.cancel_requested:
+            return
+        ffmpeg = self.ffmpeg_path or "ffmpeg"
+        cmd, temp_path, target = transcode_command(ffmpeg, item["path"], item["acodec"], profile)
+        if cmd is not None:
+            self._track_item(job, item["id"], "converting", temp_path)
+            self.log_message(f"[#{job.id}] Converting {os.path.basename(item['path'])}")
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+                                       preexec_fn=os.setsid if os.name != 'nt' else None)
+            job.processes.add(process)
+            try:
+                output = process.communicate()[0]
+            finally:
+                job.processes.discard(process)
+            if job.cancel_requested:
+                try: os.unlink(temp_path)
+                except OSError: pass
+                return
+            if process.returncode != 0:
+                self._item_failed(job, item["id"], ConversionError(f"FFmpeg failed on {os.path.basename(item['path'])}: {output.strip()[-200:]}"))
+                return
+            os.replace(temp_path, target)
+            if target != item["path"]:
+                os.unlink(item["path"])
+        if job.archive and item["id"]:
+            job.archive.add(item["source"], item["id"])
+        if job.library:
+            self._check_duplicate(job, target)
+        self._track_item(job, item["id"], "done", target)
+        job.update_item(item["id"], 1.0)
+        self._on_job_update(job)
+
+    def _leased(self, job, run, host=DOWNLOAD_HOSTS["youtube"]):
+        # Each fan-out chunk holds one connection to the host while it runs
+        def leased(chunk):
+            lease = self.scheduler.acquire(job, host)
+            if lease is None:
+                return
+            try:
+                return run(chunk, lease)
+            finally:
+                self.scheduler.release(lease)
+        return leased
+
+    def _run_youtube_batch(self, cmd, urls, job, archive_file, on_line=None, lease=None):
+        # A subprocess gets its share as it starts; later rebalancing only reaches in-process runs
+        if lease is not None and lease.rate:
+            cmd = cmd + ["--limit-rate", str(lease.rate)]
+        if len(urls) == 1:
+            return self._run_backend(cmd + [urls[0]], job, "--download-archive", archive_file, on_line, check=False)
+        fd, batch_path = tempfile.mkstemp(prefix="earbound-batch-", suffix=".txt")
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write("\n".join(urls) + "\n")
+        try:
+            return self._run_backend(cmd + ["--batch-file", batch_path], job, "--download-archive", archive_file, on_line, check=False)
+        finally:
+            os.unlink(batch_path)
+
+    def _fan_out(self, chunks, run):
+        # Runs every chunk to the end even if one fails, then reports the first failure
+        if len(chunks) == 1:
+            run(chunks[0])
+            return
+        with ThreadPoolExecutor(max_workers=len(chunks)) as pool:
+            futures = [pool.submit(run, chunk) for chunk in chunks]
+        errors = [f.exception() for f in futures if f.exception() is not None]
+        if errors:
+            raise errors[0]
+
+    def _item_done(self, job, entry):
+        return job.item_states.get(entry.get("id") or entry["url"]) == "done" or self._in_archive(job, entry)
+
+    def _in_archive(self, job, entry):
+        if not job.archive or not entry.get("id"):
+            return False
+        return job.archive.contains((entry.get("ie_key") or "youtube").lower(), entry["id"])
+
+    def _run_archived(self, job, tool, run, record=True):
+        if not job.archive:
+            run(None)
+            return
+        archive_file = job.archive.export_file(tool, record)
+        try:
+            run(archive_file)
+        finally:
+            archive_file.close()
+
+    def _run_backend(self, cmd, job, archive_flag, archive_file, on_line=None, check=True):
+        if archive_file is None:
+            return self._run_process(cmd, job, on_line, check)
+
+        def sync_archive(line):
+            archive_file.sync()
+            if on_line:
+                on_line(line)
+
+        return self._run_process(cmd + [archive_flag, archive_file.path], job, sync_archive, check)
+
+    def _run_youtube_inprocess(self, yt_dlp, urls, path, job, archive_file, profile, on_file, lease=None):
+        cancelled = getattr(yt_dlp.utils, "DownloadCancelled", None) or Exception
+
+        def check_cancel(*args, **kwargs):
+            if job.cancel_requested:
+                raise cancelled("Cancelled by user")
+            return None
+
+        def on_progress(d):
+            check_cancel()
+            if lease is not None:
+                # yt-dlp reads the limit from the options dict on every chunk
+                opts["ratelimit"] = lease.rate
+            if d.get("status") != "downloading":
+                return
+            info = d.get("info_dict") or {}
+            total = d.get("total_bytes") or d.get("total_bytes_estimate")
+            if info.get("n_entries") and job.items_total == 1:
+                job.set_items(info["n_entries"])
+            job.speed = d.get("speed")
+            job.eta = d.get("eta")
+            key = info.get("id") or info.get("url")
+            self._track_item(job, key, "downloading", d.get("tmpfilename"))
+            job.metrics.track_bytes(key, d.get("downloaded_bytes"))
+            job.update_item(key, 0.9 * (d.get("downloaded_bytes") or 0) / total if total else 0.0)
+            self._on_job_update(job)
+
+        class HandOff(yt_dlp.postprocessor.PostProcessor):
+            def run(self, info):
+                check_cancel()
+                on_file(info.get("extractor_key") or "youtube", info.get("id"), info.get("acodec"), info["filepath"])
+                return [], info
+
+        opts = {
+            "format": profile["format"],
+            "outtmpl": f"{path}/%(title)s.%(ext)s",
+            "ignoreerrors": True,
+            "noprogress": True,
+            "logger": YtdlpLogger(lambda message: self._backend_message(job, message)),
+            "progress_hooks": [on_progress],
+            "match_filter": check_cancel,
+            # A stalled connection errors out instead of hanging, and is retried like any other failure
+            "socket_timeout": 30,
+        }
+        if self.ffmpeg_path and self.ffmpeg_path != "ffmpeg":
+            opts["ffmpeg_location"] = self.ffmpeg_path
+        if archive_file:
+            opts["download_archive"] = archive_file.path
+        if lease is not None and lease.rate:
+            opts["ratelimit"] = lease.rate
+        retcode = 0
+        try:
+            with yt_dlp.YoutubeDL(opts) as ydl:
+                ydl.add_post_processor(HandOff(ydl), when="after_move")
+                for url in urls:
+                    check_cancel()
+                    retcode = ydl.download([url]) or retcode
+        except cancelled:
+            if job.cancel_requested:
+                return
+            raise
+        finally:
+            job.speed = job.eta = None
+        return retcode
+
+    def _run_process(self, cmd, job, on_line=None, check=True):
+        name = os.path.splitext(os.path.basename(cmd[0]))[0]
+        process = subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            text=True, bufsize=1, preexec_fn=os.setsid if os.name != 'nt' else None
+        )
+        job.processes.add(process)
+        watchdog = StallWatchdog(process, STALL_TIMEOUTS.get(name, 300))
+        try:
+            if job.cancel_requested:
+                kill_process_tree(process)
+            for line in process.stdout:
+                watchdog.touch()
+                if job.cancel_requested: break
+                line = line.strip()
+                if line.startswith(YTDLP_PROGRESS_PREFIX):
+                    self._parse_ytdlp_progress(line, job)
+                    continue
+                if line and not line.startswith(YTDLP_FILE_PREFIX): self._backend_message(job, line)
+                if on_line: on_line(line)
+            process.wait()
+        finally:
+            watchdog.stop()
+            job.processes.discard(process)
+        if watchdog.stalled and not job.cancel_requested:
+            raise StallError(f"{name} made no progress for {watchdog.timeout}s")
+        if check and process.returncode != 0 and not job.cancel_requested:
+            raise BackendError(f"{name} exited with code {process.returncode}")
+        return process.returncode
+
+    def _parse_ytdlp_progress(self, line, job):
+        fields = line[len(YTDLP_PROGRESS_PREFIX):].split("|", 6)
+        if len(fields) != 7:
+            return
+        key, downloaded, total, estimate, speed, eta, temp_path = fields
+        total = parse_number(total) or parse_number(estimate)
+        downloaded = parse_number(downloaded) or 0
+        job.speed = parse_number(speed)
+        job.eta = parse_number(eta)
+        self._track_item(job, key, "downloading", temp_path if temp_path != "NA" else None)
+        job.metrics.track_bytes(key, downloaded)
+        job.update_item(key, 0.9 * downloaded / total if total else 0.0)
+        self._on_job_update(job)
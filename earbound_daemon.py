@@ -0,0 +1,558 @@
+import os
+import sys
+import json
+import time
+import secrets
+import argparse
+import threading
+import subprocess
+import collections
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, urlencode
+
+from earbound_core import (DownloadEngine, DownloadJob, DUPLICATE_MODES, OUTPUT_PROFILES, dedupe_links, default_download_folder,
+                           PRIORITY_HIGH, PRIORITY_NORMAL, get_cache_dir, job_fields, parse_rate, read_json, write_json_atomic)
+
+DAEMON_FILE = "daemon.json"
+TOKEN_HEADER = "X-Earbound-Token"
+FINISHED_KEEP = 200  # Finished jobs the daemon still answers for
+EVENT_BACKLOG = 2000
+PING_INTERVAL = 15
+
+def daemon_file():
+    return get_cache_dir() / DAEMON_FILE
+
+class DaemonError(Exception):
+    pass
+
+class Subscriber:
+    # One event stream. A client that falls too far behind is disconnected
+    # rather than slowing down the engine, and resyncs when it reconnects.
+    def __init__(self, logs=False, capacity=EVENT_BACKLOG):
+        self.logs = logs
+        self.overflowed = False
+        self._events = collections.deque()
+        self._capacity = capacity
+        self._cond = threading.Condition()
+
+    def put(self, record):
+        if record["event"] == "log" and not self.logs:
+            return
+        with self._cond:
+            if len(self._events) >= self._capacity:
+                self.overflowed = True
+            else:
+                self._events.append(record)
+            self._cond.notify()
+
+    def get(self, timeout):
+        # None on overflow, {} when nothing happened within the timeout
+        with self._cond:
+            self._cond.wait_for(lambda: self._events or self.overflowed, timeout)
+            if self.overflowed:
+                return None
+            return self._events.popleft() if self._events else {}
+
+class DaemonEngine(DownloadEngine):
+    PROGRESS_INTERVAL = 0.5
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.started_at = time.time()
+        self.tools = {}
+        self._subscribers = set()
+        self._subscribers_lock = threading.Lock()
+        self._last_event = {}
+
+    def subscribe(self, logs=False):
+        subscriber = Subscriber(logs)
+        with self._subscribers_lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._subscribers_lock:
+            self._subscribers.discard(subscriber)
+
+    def publish(self, event, **fields):
+        record = dict(event=event, time=round(time.time(), 3), **fields)
+        with self._subscribers_lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            subscriber.put(record)
+
+    def log_message(self, message):
+        super().log_message(message)
+        self.publish("log", message=message)
+
+    def job_state(self, job, tracks=False):
+        return dict(job_fields(job), folder=job.folder, metrics=job.metrics.snapshot(tracks=tracks))
+
+    def _on_job_update(self, job):
+        # Same throttling as the CLI: status changes always, progress twice a second
+        now = time.monotonic()
+        last_status, last_time = self._last_event.get(job.id, (None, 0))
+        if job.status == last_status and now - last_time < self.PROGRESS_INTERVAL:
+            return
+        self.publish("job", **self.job_state(job))
+        if job.finished:
+            # A finished job sends nothing more, so it needs no throttling state
+            self._last_event.pop(job.id, None)
+            self.job_queue.remove_finished(keep=FINISHED_KEEP)
+        else:
+            self._last_event[job.id] = (job.status, now)
+
+    def submit(self, links, folder, priority=None):
+        queued, invalid, duplicates = dedupe_links(links)
+        # A link already queued or downloading into the same folder isn't started again
+        active = {(job.link, job.folder) for job in list(self.job_queue.jobs.values()) if not job.finished}
+        jobs = []
+        for link in queued:
+            if (link.url, folder) in active:
+                duplicates += 1
+                continue
+            jobs.append(self.job_queue.submit(link.url, link.link_type, folder, priority=priority))
+        return jobs, invalid, duplicates
+
+    def settings(self):
+        return {
+            "max_workers": self.job_queue.max_workers,
+            "track_workers": dict(self.track_workers),
+            "output_profile": self.output_profile,
+            "rate_limit": self.scheduler.rate_limit,
+            "connections": self.scheduler.host_limits.get("youtube"),
+            "duplicates": self.duplicates,
+            "use_inprocess": self.use_inprocess,
+            "spotify_sync": self.spotify_sync,
+            "prune_removed": self.prune_removed,
+        }
+
+    def apply_settings(self, values):
+        # Validates everything before changing anything
+        if "output_profile" in values and values["output_profile"] not in OUTPUT_PROFILES:
+            raise ValueError(f"unknown output profile: {values['output_profile']}")
+        if "duplicates" in values and values["duplicates"] not in DUPLICATE_MODES:
+            raise ValueError(f"unknown duplicates mode: {values['duplicates']}")
+        rate_limit = parse_rate(values["rate_limit"]) if "rate_limit" in values else None
+        track_workers = {source: max(1, int(count)) for source, count in (values.get("track_workers") or {}).items()
+                         if source in self.track_workers}
+        max_workers = int(values["max_workers"]) if "max_workers" in values else None
+        connections = int(values["connections"]) if "connections" in values else None
+
+        if max_workers is not None:
+            self.job_queue.set_max_workers(max_workers)
+        self.track_workers.update(track_workers)
+        if "rate_limit" in values:
+            self.scheduler.set_rate_limit(rate_limit)
+        if connections is not None:
+            self.scheduler.set_host_limit("youtube", connections)
+        for name in ("output_profile", "duplicates"):
+            if name in values:
+                setattr(self, name, values[name])
+        for name in ("use_inprocess", "spotify_sync", "prune_removed"):
+            if name in values:
+                setattr(self, name, bool(values[name]))
+        return self.settings()
+
+class DaemonHandler(BaseHTTPRequestHandler):
+    # GET  /status, /jobs, /jobs/<id>, /metrics[?format=json], /events[?logs=1]
+    # POST /jobs, /jobs/<id>/cancel, /cancel, /settings, /shutdown
+    server_version = "Earbound"
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def log_message(self, format, *args):
+        pass
+
+    def _dispatch(self, method):
+        engine = self.server.engine
+        if not secrets.compare_digest(self.headers.get(TOKEN_HEADER, ""), self.server.token):
+            self._send(401, {"error": "missing or wrong token"})
+            return
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        route = [part for part in url.path.split("/") if part]
+        try:
+            body = self._read_body() if method == "POST" else {}
+            if method == "GET" and route == ["status"]:
+                self._send(200, self._status())
+            elif method == "GET" and route == ["events"]:
+                self._stream_events(query.get("logs") == ["1"])
+            elif method == "GET" and route == ["jobs"]:
+                self._send(200, {"jobs": [engine.job_state(job) for job in list(engine.job_queue.jobs.values())]})
+            elif method == "GET" and len(route) == 2 and route[0] == "jobs":
+                job = engine.job_queue.jobs.get(int(route[1]))
+                if job is None:
+                    self._send(404, {"error": "no such job"})
+                else:
+                    self._send(200, engine.job_state(job, tracks=True))
+            elif method == "GET" and route == ["metrics"]:
+                if query.get("format") == ["json"]:
+                    self._send(200, engine.metrics.snapshot())
+                else:
+                    self._send_text(200, engine.metrics.prometheus(), "text/plain; version=0.0.4")
+            elif method == "POST" and route == ["jobs"]:
+                self._submit(body)
+            elif method == "POST" and len(route) == 3 and route[0] == "jobs" and route[2] == "cancel":
+                self._send(200, {"cancelled": engine.job_queue.cancel(int(route[1]))})
+            elif method == "POST" and route == ["cancel"]:
+                engine.job_queue.cancel_all()
+                self._send(200, {"cancelled": True})
+            elif method == "POST" and route == ["settings"]:
+                self._send(200, engine.apply_settings(body))
+            elif method == "POST" and route == ["shutdown"]:
+                if engine.job_queue.is_busy() and not body.get("force"):
+                    self._send(409, {"error": "downloads are running"})
+                    return
+                engine.job_queue.cancel_all()
+                self._send(200, {"stopping": True})
+                threading.Thread(target=self.server.shutdown, daemon=True).start()
+            else:
+                self._send(404, {"error": "not found"})
+        except (ValueError, TypeError, KeyError) as e:
+            self._send(400, {"error": str(e)})
+
+    def _status(self):
+        engine = self.server.engine
+        jobs = list(engine.job_queue.jobs.values())
+        counts = collections.Counter(job.status for job in jobs)
+        return {"pid": os.getpid(), "started_at": engine.started_at, "ready": engine.deps_ready.is_set(), "tools": engine.tools,
+                "settings": engine.settings(), "jobs": dict(counts), "busy": engine.job_queue.is_busy()}
+
+    def _submit(self, body):
+        links = body["links"]
+        if isinstance(links, str):
+            links = links.split()
+        priority = body.get("priority")
+        if priority is not None and (isinstance(priority, bool) or priority not in (PRIORITY_HIGH, PRIORITY_NORMAL)):
+            raise ValueError(f"priority must be {PRIORITY_HIGH}, {PRIORITY_NORMAL} or null")
+        folder = os.path.abspath(body.get("folder") or self.server.folder)
+        os.makedirs(folder, exist_ok=True)
+        jobs, invalid, duplicates = self.server.engine.submit(links, folder, priority)
+        self._send(200, {"jobs": [self.server.engine.job_state(job) for job in jobs],
+                         "invalid": [{"link": link, "error": reason} for link, reason in invalid],
+                         "duplicates": duplicates})
+
+    def _stream_events(self, logs):
+        # Newline-delimited JSON until the client goes away. It starts with
+        # the current state of every job, flagged as a snapshot.
+        engine = self.server.engine
+        subscriber = engine.subscribe(logs)
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            for job in list(engine.job_queue.jobs.values()):
+                self._write_event(dict(event="job", time=round(time.time(), 3), snapshot=True, **engine.job_state(job)))
+            while True:
+                record = subscriber.get(PING_INTERVAL)
+                if record is None:
+                    break
+                self._write_event(record or {"event": "ping", "time": round(time.time(), 3)})
+        except OSError:
+            pass
+        finally:
+            engine.unsubscribe(subscriber)
+            self.close_connection = True
+
+    def _write_event(self, record):
+        self.wfile.write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b"\n")
+        self.wfile.flush()
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        body = json.loads(self.rfile.read(length).decode('utf-8'))
+        if not isinstance(body, dict):
+            raise ValueError("expected a JSON object")
+        return body
+
+    def _send(self, code, data):
+        self._send_text(code, json.dumps(data, ensure_ascii=False), "application/json")
+
+    def _send_text(self, code, text, content_type):
+        payload = text.encode('utf-8')
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+class DaemonServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, engine, folder, port=0):
+        super().__init__(("127.0.0.1", port), DaemonHandler)
+        self.engine = engine
+        self.folder = folder
+        self.token = secrets.token_urlsafe(32)
+
+class DaemonClient:
+    # The daemon's address and token are in daemon.json in the cache
+    # folder, which only the user running it can read
+    def __init__(self, port, token, timeout=10):
+        self.port = port
+        self.token = token
+        self.timeout = timeout
+
+    @classmethod
+    def find(cls):
+        info = read_json(daemon_file())
+        if not info or "port" not in info or "token" not in info:
+            return None
+        client = cls(info["port"], info["token"])
+        try:
+            client.status()
+        except DaemonError:
+            return None
+        return client
+
+    def request(self, method, path, body=None):
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=self.timeout)
+        try:
+            payload = json.dumps(body).encode('utf-8') if body is not None else None
+            headers = {TOKEN_HEADER: self.token, "Content-Type": "application/json"}
+            conn.request(method, path, body=payload, headers=headers)
+            response = conn.getresponse()
+            data = response.read().decode('utf-8')
+        except (OSError, http.client.HTTPException) as e:
+            raise DaemonError(f"daemon not reachable: {e}")
+        finally:
+            conn.close()
+        if response.getheader("Content-Type", "").startswith("application/json"):
+            data = json.loads(data)
+        if response.status != 200:
+            raise DaemonError(data.get("error") if isinstance(data, dict) else data)
+        return data
+
+    def status(self):
+        return self.request("GET", "/status")
+
+    def jobs(self):
+        return self.request("GET", "/jobs")["jobs"]
+
+    def job(self, job_id):
+        return self.request("GET", f"/jobs/{job_id}")
+
+    def submit(self, links, folder=None, priority=None):
+        return self.request("POST", "/jobs", {"links": links, "folder": folder, "priority": priority})
+
+    def cancel(self, job_id=None):
+        if job_id is None:
+            return self.request("POST", "/cancel", {})["cancelled"]
+        return self.request("POST", f"/jobs/{job_id}/cancel", {})["cancelled"]
+
+    def settings(self, **values):
+        return self.request("POST", "/settings", values)
+
+    def metrics(self, fmt="prometheus"):
+        return self.request("GET", "/metrics?" + urlencode({"format": fmt}))
+
+    def shutdown(self, force=False):
+        return self.request("POST", "/shutdown", {"force": force})
+
+    def events(self, logs=False):
+        # Connects right away so nothing published after this call is missed
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=PING_INTERVAL * 3)
+        try:
+            conn.request("GET", "/events" + ("?logs=1" if logs else ""), headers={TOKEN_HEADER: self.token})
+            response = conn.getresponse()
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            raise DaemonError(f"daemon not reachable: {e}")
+        if response.status != 200:
+            conn.close()
+            raise DaemonError(f"event stream refused ({response.status})")
+        return self._read_events(conn, response)
+
+    def _read_events(self, conn, response):
+        try:
+            for line in response:
+                if line.strip():
+                    yield json.loads(line.decode('utf-8'))
+        except (OSError, http.client.HTTPException, ValueError):
+            pass
+        finally:
+            conn.close()
+
+def start_daemon(args=(), timeout=30):
+    # Starts a detached daemon and waits until it answers
+    cmd = [sys.executable, os.path.abspath(__file__)] + list(args)
+    if os.name == 'nt':
+        flags = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+        subprocess.Popen(cmd, creationflags=flags, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    else:
+        subprocess.Popen(cmd, start_new_session=True, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        client = DaemonClient.find()
+        if client:
+            return client
+        time.sleep(0.2)
+    raise DaemonError("daemon did not start, see its log in the cache folder")
+
+class RemoteJob:
+    # A daemon job rebuilt from its events, with the attributes the GUI reads from DownloadJob
+    FINISHED = DownloadJob.FINISHED
+
+    def __init__(self, fields):
+        self.update(fields)
+
+    def update(self, fields):
+        self.id = fields["id"]
+        self.link = fields["link"]
+        self.link_type = fields["type"]
+        self.folder = fields.get("folder")
+        self.status = fields["status"]
+        self.progress = fields["progress"]
+        self.items_total = fields.get("items_total", 1)
+        self.items_done = fields.get("items_done", 1 if self.status == "done" else 0)
+        self.speed = fields.get("speed")
+        self.eta = fields.get("eta")
+        self.error = fields.get("error")
+        self.failed_items = {item["id"]: item["error"] for item in fields.get("failed_items", [])}
+        self.metrics = RemoteMetrics(fields.get("metrics"))
+
+    @property
+    def finished(self):
+        return self.status in self.FINISHED
+
+class RemoteMetrics:
+    def __init__(self, snapshot):
+        self._snapshot = snapshot or {"elapsed": 0.0, "track_stages": {}, "bytes": 0, "throughput": None, "retries": 0}
+
+    def snapshot(self, tracks=True):
+        return self._snapshot
+
+class RemoteJobQueue:
+    # Stands in for JobQueue when the GUI is a client of a daemon. Job
+    # state comes from the daemon's event stream, on a background thread.
+    def __init__(self, client, on_update=None, on_log=None):
+        self.client = client
+        self.on_update = on_update
+        self.on_log = on_log
+        self.max_workers = client.status()["settings"]["max_workers"]
+        self.jobs = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._connected = threading.Event()
+        threading.Thread(target=self._listen, daemon=True, name="daemon-events").start()
+        self._connected.wait(5)
+
+    def submit(self, link, link_type, folder, journal_id=None, priority=None):
+        result = self.client.submit([link], folder, priority)
+        if not result["jobs"]:
+            return None
+        return self._update(result["jobs"][0])
+
+    def set_max_workers(self, count):
+        self.max_workers = self.client.settings(max_workers=count)["max_workers"]
+
+    def cancel(self, job_id):
+        return self.client.cancel(job_id)
+
+    def cancel_all(self):
+        self.client.cancel()
+
+    def remove_finished(self, keep=0):
+        with self._lock:
+            finished = [j.id for j in self.jobs.values() if j.finished]
+            for job_id in finished[:len(finished) - keep]:
+                del self.jobs[job_id]
+
+    def is_busy(self):
+        with self._lock:
+            return any(not job.finished for job in self.jobs.values())
+
+    def _update(self, fields):
+        with self._lock:
+            job = self.jobs.get(fields["id"])
+            if job is None:
+                job = self.jobs[fields["id"]] = RemoteJob(fields)
+            else:
+                job.update(fields)
+        if self.on_update:
+            self.on_update(job)
+        return job
+
+    def _listen(self):
+        while True:
+            try:
+                events = self.client.events(logs=True)
+            except DaemonError as e:
+                self._log(f"Lost the daemon: {e}")
+                time.sleep(2)
+                continue
+            self._connected.set()
+            for event in events:
+                if event["event"] == "log":
+                    self._log(event["message"])
+                elif event["event"] == "job":
+                    # Jobs that finished before this client connected aren't replayed
+                    if event.get("snapshot") and event["status"] in RemoteJob.FINISHED and event["id"] not in self.jobs:
+                        continue
+                    self._update(event)
+            time.sleep(0.5)
+
+    def _log(self, message):
+        if self.on_log:
+            self.on_log(message)
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="earbound-daemon",
+        description="Runs Earbound as a background service with a local HTTP API. The GUI and `earbound_cli.py --daemon` use it when it is running.",
+    )
+    parser.add_argument("--port", type=int, default=0, help="port on 127.0.0.1 (default: any free port)")
+    parser.add_argument("-o", "--output", default=None, help="default download folder for submissions without one")
+    parser.add_argument("-j", "--jobs", type=int, default=2, help="links downloaded at once (default: 2)")
+    parser.add_argument("-f", "--format", choices=list(OUTPUT_PROFILES), default="mp3", help="output profile (default: mp3)")
+    parser.add_argument("--limit-rate", type=parse_rate, metavar="RATE", help="total download speed, e.g. 500K or 2M (default: unlimited)")
+    parser.add_argument("--duplicates", choices=list(DUPLICATE_MODES), default="keep", help="tracks already in the download folder (default: keep)")
+    parser.add_argument("--no-sync", action="store_true", help="resolve Spotify playlists from scratch on every download")
+    parser.add_argument("--prune", action="store_true", help="delete files of tracks removed from a synced Spotify playlist")
+    parser.add_argument("--resume", action="store_true", help="resume downloads left unfinished by a cancel or crash")
+    parser.add_argument("--no-install", action="store_true", help="don't install missing dependencies")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if DaemonClient.find():
+        print("earbound-daemon: already running", file=sys.stderr)
+        return 1
+    engine = DaemonEngine(max_workers=args.jobs, output_profile=args.format, rate_limit=args.limit_rate, duplicates=args.duplicates,
+                          spotify_sync=not args.no_sync, prune_removed=args.prune)
+    engine.log_pipeline.enable_file(get_cache_dir() / "logs" / "daemon.log")
+    server = DaemonServer(engine, os.path.abspath(args.output or default_download_folder()), args.port)
+    path = daemon_file()
+    write_json_atomic(path, {"pid": os.getpid(), "port": server.server_address[1], "token": server.token})
+    engine.log_message(f"Listening on 127.0.0.1:{server.server_address[1]}")
+
+    # Announced before dependencies are checked, which may mean installing
+    # them, so clients connect at once; jobs wait for deps_ready
+    def prepare():
+        found = engine.check_dependencies(install=not args.no_install)
+        engine.tools = {name: info["version"] for name, info in found.items()}
+        if args.resume:
+            engine.resume_jobs(engine.resumable_jobs())
+
+    threading.Thread(target=prepare, daemon=True).start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        engine.job_queue.cancel_all()
+    finally:
+        server.server_close()
+        if (read_json(path) or {}).get("pid") == os.getpid():
+            try: os.unlink(path)
+            except OSError: pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
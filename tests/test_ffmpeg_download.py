@@ -0,0 +1,188 @@
+import io
+import os
+import json
+import shutil
+import hashlib
+import tarfile
+import zipfile
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from earbound_core import download_ffmpeg
+
+FFMPEG = os.urandom(300 * 1024)
+
+class ArchiveHandler(BaseHTTPRequestHandler):
+    # Serves server.files with Range support; a path in server.cut sends
+    # only that many bytes of its first response, then drops the connection.
+    # With server.bad_range set, ranged requests get the whole file as a 206.
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get("Range")))
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        start = 0
+        range_header = self.headers.get("Range")
+        if range_header:
+            start = 0 if self.server.bad_range else int(range_header.split("=")[1].split("-")[0])
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data) - start))
+        self.send_header("ETag", '"v1"')
+        self.end_headers()
+        cut = self.server.cut.pop(self.path, None)
+        self.wfile.write(data[start:cut] if cut else data[start:])
+        if cut:
+            self.wfile.flush()
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+class NonSeekable(io.RawIOBase):
+    # zipfile falls back to data descriptors when it can't seek back
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        return len(data)
+
+def tar_xz():
+    out = io.BytesIO()
+    with tarfile.open(fileobj=out, mode="w:xz") as tar:
+        for name, data in (("ffmpeg-7.0-static/readme.txt", b"static build"), ("ffmpeg-7.0-static/ffmpeg", FFMPEG)):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return out.getvalue()
+
+def zip_archive(descriptor=False):
+    out = NonSeekable() if descriptor else io.BytesIO()
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("LICENSE", b"license text")
+        if descriptor:
+            with archive.open("ffmpeg", "w") as f:
+                f.write(FFMPEG)
+        else:
+            archive.writestr("ffmpeg", FFMPEG)
+    return bytes(out.buffer) if descriptor else out.getvalue()
+
+class DownloadFfmpegTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), ArchiveHandler)
+        self.server.files = {}
+        self.server.cut = {}
+        self.server.bad_range = False
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.work = tempfile.mkdtemp()
+        self.dest = os.path.join(self.work, "bin", "ffmpeg")
+        self.log = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.work, ignore_errors=True)
+
+    def serve(self, name, data, checksum=None):
+        self.server.files["/" + name] = data
+        self.server.files["/" + name + ".sha256"] = ((checksum or hashlib.sha256(data).hexdigest()) + "  " + name).encode()
+        return self.base + "/" + name, self.base + "/" + name + ".sha256"
+
+    def download(self, url, checksum_url, attempts=3):
+        return download_ffmpeg(url, checksum_url, self.dest, self.work, self.log.append, attempts)
+
+    def assert_installed(self):
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), FFMPEG)
+        if os.name != 'nt':
+            self.assertTrue(os.access(self.dest, os.X_OK))
+        self.assertEqual([name for name in os.listdir(self.work) if name != "bin"], [])
+
+    def test_tar_xz(self):
+        self.download(*self.serve("ffmpeg.tar.xz", tar_xz()))
+        self.assert_installed()
+
+    def test_zip(self):
+        self.download(*self.serve("ffmpeg.zip", zip_archive()))
+        self.assert_installed()
+
+    def test_zip_with_data_descriptors(self):
+        data = zip_archive(descriptor=True)
+        self.assertTrue(data[6] & 0x08)
+        self.download(*self.serve("ffmpeg.zip", data))
+        self.assert_installed()
+
+    def test_resume_after_cut_connection(self):
+        data = tar_xz()
+        url, checksum_url = self.serve("ffmpeg.tar.xz", data)
+        self.server.cut["/ffmpeg.tar.xz"] = len(data) // 2
+        self.download(url, checksum_url)
+        self.assert_installed()
+        ranges = [header for path, header in self.server.requests if path == "/ffmpeg.tar.xz"]
+        self.assertEqual(ranges, [None, f"bytes={len(data) // 2}-"])
+        self.assertTrue(any(message.startswith("Resuming FFmpeg download") for message in self.log))
+
+    def leave_part_file(self, url, data):
+        # What an interrupted run leaves behind in the work folder
+        part = os.path.join(self.work, f"ffmpeg-{hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]}.part")
+        with open(part, 'wb') as f:
+            f.write(data)
+        with open(part + ".json", 'w') as f:
+            json.dump({"url": url, "etag": '"v1"'}, f)
+
+    def assert_started_over(self, data):
+        self.assert_installed()
+        ranges = [header for path, header in self.server.requests if path == "/ffmpeg.tar.xz"]
+        self.assertEqual(ranges, [f"bytes={len(data)}-", None])
+        self.assertIn("Partial FFmpeg download doesn't match the file upstream, starting over", self.log)
+
+    def test_part_file_already_complete(self):
+        data = tar_xz()
+        url, checksum_url = self.serve("ffmpeg.tar.xz", data)
+        self.leave_part_file(url, data)
+        self.download(url, checksum_url, attempts=1)
+        self.assert_started_over(data)
+
+    def test_part_file_longer_than_download(self):
+        # Upstream replaced the build with a smaller one
+        old = tar_xz() + os.urandom(4096)
+        url, checksum_url = self.serve("ffmpeg.tar.xz", tar_xz())
+        self.leave_part_file(url, old)
+        self.download(url, checksum_url, attempts=1)
+        self.assert_started_over(old)
+
+    def test_range_that_doesnt_continue_part_file(self):
+        data = tar_xz()
+        url, checksum_url = self.serve("ffmpeg.tar.xz", data)
+        self.leave_part_file(url, data[:1000])
+        self.server.bad_range = True
+        self.download(url, checksum_url, attempts=1)
+        self.assert_installed()
+        self.assertIn("Partial FFmpeg download doesn't match the file upstream, starting over", self.log)
+
+    def test_bad_checksum(self):
+        url, checksum_url = self.serve("ffmpeg.zip", zip_archive(), checksum="0" * 64)
+        with self.assertRaisesRegex(ValueError, "checksum mismatch"):
+            self.download(url, checksum_url, attempts=1)
+        self.assertFalse(os.path.exists(self.dest))
+        self.assertEqual([name for name in os.listdir(self.work) if name != "bin"], [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from earbound_core import LibraryIndex, normalize_tag, track_key
+
+# title -> normalized title
+TITLES = [
+    ("Song", "song"),
+    ("Song (Official Video)", "song"),
+    ("Song [Lyrics]", "song"),
+    ("Song feat. X", "song"),
+    ("Song ft. X (Official Audio)", "song"),
+    ("Song - Remastered 2011", "song"),
+    ("Song - 2011 Remastered Version", "song"),
+    ("Song | Topic", "song"),
+    ("Song / Official Audio", "song"),
+    ("Livewire (Official Video)", "livewire"),
+    ("Beyoncé", "beyonce"),
+    ("Song (Live)", "song live"),
+    ("Song - Live", "song live"),
+    ("Song feat. X (Live)", "song live"),
+    ("Song feat. X - Live", "song live"),
+    ("Song (Live at Wembley 1986)", "song live at wembley 1986"),
+    ("Song - Live at Wembley 1986", "song live at wembley 1986"),
+    ("Song (Remix)", "song remix"),
+    ("Song (X Remix)", "song x remix"),
+    ("Song [Acoustic]", "song acoustic"),
+    ("Song (feat. Y) [Instrumental]", "song instrumental"),
+    ("Song (Radio Edit)", "song radio edit"),
+    ("Song (Extended Mix)", "song extended mix"),
+    ("Song | Unplugged", "song unplugged"),
+]
+
+class NormalizeTagTest(unittest.TestCase):
+    def test_titles(self):
+        for title, expected in TITLES:
+            with self.subTest(title=title):
+                self.assertEqual(normalize_tag(title), expected)
+
+    def test_track_key(self):
+        self.assertEqual(track_key("Artist feat. Other", "Song (Official Video)"), "artist|song")
+        self.assertEqual(track_key("Artist, Other", "Song"), "artist|song")
+        self.assertNotEqual(track_key("Artist", "Song (Live)"), track_key("Artist", "Song"))
+        self.assertIsNone(track_key(None, "Song"))
+
+class LibraryIndexFindTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.library = LibraryIndex(self.folder)
+
+    def tearDown(self):
+        self.library.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def add(self, name, duration):
+        with open(os.path.join(self.folder, name), "wb") as f:
+            f.write(b"\0" * 16)
+        artist, title = os.path.splitext(name)[0].split(" - ", 1)
+        self.library._store([(name, 1, 16, artist, title, duration)], [])
+        return os.path.join(self.folder, name)
+
+    def test_versions_dont_match(self):
+        path = self.add("Artist - Song.mp3", 240)
+        self.assertEqual(self.library.find("Artist", "Song (Official Video)", 241, strict=True), [path])
+        self.assertEqual(self.library.find("Artist", "Song (Live)", 240, strict=True), [])
+        self.assertEqual(self.library.find("Artist", "Song (Remix)", 240, strict=True), [])
+        self.assertEqual(self.library.find_name("Artist - Song [Acoustic]"), [])
+
+    def test_durations(self):
+        path = self.add("Artist - Song.mp3", 240)
+        self.assertEqual(self.library.find("Artist", "Song", 243, strict=True), [path])
+        self.assertEqual(self.library.find("Artist", "Song", 250, strict=True), [])
+        self.assertEqual(self.library.find("Artist", "Song", None, strict=True), [])
+        self.assertEqual(self.library.find("Artist", "Song"), [path])
+
+    def test_unknown_duration_only_matches_lookups(self):
+        path = self.add("Artist - Song.mp3", None)
+        self.assertEqual(self.library.find("Artist", "Song", 240, strict=True), [])
+        self.assertEqual(self.library.find_name("Artist - Song"), [path])
+
+    def test_file_name_fallback(self):
+        with open(os.path.join(self.folder, "Artist - Song.mp3"), "wb") as f:
+            f.write(b"\0" * 16)
+        self.library.refresh(workers=2)
+        self.assertEqual(len(self.library), 1)
+        self.assertEqual(self.library.find_name("Artist - Song (Official Video)"), [os.path.join(self.folder, "Artist - Song.mp3")])
+        for title, duration in (("Song", 240), ("Song (Live)", 312), ("Song (Remix)", 400)):
+            with self.subTest(title=title):
+                self.assertEqual(self.library.find("Artist", title, duration, strict=True), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+import unittest
+
+from earbound_core import canonicalize_link, dedupe_links
+
+VIDEO = "dQw4w9WgXcQ"
+PLAYLIST = "PLFgquLnL59alCl_2TQvOiD5Vgm1hCaGSI"
+TRACK = "4uLU6hMCjMI75M1A2tKUQC"
+SPOTIFY_PLAYLIST = "37i9dQZF1DXcBWIGoYBM5M"
+
+VIDEO_URL = f"https://www.youtube.com/watch?v={VIDEO}"
+PLAYLIST_URL = f"https://www.youtube.com/playlist?list={PLAYLIST}"
+
+# link -> (source, kind, id, canonical url)
+CANONICAL = [
+    (f"https://youtu.be/{VIDEO}", ("youtube", "video", VIDEO, VIDEO_URL)),
+    (f"https://youtu.be/{VIDEO}?si=abc&t=42", ("youtube", "video", VIDEO, VIDEO_URL)),
+    (f"https://www.youtube.com/watch?v={VIDEO}&t=42s", ("youtube", "video", VIDEO, VIDEO_URL)),
+    (f"https://m.youtube.com/watch?v={VIDEO}", ("youtube", "video", VIDEO, VIDEO_URL)),
+    (f"HTTPS://WWW.YOUTUBE.COM/watch?v={VIDEO}", ("youtube", "video", VIDEO, VIDEO_URL)),
+    (f"youtube.com/watch?v={VIDEO}", ("youtube", "video", VIDEO, VIDEO_URL)),
+    (f"https://www.youtube.com/shorts/{VIDEO}", ("youtube", "video", VIDEO, VIDEO_URL)),
+    (f"https://music.youtube.com/watch?v={VIDEO}&si=xyz", ("youtube", "video", VIDEO, VIDEO_URL)),
+    (f"https://music.youtube.com/playlist?list={PLAYLIST}&si=xyz", ("youtube", "playlist", PLAYLIST, PLAYLIST_URL)),
+    # A video opened from a playlist is the playlist
+    (f"https://www.youtube.com/watch?v={VIDEO}&list={PLAYLIST}&index=3", ("youtube", "playlist", PLAYLIST, PLAYLIST_URL)),
+    (f"https://www.youtube.com/watch?list={PLAYLIST}", ("youtube", "playlist", PLAYLIST, PLAYLIST_URL)),
+    (f"https://youtu.be/{VIDEO}?list={PLAYLIST}&si=abc", ("youtube", "playlist", PLAYLIST, PLAYLIST_URL)),
+    # ...except an endless RD mix, which stays the video
+    (f"https://www.youtube.com/watch?v={VIDEO}&list=RD{VIDEO}&start_radio=1", ("youtube", "video", VIDEO, VIDEO_URL)),
+    (f"https://youtu.be/{VIDEO}?list=RD{VIDEO}", ("youtube", "video", VIDEO, VIDEO_URL)),
+    (f"https://www.youtube.com/playlist?list=RD{VIDEO}",
+     ("youtube", "playlist", f"RD{VIDEO}", f"https://www.youtube.com/playlist?list=RD{VIDEO}")),
+    # YouTube Music albums and channel pages are lists yt-dlp resolves
+    ("https://music.youtube.com/browse/MPREb_4pL8gzRtw1p?si=abc",
+     ("youtube", "playlist", "browse/MPREb_4pL8gzRtw1p", "https://music.youtube.com/browse/MPREb_4pL8gzRtw1p")),
+    (f"https://music.youtube.com/browse/VL{PLAYLIST}", ("youtube", "playlist", PLAYLIST, PLAYLIST_URL)),
+    ("https://www.youtube.com/@SomeArtist?si=abc", ("youtube", "playlist", "@SomeArtist", "https://www.youtube.com/@SomeArtist")),
+    ("https://www.youtube.com/@SomeArtist/videos", ("youtube", "playlist", "@SomeArtist/videos", "https://www.youtube.com/@SomeArtist/videos")),
+    ("https://m.youtube.com/channel/UC38IQsAvIsxxjztdMZQtwHA/",
+     ("youtube", "playlist", "channel/UC38IQsAvIsxxjztdMZQtwHA", "https://www.youtube.com/channel/UC38IQsAvIsxxjztdMZQtwHA")),
+    ("https://www.youtube.com/user/Name/playlists", ("youtube", "playlist", "user/Name/playlists", "https://www.youtube.com/user/Name/playlists")),
+    (f"spotify:track:{TRACK}", ("spotify", "track", TRACK, f"https://open.spotify.com/track/{TRACK}")),
+    (f"spotify:playlist:{SPOTIFY_PLAYLIST}",
+     ("spotify", "playlist", SPOTIFY_PLAYLIST, f"https://open.spotify.com/playlist/{SPOTIFY_PLAYLIST}")),
+    (f"https://open.spotify.com/track/{TRACK}?si=123", ("spotify", "track", TRACK, f"https://open.spotify.com/track/{TRACK}")),
+    (f"https://open.spotify.com/intl-de/track/{TRACK}?si=123", ("spotify", "track", TRACK, f"https://open.spotify.com/track/{TRACK}")),
+    (f"https://open.spotify.com/intl-pt-br/album/{TRACK}", ("spotify", "album", TRACK, f"https://open.spotify.com/album/{TRACK}")),
+    (f"https://open.spotify.com/embed/playlist/{SPOTIFY_PLAYLIST}",
+     ("spotify", "playlist", SPOTIFY_PLAYLIST, f"https://open.spotify.com/playlist/{SPOTIFY_PLAYLIST}")),
+]
+
+# link -> error message
+INVALID = [
+    ("https://youtu.be/short", "Invalid YouTube link"),
+    ("https://www.youtube.com/feed/library", "Unsupported YouTube link"),
+    ("https://www.youtube.com/@SomeArtist/community", "Unsupported YouTube link"),
+    (f"https://open.spotify.com/show/{TRACK}", "Unsupported Spotify link"),
+    ("spotify:track:bad", "Unsupported link"),
+    ("https://example.com/x", "Unsupported link"),
+]
+
+class CanonicalizeLinkTest(unittest.TestCase):
+    def test_canonical(self):
+        for link, expected in CANONICAL:
+            with self.subTest(link=link):
+                canonical = canonicalize_link(link)
+                self.assertEqual(tuple(canonical), expected)
+                self.assertEqual(canonical.link_type, f"{expected[0]}_{expected[1]}")
+
+    def test_invalid(self):
+        for link, message in INVALID:
+            with self.subTest(link=link):
+                with self.assertRaisesRegex(ValueError, f"^{message}$"):
+                    canonicalize_link(link)
+
+class DedupeLinksTest(unittest.TestCase):
+    def test_variants_of_one_link_are_dropped(self):
+        links = [
+            f"https://youtu.be/{VIDEO}",
+            f"https://music.youtube.com/watch?v={VIDEO}&si=x",
+            f"spotify:track:{TRACK}",
+            "bad",
+            f"https://www.youtube.com/watch?v={VIDEO}&t=42",
+            f"https://open.spotify.com/intl-de/track/{TRACK}",
+            "bad",
+        ]
+        queued, invalid, duplicates = dedupe_links(links)
+        self.assertEqual([c.url for c in queued], [VIDEO_URL, f"https://open.spotify.com/track/{TRACK}"])
+        self.assertEqual(invalid, [("bad", "Unsupported link")])
+        self.assertEqual(duplicates, 3)
+
+    def test_mix_and_playlist_of_one_video_are_distinct(self):
+        links = [f"https://www.youtube.com/watch?v={VIDEO}&list={PLAYLIST}", f"https://youtu.be/{VIDEO}",
+                 f"https://www.youtube.com/watch?v={VIDEO}&list=RD{VIDEO}", f"https://youtu.be/{VIDEO}?list={PLAYLIST}"]
+        queued, invalid, duplicates = dedupe_links(links)
+        self.assertEqual([c.url for c in queued], [PLAYLIST_URL, VIDEO_URL])
+        self.assertEqual((invalid, duplicates), ([], 2))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+from earbound_core import DownloadEngine
+
+PLAYLIST = "https://open.spotify.com/playlist/37i9dQZF1DXcBWIGoYBM5M"
+
+# Resolves the songs in $FAKE_LIST and downloads a .spotdl batch the way spotdl names its files
+FAKE_SPOTDL = r'''
+import os, sys, json
+args = sys.argv[1:]
+def opt(name):
+    return args[args.index(name) + 1] if name in args else None
+if "--version" in args:
+    print("4.0.0-fake")
+    sys.exit(0)
+with open(os.environ["FAKE_LIST"]) as f:
+    songs = json.load(f)
+if args[0] == "save":
+    with open(opt("--save-file"), "w") as f:
+        json.dump(songs, f)
+    sys.exit(0)
+with open(args[1]) as f:
+    batch = json.load(f)
+with open(os.environ["FAKE_LOG"], "a") as f:
+    f.write(json.dumps([song["song_id"] for song in batch]) + "\n")
+print("Found %d songs in Fake Playlist (Playlist)" % len(batch), flush=True)
+for song in batch:
+    name = "%s - %s" % (", ".join(song["artists"]), song["name"])
+    with open(os.path.join(opt("--output"), name + ".mp3"), "w") as f:
+        f.write(song["song_id"])
+    print('Downloaded "%s - %s": https://music.youtube.com/watch?v=%s' % (song["artists"][0], song["name"], song["song_id"][:11]), flush=True)
+    with open(opt("--archive"), "a") as f:
+        f.write("https://open.spotify.com/track/%s\n" % song["song_id"])
+'''
+
+def song(song_id, artist, name, duration=200):
+    return {"song_id": song_id.ljust(22, "0"), "name": name, "artists": [artist], "artist": artist, "duration": duration}
+
+class LogEngine(DownloadEngine):
+    def __init__(self, **kwargs):
+        super().__init__(use_inprocess=False, **kwargs)
+        self.logs = []
+        self.deps_ready.set()
+
+    def log_message(self, message):
+        self.logs.append(message)
+
+class SpotifySyncTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        bin_dir = os.path.join(self.root, "bin")
+        os.makedirs(bin_dir)
+        with open(os.path.join(bin_dir, "spotdl"), "w") as f:
+            f.write(f"#!{sys.executable}\n{FAKE_SPOTDL}")
+        os.chmod(os.path.join(bin_dir, "spotdl"), 0o755)
+        os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+        os.environ["XDG_CACHE_HOME"] = os.path.join(self.root, "cache")
+        os.environ["FAKE_LIST"] = os.path.join(self.root, "list.json")
+        os.environ["FAKE_LOG"] = os.path.join(self.root, "downloads.log")
+        self.folder = os.path.join(self.root, "music")
+        self.synced = os.path.join(self.folder, "Spotify_Playlist")
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def sync(self, songs, prune=False):
+        with open(os.environ["FAKE_LIST"], "w") as f:
+            json.dump(songs, f)
+        engine = LogEngine(prune_removed=prune)
+        job = engine.job_queue.submit(PLAYLIST, "spotify_playlist", self.folder)
+        engine.job_queue.join()
+        self.assertEqual(job.status, "done", job.error)
+        return engine.logs
+
+    def downloads(self):
+        with open(os.environ["FAKE_LOG"]) as f:
+            return [[song_id.rstrip("0") for song_id in json.loads(line)] for line in f]
+
+    def files(self):
+        return sorted(name for name in os.listdir(self.synced) if name.endswith(".mp3"))
+
+    def test_resync_downloads_other_versions(self):
+        studio = song("a", "Artist", "Song")
+        self.sync([studio])
+        logs = self.sync([studio, song("b", "Artist", "Song (Live)", 312), song("c", "Artist", "Song - Remastered 2011")])
+        self.assertTrue(any(line.endswith("2 track(s) added and 0 removed since the last sync, 2 to download") for line in logs))
+        self.assertEqual(self.downloads(), [["a"], ["b", "c"]])
+        self.assertEqual(self.files(), ["Artist - Song (Live).mp3", "Artist - Song - Remastered 2011.mp3", "Artist - Song.mp3"])
+        # Every song now has its own file, so nothing is left to download
+        self.sync([studio, song("b", "Artist", "Song (Live)", 312), song("c", "Artist", "Song - Remastered 2011")])
+        self.assertEqual(len(self.downloads()), 2)
+
+    def test_prune_removes_only_the_removed_recording(self):
+        studio, remaster = song("a", "Artist", "Song"), song("b", "Artist", "Song - Remastered 2011")
+        self.sync([studio, remaster])
+        self.assertEqual(self.downloads(), [["a", "b"]])
+        self.sync([studio], prune=True)
+        self.assertEqual(self.files(), ["Artist - Song.mp3"])
+        with open(os.path.join(self.synced, "Artist - Song.mp3")) as f:
+            self.assertEqual(f.read(), studio["song_id"])
+
+    def test_unsynced_file_with_same_title_is_not_claimed(self):
+        # A file downloaded outside the sync is only taken when its exact name and length match
+        os.makedirs(self.synced)
+        with open(os.path.join(self.synced, "Artist - Song.mp3"), "w") as f:
+            f.write("unsynced")
+        remaster, other = song("b", "Artist", "Song - Remastered 2011"), song("c", "Artist", "Other")
+        self.sync([remaster, other])
+        self.assertEqual(self.downloads(), [["b", "c"]])
+        self.sync([other], prune=True)
+        self.assertEqual(self.files(), ["Artist - Other.mp3", "Artist - Song.mp3"])
+        with open(os.path.join(self.synced, "Artist - Song.mp3")) as f:
+            self.assertEqual(f.read(), "unsynced")
+
+if __name__ == "__main__":
+    unittest.main()